@@ -8,7 +8,8 @@ from api_db_utils import APIDB
 from gaebasepy.auth import GCAuth
 from gaebasepy.exceptions import AuthenticationError
 from gaebasepy.gc_utils import json_from_request
-from tasks import sync_user
+from tasks import sync_user, migrate_participation_keys, migrate_indicators, migrate_course_relations, \
+    migrate_session_indexes, defer
 
 
 __author__ = 'stefano tranquillini'
@@ -17,10 +18,11 @@ import datetime
 import logging
 import logging.config
 
-from google.appengine.ext import ndb, deferred
+from google.appengine.ext import ndb
 
 import cfg
 from models import User, Club
+import search_index
 
 from app import app
 
@@ -58,7 +60,7 @@ def auth_up(req):  # pragma: no cover
     #             'Access-Control-Allow-Origin': origin,
     #             'Access-Control-Allow-Credentials': 'true'})
     # response.write(json.dumps(token))
-    deferred.defer(sync_user, user, s_token)
+    defer(sync_user, user, s_token)
     return token
 
 
@@ -164,7 +166,7 @@ def auth(req, provider, token):  # pragma: no cover
     #             'Access-Control-Allow-Origin': origin,
     #             'Access-Control-Allow-Credentials': 'true'})
     # response.write(json.dumps(token))
-    deferred.defer(sync_user, user, s_token)
+    defer(sync_user, user, s_token)
     return token
 
 
@@ -186,6 +188,75 @@ def delete_auth(req):  # pragma: no cover
         keys = expired_tokens.fetch(100, keys_only=True)
         ndb.delete_multi(keys)
 
+
+@app.route("/%s/search-index" % APP_ADMIN, methods=('GET',))
+def search_index_drain(req):  # pragma: no cover
+    """
+    Function to write the search documents of the users and clubs that changed. Called by ``cron``
+
+    :param req: the request
+    :return: None
+    """
+    for index_name in ("users", "clubs"):
+        written = search_index.drain(index_name)
+        logging.debug("search index %s: %s documents", index_name, written)
+
+
+@app.route("/%s/sessions-status" % APP_ADMIN, methods=('GET',))
+def sessions_status(req):  # pragma: no cover
+    """
+    Function to update the status of the sessions that started or ended. Called by ``cron``
+
+    :param req: the request
+    :return: None
+    """
+    updated = APIDB.update_sessions_status()
+    logging.debug("sessions status: %s sessions updated", updated)
+
+
+@app.route("/%s/migrate-participations" % APP_ADMIN, methods=('GET',))
+def migrate_participations(req):  # pragma: no cover
+    """
+    Starts the task that moves participations and performances to the keys built from their data.
+
+    :param req: the request
+    :return: None
+    """
+    defer(migrate_participation_keys)
+
+
+@app.route("/%s/migrate-indicators" % APP_ADMIN, methods=('GET',))
+def migrate_participation_indicators(req):  # pragma: no cover
+    """
+    Starts the task that encodes the indicators of participations and performances in columns.
+
+    :param req: the request
+    :return: None
+    """
+    defer(migrate_indicators)
+
+
+@app.route("/%s/migrate-course-relations" % APP_ADMIN, methods=('GET',))
+def migrate_relations_of_courses(req):  # pragma: no cover
+    """
+    Starts the task that copies the fields of the courses in their subscriptions and trainers.
+
+    :param req: the request
+    :return: None
+    """
+    defer(migrate_course_relations)
+
+
+@app.route("/%s/migrate-session-indexes" % APP_ADMIN, methods=('GET',))
+def migrate_indexes_of_sessions(req):  # pragma: no cover
+    """
+    Starts the task that stores the club of the sessions and writes their ``SessionMember``.
+
+    :param req: the request
+    :return: None
+    """
+    defer(migrate_session_indexes)
+
 # Enable to test if deployments work
 # #
 # @app.route("/%s/hw" % APP_ADMIN, methods=('GET', ))
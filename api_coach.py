@@ -1,10 +1,9 @@
 import logging
 import logging.config
 
-from google.appengine.ext import deferred
-
-from models import Observation
-from tasks import sync_user
+from models import Observation, resolve_indicators, exercises_to_dict
+from serializer import serialize, response
+from tasks import sync_user, defer
 
 
 __author__ = 'Stefano Tranquillini <stefano.tranquillini@gmail.com>'
@@ -13,13 +12,13 @@ import datetime
 
 from app import app
 from api_db_utils import APIDB
+import identity_map
 from auth import user_has_role
 from gaebasepy.auth import user_required, GCAuth
 from gaebasepy.exceptions import BadParameters, AuthenticationError, BadRequest
 from gaebasepy.gc_utils import sanitize_json, sanitize_list, json_from_paginated_request, \
     json_from_request, date_from_js_timestamp
 from gaebasepy.http_codes import HttpEmpty, HttpCreated
-from google.appengine.api import search
 from google.appengine.ext import ndb
 from google.appengine.ext.ndb.key import Key
 
@@ -75,7 +74,7 @@ def coach_profile(req):
         j_user['memberships'] = sanitize_list(APIDB.get_user_member_of_type(req.user, ['OWNER', 'TRAINER']),
                                               ['id', 'name', 'description'])
         s_token = GCAuth.auth_user_token(user)
-        deferred.defer(sync_user, user, s_token)
+        defer(sync_user, user, s_token)
         return sanitize_json(j_user, out)
 
 
@@ -89,30 +88,33 @@ def coach_club_list(req):
     """
     # check if there's the filter
     user = req.user
-    j_req = json_from_paginated_request(req, (('paginated', 'true'),))
+    j_req = json_from_paginated_request(req, (('paginated', 'true'), ('cursor', '')))
     page = int(j_req['page'])
     size = int(j_req['size'])
     paginated = j_req['paginated'] == 'true'
 
     # if paginated then use the pagination..
     if paginated:
-        clubs, total = APIDB.get_user_owner_or_trainer_of(user, paginated=True, page=page, size=size)
+        clubs, total, cursors = APIDB.get_user_owner_or_trainer_of(user, paginated=True, page=page, size=size,
+                                                                   cursor=j_req['cursor'])
     else:
         clubs = APIDB.get_user_owner_or_trainer_of(user)
     # render accordingly to the doc.
     ret = {}
     items = []
+    clubs = [club for club in clubs if not club.is_deleted]
+    aggregates = APIDB.get_clubs_aggregates(clubs, trainers=True)
     for club in clubs:
-        if not club.is_deleted:
-            j_club = club.to_dict()
-            j_club['role'] = club.membership.membership_type
-            j_club['member_count'] = APIDB.get_club_members(club, count_only=True)
-            j_club['course_count'] = APIDB.get_club_courses(club, count_only=True)
-            j_club['owner_count'] = APIDB.get_club_owners(club, count_only=True)
-            j_club['trainer_count'] = APIDB.get_club_trainers(club, count_only=True)
-            # j_club['owners'] = sanitize_list(APIDB.get_club_owners(club), ['id','name', 'picture'])
-            items.append(j_club)
-            j_club['trainers'] = sanitize_list(APIDB.get_club_trainers(club), ['id', 'name', 'picture'])
+        j_club = club.to_dict()
+        j_club['role'] = club.membership.membership_type
+        club_aggregates = aggregates[club.key]
+        j_club['member_count'] = club_aggregates['member_count']
+        j_club['course_count'] = club_aggregates['course_count']
+        j_club['owner_count'] = club_aggregates['owner_count']
+        j_club['trainer_count'] = club_aggregates['trainer_count']
+        # j_club['owners'] = sanitize_list(club_aggregates['owners'], ['id','name', 'picture'])
+        items.append(j_club)
+        j_club['trainers'] = sanitize_list(club_aggregates['trainers'], ['id', 'name', 'picture'])
 
     if paginated:
         ret['results'] = sanitize_list(items,
@@ -120,6 +122,7 @@ def coach_club_list(req):
                                         'owner_count', 'trainer_count',
                                         'member_count', 'course_count', 'trainers', 'role'])
         ret['total'] = total
+        ret.update(cursors)
         return ret
     else:
         return sanitize_list(items,
@@ -201,22 +204,24 @@ def coach_club_membership(req, uskey_club):
     List of the members of a club. |uroleOT|
     """
     club = req.model
-    j_req = json_from_paginated_request(req)
+    j_req = json_from_paginated_request(req, (('cursor', ''),))
     page = int(j_req['page'])
     size = int(j_req['size'])
     role = req.get('role', None)
     status = req.get('status', "ACCEPTED")
     l_users = []
     if not role:
-        members, total = APIDB.get_club_all_members(club, status=status, paginated=True, page=page, size=size,
-                                                    merge="role")
+        members, total, cursors = APIDB.get_club_all_members(club, status=status, paginated=True, page=page, size=size,
+                                                             merge="role", cursor=j_req['cursor'])
     elif role == "MEMBER":
-        members, total = APIDB.get_club_members(club, status=status, paginated=True, page=page, size=size, merge='role')
+        members, total, cursors = APIDB.get_club_members(club, status=status, paginated=True, page=page, size=size,
+                                                         merge='role', cursor=j_req['cursor'])
     elif role == "TRAINER":
-        members, total = APIDB.get_club_trainers(club, status=status, paginated=True, page=page, size=size,
-                                                 merge='role')
+        members, total, cursors = APIDB.get_club_trainers(club, status=status, paginated=True, page=page, size=size,
+                                                          merge='role', cursor=j_req['cursor'])
     elif role == "OWNER":
-        members, total = APIDB.get_club_owners(club, status=status, paginated=True, page=page, size=size, merge='role')
+        members, total, cursors = APIDB.get_club_owners(club, status=status, paginated=True, page=page, size=size,
+                                                        merge='role', cursor=j_req['cursor'])
     # if the query is paginated, and the previous call has already fetched enough people.
     else:
         raise BadParameters("Role does not exists %s" % role)
@@ -236,7 +241,7 @@ def coach_club_membership(req, uskey_club):
         res_user['id_membership'] = member.role.id
         l_users.append(res_user)
 
-    return dict(results=l_users, total=total)
+    return dict(results=l_users, total=total, **cursors)
 
 
 @app.route('/%s/clubs/<uskey_club>/memberships' % APP_COACH, methods=('POST',))
@@ -294,26 +299,22 @@ def coach_course_list(req, uskey_club):
     List of the courses of a club. |uroleOT|
     """
     club = req.model
-    j_req = json_from_paginated_request(req, (('courseType', None), ('activeOnly', None),))
+    j_req = json_from_paginated_request(req, (('courseType', None), ('activeOnly', None), ('cursor', '')))
     page = int(j_req['page'])
     size = int(j_req['size'])
     course_type = j_req['courseType']
     active_only = j_req['activeOnly'] == "true"
-    courses, total = APIDB.get_club_courses(club, course_type=course_type, active_only=active_only,
-                                            paginated=True, page=page, size=size)
+    courses, total, cursors = APIDB.get_club_courses(club, course_type=course_type, active_only=active_only,
+                                                     paginated=True, page=page, size=size, cursor=j_req['cursor'])
     res_courses = []
+    stats = APIDB.get_courses_stats(courses)
     for course in courses:
         j_course = course.to_dict()
-        j_course["trainers"] = sanitize_list(APIDB.get_course_trainers(course), allowed=["id", "name", "picture"])
-        j_course["subscriber_count"] = APIDB.get_course_subscribers(course, count_only=True)
-        sessions_total = APIDB.get_course_sessions(course)
-        j_course['session_count'] = len(sessions_total)
-        sessions_finished = [session for session in sessions_total if session.status == "FINISHED"]
-        # logger.debug("%s %s %s", len(sessions_total), len(sessions_finished),long(sessions_finished)/long(sessions_total) * 100 )
-        if len(sessions_total) > 0:
-            j_course['completeness'] = long(len(sessions_finished)) / long(len(sessions_total)) * 100
-        else:
-            j_course['completeness'] = 0
+        course_stats = stats[course.key]
+        j_course["trainers"] = sanitize_list(course_stats['trainers'], allowed=["id", "name", "picture"])
+        j_course["subscriber_count"] = course_stats['subscriber_count']
+        j_course['session_count'] = course_stats['session_count']
+        j_course['completeness'] = course_stats['completeness']
         allowed = ["id", "name", "description", "trainers", "subscriber_count", "session_count", "course_type",
                    "completeness", "profile", "max_level"]
         if course.course_type == "SCHEDULED":
@@ -325,6 +326,7 @@ def coach_course_list(req, uskey_club):
     ret = {}
     ret['results'] = res_courses
     ret['total'] = total
+    ret.update(cursors)
     return ret
 
 
@@ -367,17 +369,11 @@ def coach_course_detail(req, uskey_course):
     """
     course = req.model
     j_course = course.to_dict()
-    j_course['trainers'] = sanitize_list(APIDB.get_course_trainers(course), allowed=['id', 'name', 'picture'])
-    j_course['subscriber_count'] = APIDB.get_course_subscribers(course, count_only=True)
-    # the filter on status does not work, this is an "expensive" workaround
-    sessions_total = APIDB.get_course_sessions(course)
-    j_course['session_count'] = len(sessions_total)
-    sessions_finished = [session for session in sessions_total if session.status == "FINISHED"]
-    # logger.debug("%s %s %s", len(sessions_total), len(sessions_finished),long(sessions_finished)/long(sessions_total) * 100 )
-    if len(sessions_total) > 0:
-        j_course['completeness'] = long(len(sessions_finished)) / long(len(sessions_total)) * 100
-    else:
-        j_course['completeness'] = 0
+    course_stats = APIDB.get_courses_stats([course])[course.key]
+    j_course['trainers'] = sanitize_list(course_stats['trainers'], allowed=['id', 'name', 'picture'])
+    j_course['subscriber_count'] = course_stats['subscriber_count']
+    j_course['session_count'] = course_stats['session_count']
+    j_course['completeness'] = course_stats['completeness']
     return sanitize_json(j_course, ['id', 'name', 'description', 'start_date', 'end_date', 'duration',
                                     'trainers', 'course_type', 'subscriber_count', 'session_count', 'completeness',
                                     "profile", 'max_level'],
@@ -428,7 +424,7 @@ def coach_course_session_list(req, uskey_course):
     course = req.model
     j_req = json_from_paginated_request(req, (('status', None), ('type', None),
                                               ('from', None),
-                                              ('to', None)))
+                                              ('to', None), ('cursor', '')))
     # date_to_js_timestamp(datetime.datetime.now())))
     page = int(j_req['page'])
     size = int(j_req['size'])
@@ -445,33 +441,26 @@ def coach_course_session_list(req, uskey_course):
         # raise BadParameters("Problems with the data format %s" % e.message)
     session_type = j_req['type']
 
-    sessions, total = APIDB.get_course_sessions(course, date_from=date_from, date_to=date_to, session_type=session_type,
-                                                status=status,
-                                                paginated=True, page=page, size=size)
+    sessions, total, cursors = APIDB.get_course_sessions(course, date_from=date_from, date_to=date_to,
+                                                         session_type=session_type, status=status,
+                                                         paginated=True, page=page, size=size, cursor=j_req['cursor'])
     res_list = []
+    # the same for all the sessions
+    course_subscribers = APIDB.get_course_subscribers(course, count_only=True)
     for session in sessions:
-        res_obj = session.to_dict()
-        res_obj['status'] = session.status
+        # this list never showed the url of the single sessions
+        fields = [name for name in session.summary_fields(course) if name != 'url']
         # res_obj['participated'] = APIDB.user_participated_in_session(req.user, session)
         session_participations = APIDB.get_session_participations(session, count_only=True)
-        course_subscribers = APIDB.get_course_subscribers(course, count_only=True)
-        res_obj['participation_count'] = session_participations
         if course_subscribers:
-            res_obj['participation_percent'] = 100 * (float(session_participations) / float(course_subscribers))
+            participation_percent = 100 * (float(session_participations) / float(course_subscribers))
         else:
-            res_obj['participation_percent'] = 0
-        # res_obj['actnoivity_count'] = session.activity_count
-        # TODO: check the 'url' here
-        allowed = ['id', 'name', 'status', 'participation_count',
-                   'session_type', 'participation_percent', 'max_level', 'profile']
-        course_type = session.course.get().course_type
-        if course_type == "SCHEDULED":
-            allowed += ["start_date", "end_date"]
-        elif course_type == "PROGRAM":
-            allowed += ["week_no", "day_no"]
-        res_list.append(sanitize_json(res_obj, allowed=allowed))
+            participation_percent = 0
+        res_list.append(serialize(session, fields, participation_count=session_participations,
+                                  participation_percent=participation_percent, max_level=course.max_level,
+                                  profile=course.profile))
 
-    return dict(total=total, results=res_list)
+    return response(total=total, results=res_list, **cursors)
 
 
 @app.route('/%s/courses/<uskey_course>/sessions' % APP_COACH, methods=('POST',))
@@ -512,8 +501,7 @@ def coach_session_detail(req, uskey_session):
                                                    "required"])
     activities = APIDB.get_session_exercises(session)
     res_list = []
-    for activity in activities:
-        j_activity = activity.to_dict()
+    for activity, j_activity in zip(activities, exercises_to_dict(activities)):
         level_count = len(activity.levels)
         j_activity['level_count'] = level_count
 
@@ -576,16 +564,17 @@ def coach_session_participations(req, uskey_session):
     """
     session = req.model
     user = req.user
-    j_req = json_from_paginated_request(req)
+    j_req = json_from_paginated_request(req, (('cursor', ''),))
     # if j_req['paginated']:
-    participations, total = APIDB.get_session_participations(session, paginated=True, size=j_req['size'],
-                                                             page=j_req['page'])
+    participations, total, cursors = APIDB.get_session_participations(session, paginated=True, size=int(j_req['size']),
+                                                                      page=int(j_req['page']), cursor=j_req['cursor'])
     # else:
     # participations = APIDB.get_session_participations(session, paginated=True, size=j_req['size'],
     # page=j_req['page'])
 
     res_list = []
-    for participation in participations:
+    indicators = resolve_indicators(participations)
+    for participation, participation_indicators in zip(participations, indicators):
         res = participation.to_dict()
         res['user'] = sanitize_json(participation.user.get(), ['name', 'id', 'avatar', 'picture', 'sensors'],
                                     except_on_missing=False)
@@ -594,13 +583,13 @@ def coach_session_participations(req, uskey_session):
         res['current_level'] = subscription.profile_level
         res['level'] = participation.level
         res['level_up'] = subscription.increase_level
-        res['indicators'] = participation.indicators
+        res['indicators'] = participation_indicators
         res['max_completeness'] = participation.max_completeness
         res['participation_count'] = participation.participation_count
         res_list.append(sanitize_json(res, ['id', 'user', 'level_up', 'current_level', 'indicators',
                                             'max_completeness', 'completeness', 'participation_count', 'time',
                                             'level', 'subscription_id']))
-    return dict(results=res_list, total=total)
+    return dict(results=res_list, total=total, **cursors)
 
 
 @app.route('/%s/clubs/<uskey_club>/sessions' % APP_COACH, methods=('GET',))
@@ -614,7 +603,7 @@ def coach_club_session_list(req, uskey_club):
     club = req.model
     j_req = json_from_paginated_request(req, (('status', None), ('notStatus', None), ('type', None),
                                               ('from', None),
-                                              ('to', None)))
+                                              ('to', None), ('cursor', '')))
     page = int(j_req['page'])
     size = int(j_req['size'])
 
@@ -631,30 +620,23 @@ def coach_club_session_list(req, uskey_club):
     role = APIDB.get_user_club_role(req.user, club)
     logging.debug(j_req)
     if role == "OWNER":
-        sessions, total = APIDB.get_club_sessions(club, date_from=date_from, date_to=date_to,
-                                                  session_type=session_type, paginated=True,
-                                                  not_status=j_req['notStatus'], page=page, size=size)
+        sessions, total, cursors = APIDB.get_club_sessions(club, date_from=date_from, date_to=date_to,
+                                                           session_type=session_type, paginated=True,
+                                                           not_status=j_req['notStatus'], page=page, size=size,
+                                                           cursor=j_req['cursor'])
     else:
-        sessions, total = APIDB.get_session_im_trainer_of(req.user, club, date_from=date_from, date_to=date_to,
-                                                          session_type=session_type, paginated=True, page=page,
-                                                          size=size)
+        sessions, total, cursors = APIDB.get_session_im_trainer_of(req.user, club, date_from=date_from, date_to=date_to,
+                                                                   session_type=session_type, paginated=True, page=page,
+                                                                   size=size, cursor=j_req['cursor'])
+    course_keys = list(set(session.course for session in sessions))
+    courses = dict(zip(course_keys, identity_map.get_multi(course_keys)))
     res_list = []
     for session in sessions:
-        res_obj = session.to_dict()
-        res_obj['status'] = session.status
-        res_obj['participation_count'] = APIDB.get_session_participations(session, count_only=True)
-        res_obj['course'] = sanitize_json(session.course.get(), allowed=['id', 'name'])
-        allowed = ['id', 'name', 'status', 'participation_count',
-                   'session_type', 'course', 'created']
-        course_type = session.course.get().course_type
-        if course_type == "SCHEDULED":
-            allowed += ["start_date", "end_date"]
-        elif course_type == "PROGRAM":
-            allowed += ["week_no", "day_no"]
-        if session.session_type == "SINGLE":
-            allowed += ['url']
-        res_list.append(sanitize_json(res_obj, allowed=allowed))
-    return dict(total=total, results=res_list)
+        course = courses[session.course]
+        res_list.append(serialize(session, session.summary_fields(course) + ['created'],
+                                  participation_count=APIDB.get_session_participations(session, count_only=True),
+                                  course=dict(id=course.id, name=course.name)))
+    return response(total=total, results=res_list, **cursors)
 
 
 @app.route('/%s/courses/<uskey_course>/subscriptions' % APP_COACH, methods=('GET',))
@@ -666,12 +648,12 @@ def coach_course_subscribers(req, uskey_course):
     List of the subscribers of a course. |uroleOT|
     """
     course = req.model
-    j_req = json_from_paginated_request(req)
+    j_req = json_from_paginated_request(req, (('cursor', ''),))
     page = int(j_req['page'])
     size = int(j_req['size'])
     # the merge field is used later
-    subscribers, total = APIDB.get_course_subscribers(course, paginated=True, page=page, size=size,
-                                                      merge="subscription")
+    subscribers, total, cursors = APIDB.get_course_subscribers(course, paginated=True, page=page, size=size,
+                                                               merge="subscription", cursor=j_req['cursor'])
     res = []
     for subscriber in subscribers:
         res_subscriber = sanitize_json(subscriber, allowed=['id', 'name', 'picture', 'nickname'])
@@ -680,7 +662,7 @@ def coach_course_subscribers(req, uskey_course):
                                          allowed=['id', 'profile_level'])
         res_subscription['user'] = res_subscriber
         res.append(res_subscription)
-    return dict(results=res, total=total)
+    return dict(results=res, total=total, **cursors)
 
 
 @app.route('/%s/courses/<uskey_course>/subscriptions' % APP_COACH, methods=('POST',))
@@ -722,16 +704,17 @@ def coach_course_subscription_details(req, uskey_subscription):
     sessions = APIDB.get_course_sessions(subscription.course.get())
     res_list = []
     added_activities = []
+    activities = []
     for session in sessions:
-        activities = APIDB.get_session_exercises(session)
-        for activity in activities:
+        for activity in APIDB.get_session_exercises(session):
             if activity.id not in added_activities:
                 added_activities.append(activity.id)
-                j_activity = activity.to_dict()
-                level_count = len(activity.levels)
-                j_activity['level_count'] = level_count
-            # this is already a json, see docs in the model
-                res_list.append(j_activity)
+                activities.append(activity)
+    for activity, j_activity in zip(activities, exercises_to_dict(activities)):
+        level_count = len(activity.levels)
+        j_activity['level_count'] = level_count
+        # this is already a json, see docs in the model
+        res_list.append(j_activity)
     res['activities'] = sanitize_list(res_list,allowed=['id', 'name', 'level_count'])
     return res
 
@@ -803,17 +786,17 @@ def coach_club_activities(req, uskey_club):
     List of activities of a club. |uroleOT|
     """
     club = req.model
-    j_req = json_from_paginated_request(req)
+    j_req = json_from_paginated_request(req, (('cursor', ''),))
     page = int(j_req['page'])
     size = int(j_req['size'])
-    exercises, total = APIDB.get_club_activities(club, paginated=True, page=page, size=size)
+    exercises, total, cursors = APIDB.get_club_activities(club, paginated=True, page=page, size=size,
+                                                          cursor=j_req['cursor'])
     ret = []
-    for exercise in exercises:
-        res_obj = exercise.to_dict()
+    for exercise, res_obj in zip(exercises, exercises_to_dict(exercises)):
         res_obj['level_count'] = exercise.level_count
         res_obj['indicator_count'] = exercise.indicator_count
         ret.append(sanitize_json(res_obj, allowed=['id', 'name', 'level_count', 'indicator_count']))
-    return dict(results=ret, total=total)
+    return dict(results=ret, total=total, **cursors)
 
 
 @app.route('/%s/clubs/<uskey_club>/activities' % APP_COACH, methods=('POST',))
@@ -925,11 +908,11 @@ def coach_details_list(req, uskey_club):
     Gets the list of details. |uroleOT|
     """
     club = req.model
-    j_req = json_from_paginated_request(req)
+    j_req = json_from_paginated_request(req, (('cursor', ''),))
     page = int(j_req['page'])
     size = int(j_req['size'])
-    details, total = APIDB.get_club_details(club, paginated=True, page=page, size=size)
-    return dict(total=total, results=sanitize_list(details, allowed=['id', 'name', 'description']))
+    details, total, cursors = APIDB.get_club_details(club, paginated=True, page=page, size=size, cursor=j_req['cursor'])
+    return dict(total=total, results=sanitize_list(details, allowed=['id', 'name', 'description']), **cursors)
 
 
 @app.route('/%s/details/<uskey_detail>' % APP_COACH, methods=('GET',))
@@ -983,11 +966,12 @@ def coach_indicators_list(req, uskey_club):
     Gets the list of indicators. |uroleOT|
     """
     club = req.model
-    j_req = json_from_paginated_request(req)
+    j_req = json_from_paginated_request(req, (('cursor', ''),))
     page = int(j_req['page'])
     size = int(j_req['size'])
-    indicators, total = APIDB.get_club_indicators(club, paginated=True, page=page, size=size)
-    return dict(total=total, results=sanitize_list(indicators, allowed=['id', 'name', 'description']))
+    indicators, total, cursors = APIDB.get_club_indicators(club, paginated=True, page=page, size=size,
+                                                           cursor=j_req['cursor'])
+    return dict(total=total, results=sanitize_list(indicators, allowed=['id', 'name', 'description']), **cursors)
 
 
 @app.route('/%s/indicators/<uskey_indicator>' % APP_COACH, methods=('GET',))
@@ -1040,25 +1024,29 @@ def coach_participations_performances(req, uskey_participation):
 
     Perfomances of a participation. |uroleOT|
     """
+    # the details have all the attempts, also the old ones
     participation = req.model
-
     user = participation.user.get()
     performances = APIDB.get_performances_from_participation(participation)
+    history = APIDB.get_attempts_history([participation] + performances)
+    participation, performances = history[0], history[1:]
     res_list = []
     session = participation.session.get()
     subscription = APIDB.get_course_subscription(session.course, user)
 
-    for performance in performances:
+    # one get_multi for the indicators of the participation and of all the performances
+    indicators = resolve_indicators([participation] + performances)
+    for performance, performance_indicators in zip(performances, indicators[1:]):
         res_obj = performance.to_dict()
         activity = performance.activity.get()
         res_obj['activity'] = sanitize_json(activity, ['id', 'name'])
-        res_obj['indicators'] = performance.indicators
+        res_obj['indicators'] = performance_indicators
         res_list.append(sanitize_json(res_obj,
                                       ['activity', 'record_date', 'completeness', 'indicators', 'max_completeness',
                                        'level']))
     d_participation = participation.to_dict()
     d_participation['max_completeness'] = participation.max_completeness
-    d_participation['indicators'] = participation.indicators
+    d_participation['indicators'] = indicators[0]
     return dict(user=sanitize_json(user, ['id', 'name', 'picture', 'sensors'], except_on_missing=False),
                 participation=sanitize_json(d_participation,
                                             ['id', 'max_completeness', 'completeness', 'time', 'indicators']),
@@ -1074,7 +1062,7 @@ def coach_performance_detail(req, uskey_perfomance):
 
     Details of the performance. |uroleOT|
     """
-    performance = req.model
+    performance = APIDB.get_attempts_history([req.model])[0]
     res = performance.to_dict()
     activity = performance.activity.get()
     res['activity'] = sanitize_json(activity, ['name', 'id'])
@@ -1104,6 +1092,8 @@ def search_user(req):
     offset = size * (int(j_req['page']))
     if not query_string:
         raise BadParameters("Missing 'query' parameter")
+    # imported here, only this endpoint uses the search api and it's slow to import
+    from google.appengine.api import search
     index = search.Index(name="users")
     query_options = search.QueryOptions(ids_only=True, offset=offset, limit=size)
     query = search.Query(query_string=query_string, options=query_options)
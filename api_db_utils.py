@@ -12,9 +12,12 @@ import datetime
 
 from google.appengine.ext import ndb
 from google.appengine.ext.ndb.key import Key
-from google.appengine.ext.ndb.query import Query
+from google.appengine.ext.ndb.query import Query, ConjunctionNode, DisjunctionNode, FilterNode
 
 import cfg
+import counters
+import identity_map
+import role_cache
 from gaebasepy.exceptions import ServerError, BadParameters, BadRequest
 import models
 from gaebasepy.gc_models import GCModel
@@ -36,7 +39,11 @@ class APIDB():
     model_course_user = models.CourseSubscription
     model_course_trainers = models.CourseTrainers
     model_session = models.Session
+    model_session_member = models.SessionMember
+    model_timeline = models.Timeline
+    model_timeline_stub = models.TimelineStub
     model_participation = models.Participation
+    model_participation_attempt = models.ParticipationAttempt
     model_exercise = models.Exercise
     model_time_data = models.TimeData
     model_performance = models.Performance
@@ -265,6 +272,7 @@ class APIDB():
         :return: list of users
         """
         kwargs['projection'] = 'member'
+        kwargs['counter'] = cls.__counter_name('members', club, 'ALL', status)
         query = club.all_memberships.filter(cls.model_club_user.status == status)
         return cls.__get(query, **kwargs)
 
@@ -279,6 +287,7 @@ class APIDB():
         :return: list of users
         """
         kwargs['projection'] = 'member'
+        kwargs['counter'] = cls.__counter_name('members', club, 'MEMBER', status)
         query = club.members.filter(cls.model_club_user.status == status)
         return cls.__get(query, **kwargs)
 
@@ -293,6 +302,7 @@ class APIDB():
         :return: list of users
         """
         kwargs['projection'] = 'member'
+        kwargs['counter'] = cls.__counter_name('members', club, 'TRAINER', status)
         query = club.trainers.filter(cls.model_club_user.status == status)
         return cls.__get(query, **kwargs)
 
@@ -307,6 +317,7 @@ class APIDB():
         :return: list of users
         """
         kwargs['projection'] = 'member'
+        kwargs['counter'] = cls.__counter_name('members', club, 'OWNER', status)
         query = club.owners.filter(cls.model_club_user.status == status)
         return cls.__get(query, **kwargs)
 
@@ -328,8 +339,68 @@ class APIDB():
             query = query.filter(cls.model_course.end_date > datetime.datetime.now()).order(cls.model_course.end_date)
         else:
             query = query.order(GCModel.created)
+            # active_only depends on the time, it can't be counted
+            kwargs['counter'] = cls.__counter_name('courses', club, course_type or 'ALL')
         return cls.__get(query, **kwargs)
 
+    @classmethod
+    def get_clubs_aggregates(cls, clubs, owners=False, trainers=False):
+        """
+        Gets the counts of members, courses, owners and trainers of a list of clubs, and optionally their owners and
+        trainers. It's the batch version of ``get_club_members(club, count_only=True)`` and the others, the number
+        of round trips does not depend on the number of clubs: the counters are read together, the missing counts and
+        the lists run as parallel async queries and the users are loaded with one ``get_multi``.
+
+        :param clubs: list of clubs
+        :param owners: if the list of the owners is needed
+        :param trainers: if the list of the trainers is needed
+        :return: dict ``club.key`` -> dict with ``member_count``, ``course_count``, ``owner_count``,
+            ``trainer_count`` and, if requested, ``owners`` and ``trainers`` (list of users)
+        """
+        counts = {}
+        for club in clubs:
+            counts[club.key] = dict(
+                member_count=(cls.__counter_name('members', club, 'MEMBER', 'ACCEPTED'),
+                              club.members.filter(cls.model_club_user.status == 'ACCEPTED')),
+                course_count=(cls.__counter_name('courses', club, 'ALL'),
+                              cls.model_course.query(cls.model_course.club == club.key,
+                                                     cls.model_course.is_deleted == False)),
+                owner_count=(cls.__counter_name('members', club, 'OWNER', 'ACCEPTED'),
+                             club.owners.filter(cls.model_club_user.status == 'ACCEPTED')),
+                trainer_count=(cls.__counter_name('members', club, 'TRAINER', 'ACCEPTED'),
+                               club.trainers.filter(cls.model_club_user.status == 'ACCEPTED')))
+        values = counters.get_counts([name for club_counts in counts.values() for name, _ in club_counts.values()])
+        # start all the queries, then wait
+        futures = {}
+        for club_counts in counts.itervalues():
+            for name, query in club_counts.itervalues():
+                if values[name] is None and name not in futures:
+                    futures[name] = query.count_async()
+        lists = []
+        if owners:
+            lists.append('owners')
+        if trainers:
+            lists.append('trainers')
+        relations = {}
+        for club in clubs:
+            for field in lists:
+                query = getattr(club, field).filter(cls.model_club_user.status == 'ACCEPTED')
+                relations[(club.key, field)] = query.fetch_async()
+        for name, future in futures.iteritems():
+            values[name] = counters.initialize(name, future.get_result())
+        for key in relations:
+            relations[key] = relations[key].get_result()
+        user_keys = list(set(relation.member for memberships in relations.values() for relation in memberships))
+        users = dict(zip(user_keys, ndb.get_multi(user_keys)))
+        ret = {}
+        for club in clubs:
+            aggregates = dict((field, values[name]) for field, (name, _) in counts[club.key].iteritems())
+            for field in lists:
+                aggregates[field] = [users[relation.member] for relation in relations[(club.key, field)]
+                                     if users[relation.member]]
+            ret[club.key] = aggregates
+        return ret
+
     @classmethod
     def add_member_to_club(cls, user, club, status="PENDING", end_date=None):
         """
@@ -341,9 +412,9 @@ class APIDB():
         :param end_date: when the membership ends (default=``None``)
         :return: the membership object
         """
-        return cls.model_club_user(id=cls.model_club_user.build_id(user.key, club.key),
-                                   member=user.key, club=club.key, status=status,
-                                   end_date=end_date).put()
+        return cls.__counted_put(cls.model_club_user(id=cls.model_club_user.build_id(user.key, club.key),
+                                                     member=user.key, club=club.key, status=status,
+                                                     end_date=end_date))
 
     @classmethod
     def rm_member_from_club(cls, user, club):
@@ -359,7 +430,7 @@ class APIDB():
         relation = ndb.Key(cls.model_club_user, cls.model_club_user.build_id(user.key, club.key)).get()
         if relation:
             relation.is_active = False
-            relation.put()
+            cls.__counted_put(relation)
             return True
         else:
             return False
@@ -375,9 +446,9 @@ class APIDB():
         :param end_date: when the membership ends (default=``None``)
         :return: the membership object
         """
-        return cls.model_club_user(id=cls.model_club_user.build_id(user.key, club.key),
-                                   member=user.key, club=club.key, is_active=True, membership_type="TRAINER",
-                                   status=status, end_date=end_date).put()
+        return cls.__counted_put(cls.model_club_user(id=cls.model_club_user.build_id(user.key, club.key),
+                                                     member=user.key, club=club.key, is_active=True,
+                                                     membership_type="TRAINER", status=status, end_date=end_date))
 
     @classmethod
     def rm_trainer_from_club(cls, user, club):
@@ -405,9 +476,9 @@ class APIDB():
         """
         if end_date and end_date.isNondigit():
             end_date = date_from_js_timestamp(end_date)
-        return cls.model_club_user(id=cls.model_club_user.build_id(user.key, club.key),
-                                   member=user.key, club=club.key, is_active=True, membership_type="OWNER",
-                                   status="ACCEPTED", end_date=end_date).put()
+        return cls.__counted_put(cls.model_club_user(id=cls.model_club_user.build_id(user.key, club.key),
+                                                     member=user.key, club=club.key, is_active=True,
+                                                     membership_type="OWNER", status="ACCEPTED", end_date=end_date))
 
     @classmethod
     def rm_owner_from_club(cls, user, club):
@@ -507,7 +578,10 @@ class APIDB():
         :param args: dict containing the data of the course
         :return: the course
         """
+        before = cls.model_course_user.course_values(course)
         cls.__update(course, not_allowed=['club'], **args)
+        if cls.model_course_user.course_values(course) != before:
+            cls.__sync_course_relations(course)
         return course
 
     @classmethod
@@ -518,9 +592,62 @@ class APIDB():
         :param course: the course to delete
         :return: the course
         """
-        course.safe_delete()
+        cls.__counted_put(course, course.safe_delete)
+        cls.__sync_course_relations(course)
+        # tasks imports APIDB
+        from tasks import defer, detach_course_sessions
+        defer(detach_course_sessions, course.key)
         return course
 
+    @classmethod
+    def __sync_course_relations(cls, course, max_members=100):
+        """
+        Syncs the relations of the course after it changed in the fields they copy (see
+        :py:meth:`.sync_course_relations`), in the request if the course has up to ``max_members`` subscriptions,
+        in the task ``tasks.sync_course_relations`` otherwise.
+
+        :param course: the course
+        :param max_members: the number of subscriptions of the courses synced in the request
+        """
+        if cls.__subscriptions_async(course.key, max_members).get_result() <= max_members:
+            cls.sync_course_relations(course)
+        else:
+            # tasks imports APIDB
+            from tasks import defer, sync_course_relations
+            defer(sync_course_relations, course.key)
+
+    @classmethod
+    def __subscriptions_async(cls, course_key, max_members):
+        """
+        Counts the subscriptions of a course up to ``max_members + 1``, to know if it's too large to write its
+        relations in the request.
+
+        :param course_key: the key of the course
+        :param max_members: the limit
+        :return: the future of the count
+        """
+        return cls.model_course_user.query(cls.model_course_user.course == course_key).count_async(
+            limit=max_members + 1)
+
+    @classmethod
+    def sync_course_relations(cls, course, batch_size=100):
+        """
+        Copies the fields of the course to its subscriptions and trainers (see ``models.CourseRelation``), only
+        the relations that changed are written.
+
+        :param course: the course
+        :param batch_size: the number of relations stored with each ``put_multi``
+        """
+        for model in (cls.model_course_user, cls.model_course_trainers):
+            changed = []
+            for relation in model.query(model.course == course.key).iter(batch_size=batch_size):
+                if relation.copy_course(course):
+                    changed.append(relation)
+                if len(changed) == batch_size:
+                    ndb.put_multi(changed)
+                    changed = []
+            ndb.put_multi(changed)
+
     @classmethod
     def add_member_to_course(cls, user, course, status="PENDING", profile_level=1):
         """
@@ -533,11 +660,17 @@ class APIDB():
         """
         # Q: do we have to add it to the club as well, one person should not be able
         # to subscribe to a course of a club he's not member of.
-        rel = cls.model_course_user(id=cls.model_course_user.build_id(user, course),
-                                    member=user.key, course=course.key, is_active=True, status=status,
-                                    profile_level=profile_level).put()
+        subscription = cls.model_course_user(id=cls.model_course_user.build_id(user, course), member=user.key,
+                                             course=course.key, is_active=True, status=status,
+                                             profile_level=profile_level)
+        subscription.copy_course(course)
+        rel = cls.__counted_put(subscription)
+        # tasks imports APIDB
+        from tasks import defer, add_to_session_indexes, add_course_to_timeline
+        defer(add_to_session_indexes, user.key, course.key, 'subscribers')
+        defer(add_course_to_timeline, user.key, course.key)
         # also add the trainer to the club, just in case
-        cls.add_member_to_club(user, course.club.get(), status=status)
+        cls.add_member_to_club(user, identity_map.get(course.club), status=status)
         return rel
 
     @classmethod
@@ -553,7 +686,7 @@ class APIDB():
         relation = ndb.Key(cls.model_course_user, cls.model_course_user.build_id(user.key, course.key)).get()
         if relation:
             relation.is_active = False
-            relation.put()
+            cls.__counted_put(relation)
             return True
         else:
             return False
@@ -567,8 +700,13 @@ class APIDB():
         :param course: the course
         :return: the relation
         """
-        rel = cls.model_course_trainers(id=cls.model_course_user.build_id(user, course),
-                                        member=user.key, course=course.key, is_active=True).put()
+        trainer = cls.model_course_trainers(id=cls.model_course_user.build_id(user, course), member=user.key,
+                                            course=course.key, is_active=True)
+        trainer.copy_course(course)
+        rel = cls.__counted_put(trainer)
+        # tasks imports APIDB
+        from tasks import defer, add_to_session_indexes
+        defer(add_to_session_indexes, user.key, course.key, 'trainers')
         # this isn't needed
         # # if he's owner than keep it as owner.
         # if cls.get_type_of_membership(user, course.club.get()) != "OWNER":
@@ -587,7 +725,7 @@ class APIDB():
         relation = ndb.Key(cls.model_course_trainers, cls.model_course_trainers.build_id(user.key, course.key)).get()
         if relation:
             relation.is_active = False
-            relation.put()
+            cls.__counted_put(relation)
             return True
         else:
             return False
@@ -623,6 +761,7 @@ class APIDB():
         :return: the list
         """
         kwargs['projection'] = 'member'
+        kwargs['counter'] = cls.__counter_name('subscribers', course)
         return cls.__get(course.subscribers, **kwargs)
 
     @classmethod
@@ -649,7 +788,55 @@ class APIDB():
         return cls.__get(course.trainers, **kwargs)
 
     @classmethod
-    def get_course_sessions(cls, course, date_from=None, date_to=None, session_type=None, status=None, **kwargs):
+    def get_courses_stats(cls, courses):
+        """
+        Gets the stats of a list of courses. The counts are the sharded counters of the sessions, of the finished
+        sessions and of the subscribers, read with one call to memcache (see ``counters.get_counts``), the ones that
+        are not initialized are counted with the queries, run in parallel. The trainers are loaded with a projection query for each
+        course, run in parallel, and one ``get_multi``.
+
+        :param courses: list of courses
+        :return: dict ``course.key`` -> dict with ``session_count``, ``finished_count``, ``subscriber_count``,
+            ``completeness`` and ``trainers`` (list of users)
+        """
+        names = dict((course.key, (cls.__counter_name('sessions', course),
+                                   cls.__counter_name('sessions', course, 'FINISHED'),
+                                   cls.__counter_name('subscribers', course))) for course in courses)
+        relations = dict((course.key, course.trainers.fetch_async(projection=[cls.model_course_trainers.member]))
+                         for course in courses)
+        counts = counters.get_counts([name for course_names in names.values() for name in course_names])
+        missing = dict()
+        for course in courses:
+            session_name, finished_name, subscriber_name = names[course.key]
+            if counts[session_name] is None:
+                missing[session_name] = cls.get_course_sessions(course, query_only=True).count_async()
+            if counts[finished_name] is None:
+                missing[finished_name] = cls.get_course_sessions(course, status="FINISHED",
+                                                                 query_only=True).count_async()
+            if counts[subscriber_name] is None:
+                missing[subscriber_name] = cls.get_course_subscribers(course, query_only=True).count_async()
+        # the counters that are not initialized are counted in parallel
+        ndb.Future.wait_all(missing.values())
+        for name, future in missing.iteritems():
+            counts[name] = counters.initialize(name, future.get_result())
+        trainer_keys = list(set(relation.member for future in relations.values() for relation in future.get_result()))
+        trainers = dict(zip(trainer_keys, identity_map.get_multi(trainer_keys)))
+        ret = {}
+        for course in courses:
+            session_count, finished_count, subscriber_count = [counts[name] for name in names[course.key]]
+            if session_count > 0:
+                completeness = long(finished_count) / long(session_count) * 100
+            else:
+                completeness = 0
+            course_trainers = [trainers[relation.member] for relation in relations[course.key].get_result()]
+            ret[course.key] = dict(session_count=session_count, finished_count=finished_count,
+                                   subscriber_count=subscriber_count, completeness=completeness,
+                                   trainers=[trainer for trainer in course_trainers if trainer])
+        return ret
+
+    @classmethod
+    def get_course_sessions(cls, course, date_from=None, date_to=None, session_type=None, status=None,
+                            not_status=None, **kwargs):
         """
         Gets the sessions of a course
 
@@ -658,6 +845,7 @@ class APIDB():
         :param date_to:  to filter courses which have ``start_date<= data_to`` (default = ``None``)
         :param session_type: to filter by type of the session (default = ``None``)
         :param status: to filter by status of the session (default = ``None``)
+        :param not_status: to exclude a status, used only if ``status`` is not set (default = ``None``)
         :param kwargs: usual kwargs
         :return: list of sessions
         """
@@ -669,11 +857,11 @@ class APIDB():
             sessions = sessions.filter(cls.model_session.start_date <= date_to)
         if session_type:
             sessions = sessions.filter(cls.model_session.session_type == session_type)
-        if status:
-            # https://cloud.google.com/appengine/docs/python/ndb/properties#computed
-            # computed property not calculade during query
-            raise BadParameters("Filter on status is not working")
-            # sessions = sessions.filter(cls.model_session.status == status)
+        sessions = cls.__filter_session_status(sessions, status, not_status)
+        if not (date_from or date_to or session_type or status or not_status):
+            kwargs['counter'] = cls.__counter_name('sessions', course)
+        elif status == "FINISHED" and not (date_from or date_to or session_type):
+            kwargs['counter'] = cls.__counter_name('sessions', course, status)
         # if not date_to or date_from:
         # # in case there's no inequality, then we order
         # sessions.order(GCModel.created)
@@ -684,22 +872,24 @@ class APIDB():
     @classmethod
     def get_club_courses_im_subscribed_to(cls, user, club, course_type=None, active_only=None, **kwargs):
         """
-        Gets the courses of the club that i'm subscribed to
+        Gets the courses of the club that i'm subscribed to, with a query on the fields of the course copied in
+        the subscriptions (see ``models.CourseRelation``). The courses are ordered by end date.
 
         :param user: the user
         :param club: the club
+        :param course_type: the type of the courses (optional)
+        :param active_only: only the courses that are not ended yet
         :param kwargs: usual kwargs
         :return: the list of curses
         """
-        all_courses = cls.__get(cls.model_course_user.query(cls.model_course_user.member == user.key))
-        courses = [course for course in all_courses if course.club == club.key and not course.is_deleted]
+        model = cls.model_course_user
+        query = model.query(model.member == user.key, model.club == club.key, model.is_deleted == False)
         if course_type:
-            t_courses = [course for course in courses if course.course_type == course_type]
-            courses = t_courses
+            query = query.filter(model.course_type == course_type)
         if active_only:
-            t_courses = [course for course in courses if course.end_date > datetime.datetime.now()]
-            courses = t_courses
-        return cls.__get(courses, **kwargs)
+            query = query.filter(model.course_end_date > datetime.datetime.now())
+        kwargs['projection'] = 'course'
+        return cls.__get(query.order(model.course_end_date), **kwargs)
 
     @classmethod
     def get_club_courses_im_trainer_of(cls, user, club, **kwargs):
@@ -711,9 +901,10 @@ class APIDB():
         :param kwargs: usual kwargs
         :return: the list of curses
         """
-        all_courses = cls.__get(cls.model_course_trainers.query(cls.model_course_trainers.member == user.key))
-        courses = [course for course in all_courses if course.club == club.key and not course.is_deleted]
-        return cls.__get(courses, **kwargs)
+        model = cls.model_course_trainers
+        query = model.query(model.member == user.key, model.club == club.key, model.is_deleted == False)
+        kwargs['projection'] = 'course'
+        return cls.__get(query.order(model.course_end_date), **kwargs)
 
     @classmethod
     def get_user_subscription(cls, user, course):
@@ -741,6 +932,403 @@ class APIDB():
         """
         session = cls.model_session()
         session.course = course.key
+        cls.__create(session, **cls.__session_args(args))
+        return session
+
+    @classmethod
+    def create_sessions(cls, course, list_args):
+        """
+        Creates many sessions of a course. The course time is extended once for the whole list, so the sessions
+        don't write the course, and the sessions are stored with one ``put_multi``.
+
+        .. note::
+
+            the sessions are not created in a transaction (they are in different entity groups), the counter of the
+            sessions is updated after they are stored.
+
+        :param course: the course to which the sessions are created
+        :param list_args: list of dicts containing the data of the sessions
+        :return: the list of sessions
+        """
+        sessions = []
+        for args in list_args:
+            session = cls.model_session(course=course.key)
+            session.populate(**cls.__session_args(args))
+            sessions.append(session)
+        if not sessions:
+            return sessions
+        if course.course_type == "SCHEDULED":
+            start_date = min(session.start_date for session in sessions)
+            end_date = max(session.end_date for session in sessions)
+            if not course.window_contains(start_date, end_date):
+                identity_map.remember(cls.model_course.extend_window(course.key, start_date, end_date))
+        cls.put_sessions(sessions)
+        cls.index_sessions(sessions)
+        cls.__queue_fan_out([session for session in sessions if not session.canceled])
+        return sessions
+
+    @classmethod
+    def put_sessions(cls, sessions):
+        """
+        Stores the sessions with a ``put_multi``, the sessions that are not stored with
+        :py:meth:`._APIDB__counted_put`. The put computes the status (see ``models.Session._pre_put_hook``), so a
+        session can become ``FINISHED`` while it's stored for another reason: the counters of the sessions (see
+        :py:meth:`._APIDB__counter_names`) are moved after the put by the difference.
+
+        :param sessions: list of sessions, the new ones too
+        """
+        before = [cls.__counter_names(session) if session.key else [] for session in sessions]
+        ndb.put_multi(sessions)
+        deltas = dict()
+        for names, session in zip(before, sessions):
+            for name in names:
+                deltas[name] = deltas.get(name, 0) - 1
+            for name in cls.__counter_names(session):
+                deltas[name] = deltas.get(name, 0) + 1
+        for name, delta in deltas.iteritems():
+            if delta:
+                counters.increment(name, delta)
+
+    @classmethod
+    def index_sessions(cls, sessions, max_members=100):
+        """
+        Writes the ``SessionMember`` of the sessions (see :py:meth:`.put_session_indexes`). The sessions of the
+        courses with more than ``max_members`` subscriptions take many transactions, they are written in the task
+        ``tasks.index_sessions``.
+
+        :param sessions: list of sessions
+        :param max_members: the number of subscriptions of the courses whose sessions are written in the request
+        """
+        large = dict((course, cls.__subscriptions_async(course, max_members))
+                     for course in set(session.course for session in sessions))
+        cls.put_session_indexes([session for session in sessions
+                                 if large[session.course].get_result() <= max_members])
+        deferred = [session.key for session in sessions if large[session.course].get_result() > max_members]
+        if deferred:
+            # tasks imports APIDB
+            from tasks import defer, index_sessions
+            defer(index_sessions, deferred)
+
+    @classmethod
+    def put_session_indexes(cls, sessions, batch_size=100):
+        """
+        Writes the ``SessionMember`` of the sessions: the users that have a relation with their courses are added
+        and the fields of the session are copied in all the members. The users of each course are loaded with two
+        parallel projection queries, the members that are already there with a keys only ancestor query.
+
+        The members of a session are written in transactions on the session (see
+        :py:meth:`._APIDB__put_session_members`) and the users are only added, so the relations missing from the
+        queries, which are eventually consistent, don't remove the users added by
+        :py:meth:`.add_to_session_indexes`. The sessions are written in parallel.
+
+        :param sessions: list of sessions
+        :param batch_size: the number of members written in each transaction
+        """
+        if not sessions:
+            return
+        members = dict()
+        for course in set(session.course for session in sessions):
+            members[course] = [model.query(model.course == course).fetch_async(projection=[model.member])
+                               for model in (cls.model_course_user, cls.model_course_trainers)]
+        stored = [cls.model_session_member.query(ancestor=session.key).fetch_async(keys_only=True)
+                  for session in sessions]
+
+        @ndb.tasklet
+        def put_members(session, keys, subscribers, trainers):
+            # the transactions of a session one after the other, they are in the same entity group
+            for i in range(0, len(keys), batch_size):
+                yield cls.__put_session_members(session, keys[i:i + batch_size], subscribers, trainers)
+
+        puts = []
+        for session, stored_keys in zip(sessions, stored):
+            subscribers, trainers = [set(relation.member for relation in future.get_result())
+                                     for future in members[session.course]]
+            keys = set(stored_keys.get_result())
+            keys.update(cls.model_session_member.build_key(user, session) for user in subscribers | trainers)
+            puts.append(put_members(session, list(keys), subscribers, trainers))
+        ndb.Future.wait_all(puts)
+        for put in puts:
+            put.check_success()
+
+    @classmethod
+    def __put_session_members(cls, session, keys, subscribers=frozenset(), trainers=frozenset()):
+        """
+        Writes some ``SessionMember`` of a session in a transaction: the missing ones are created, the users are
+        added as subscribers or trainers and the fields of the session are copied. Only the members that changed
+        are stored.
+
+        :param session: the session
+        :param keys: the keys of the members, all children of the session
+        :param subscribers: set of the keys of the users that are subscribed to the course
+        :param trainers: set of the keys of the users that are trainers of the course
+        :return: the future of the transaction
+        """
+
+        @ndb.tasklet
+        def txn():
+            stored = yield ndb.get_multi_async(keys)
+            changed = []
+            for key, member in zip(keys, stored):
+                if member is None:
+                    member = cls.model_session_member(key=key, member=ndb.Key(cls.model_user, key.id()))
+                updated = member.copy_session(session)
+                if member.member in subscribers and not member.subscriber:
+                    member.subscriber = updated = True
+                if member.member in trainers and not member.trainer:
+                    member.trainer = updated = True
+                if updated:
+                    changed.append(member)
+            if changed:
+                yield ndb.put_multi_async(changed)
+
+        return ndb.transaction_async(txn)
+
+    @classmethod
+    def fan_out_to_timelines(cls, sessions):
+        """
+        Writes the sessions in the ``Timeline`` of the subscribers of their courses, the canceled sessions and the
+        ones of the deleted courses are removed. The timelines that don't exist are skipped, they are built when
+        they are read (see :py:meth:`.get_timeline`). The subscribers of each course are loaded with a projection
+        query.
+
+        It runs in the task ``tasks.fan_out_sessions``, queued when the sessions are created and when they change
+        in the fields of the timelines (see ``models.TimelineStub.changed``).
+
+        :param sessions: list of sessions
+        """
+        course_keys = list(set(session.course for session in sessions))
+        model = cls.model_course_user
+        relations = [model.query(model.course == course).fetch_async(projection=[model.member])
+                     for course in course_keys]
+        subscribers = dict((course, [relation.member for relation in future.get_result()])
+                           for course, future in zip(course_keys, relations))
+        courses = dict((course.key, course) for course in identity_map.get_multi(course_keys))
+        changes = dict()
+        for session in sessions:
+            course = courses[session.course]
+            for user in subscribers[session.course]:
+                changes.setdefault(cls.model_timeline.build_key(user, course.club), []).append(session)
+
+        def update(timeline, changed):
+            for session in changed:
+                old = timeline.find(session)
+                if session.canceled or session.club is None:
+                    timeline.remove(session)
+                    continue
+                stub = cls.model_timeline_stub.of_session(session)
+                if old is not None:
+                    stub.populate(participated=old.participated, participation_count=old.participation_count,
+                                  max_score=old.max_score)
+                timeline.add(stub)
+            return True
+
+        cls.__update_timelines(changes, update)
+
+    @classmethod
+    def __queue_fan_out(cls, sessions, transactional=False):
+        """
+        Queues the task that writes the sessions in the timelines (see :py:meth:`.fan_out_to_timelines`).
+
+        :param sessions: list of sessions
+        :param transactional: if the task is queued only when the current transaction commits
+        """
+        if not sessions:
+            return
+        # tasks imports APIDB
+        from tasks import defer, fan_out_sessions
+        defer(fan_out_sessions, [session.key for session in sessions], _transactional=transactional)
+
+    @classmethod
+    def __update_timelines(cls, changes, update, batch_size=50):
+        """
+        Updates the ``Timeline``, each one in its transaction. The transactions of a batch run in parallel.
+
+        :param changes: dict timeline key -> value passed to ``update``
+        :param update: function ``(timeline, value)``, it changes the timeline and returns ``True`` if it has to be
+            stored. It's not called for the timelines that don't exist
+        :param batch_size: the number of timelines updated in parallel
+        """
+
+        @ndb.tasklet
+        def txn(key, value):
+            timeline = yield key.get_async()
+            if timeline is not None and update(timeline, value):
+                yield timeline.put_async()
+
+        items = changes.items()
+        for i in range(0, len(items), batch_size):
+            futures = [ndb.transaction_async(lambda key=key, value=value: txn(key, value))
+                       for key, value in items[i:i + batch_size]]
+            ndb.Future.wait_all(futures)
+            for future in futures:
+                future.check_success()
+
+    @classmethod
+    def __timeline_stubs(cls, user, sessions):
+        """
+        Creates the ``TimelineStub`` of the sessions for the user, the participations are loaded in batch.
+
+        :param user: the user
+        :param sessions: list of sessions
+        :return: list of stubs
+        """
+        participations = cls.get_user_sessions_participations(user, sessions)
+        return [cls.model_timeline_stub.of_session(session, participations[session.key]) for session in sessions]
+
+    @classmethod
+    def add_course_to_timeline(cls, user, course):
+        """
+        Adds the sessions of the course to the ``Timeline`` of the user, when the user subscribes to it. It runs in
+        the task ``tasks.add_course_to_timeline``.
+
+        :param user: the user
+        :param course: the course
+        """
+        key = cls.model_timeline.build_key(user, course.club)
+        if key.get() is None:
+            # it's built with the course when it's read
+            return
+        sessions = cls.model_session.query(cls.model_session.course == course.key,
+                                           cls.model_session.canceled == False).fetch()
+        stubs = cls.__timeline_stubs(user, [session for session in sessions if session.club is not None])
+
+        def update(timeline, stubs):
+            for stub in stubs:
+                timeline.add(stub)
+            return bool(stubs)
+
+        cls.__update_timelines({key: stubs}, update)
+
+    @classmethod
+    def __update_timeline_participation(cls, user, session):
+        """
+        Copies the participation of the user in the ``Timeline``, after an upload.
+
+        :param user: the user
+        :param session: the session
+        """
+        if session.club is None:
+            return
+        participation = cls.get_user_sessions_participations(user, [session])[session.key]
+
+        def update(timeline, participation):
+            stub = timeline.find(session)
+            if stub is not None:
+                stub.set_participation(participation)
+            return stub is not None
+
+        cls.__update_timelines({cls.model_timeline.build_key(user, session.club): participation}, update)
+
+    @classmethod
+    def get_timeline(cls, user, club):
+        """
+        Gets the ``Timeline`` of the user in the club. If it doesn't exist it's built from the last sessions of
+        :py:meth:`.get_sessions_im_subscribed`.
+
+        :param user: the user
+        :param club: the club
+        :return: the timeline
+        """
+        key = cls.model_timeline.build_key(user, club)
+        timeline = key.get()
+        if timeline is not None:
+            return timeline
+        query = cls.__user_sessions_query(user, 'subscriber', club)
+        # the last ones, one more to know if the timeline is truncated
+        member_keys = cls.__reverse_query(query).fetch(models.TIMELINE_SIZE + 1)
+        sessions = [session for session in ndb.get_multi([member.parent() for member in member_keys]) if session]
+        timeline = cls.model_timeline(key=key)
+        for stub in cls.__timeline_stubs(user, sessions):
+            timeline.add(stub)
+
+        @ndb.transactional
+        def insert():
+            # a concurrent request may have built it
+            stored = key.get()
+            if stored is not None:
+                return stored
+            timeline.put()
+            return timeline
+
+        return insert()
+
+    @classmethod
+    def get_timeline_sessions(cls, user, club, date_from=None, date_to=None, session_type=None, **kwargs):
+        """
+        Gets the sessions the user is subscribed to within a club from the ``Timeline`` of the user, as
+        ``TimelineStub``. If the timeline doesn't have the older sessions that are requested it uses
+        :py:meth:`.get_sessions_im_subscribed`.
+
+        :param user: the user
+        :param club: the club
+        :param date_from: to filter sessions which have ``start_date >= data_from`` (default = ``None``)
+        :param date_to:  to filter sessions which have ``start_date <= data_from`` (default = ``None``)
+        :param session_type:  to filter sessions on type  (default = ``None``)
+        :param kwargs: usual kwargs
+        :return: list of stubs
+        """
+        timeline = cls.get_timeline(user, club)
+        if timeline.covers(date_from):
+            return cls.__get(timeline.select(date_from, date_to, session_type), **kwargs)
+        result = cls.get_sessions_im_subscribed(user, club, date_from, date_to, session_type, **kwargs)
+        if isinstance(result, tuple):
+            return (cls.__timeline_stubs(user, result[0]),) + result[1:]
+        return cls.__timeline_stubs(user, result)
+
+    @classmethod
+    def add_to_session_indexes(cls, course, user, field, batch_size=50):
+        """
+        Adds the user to the ``SessionMember`` of the sessions of the course, each session in its transaction (see
+        :py:meth:`._APIDB__put_session_members`). The transactions of a batch run in parallel. It runs in the task
+        ``tasks.add_to_session_indexes``, queued when the user subscribes to the course or becomes a trainer of it;
+        a user already there is not written again.
+
+        :param course: the course
+        :param user: the user
+        :param field: ``subscribers`` or ``trainers``
+        :param batch_size: the number of sessions written in parallel
+        """
+        query = cls.model_session.query(cls.model_session.course == course.key)
+        sessions, cursor, more = query.fetch_page(batch_size)
+        while sessions:
+            futures = [cls.__put_session_members(session, [cls.model_session_member.build_key(user, session)],
+                                                 **{field: frozenset([user.key])}) for session in sessions]
+            ndb.Future.wait_all(futures)
+            for future in futures:
+                future.check_success()
+            if not more:
+                break
+            sessions, cursor, more = query.fetch_page(batch_size, start_cursor=cursor)
+
+    @classmethod
+    def detach_course_sessions(cls, course, batch_size=100):
+        """
+        Removes the sessions of a deleted course from the lists of the club, the put sets ``club`` to ``None``. It
+        runs in the task ``tasks.detach_course_sessions``, queued when the course is deleted; the sessions already
+        detached are not read again.
+
+        :param course: the course
+        :param batch_size: the number of sessions stored with each ``put_multi``
+        """
+        query = cls.model_session.query(cls.model_session.course == course.key,
+                                        cls.model_session.club == course.club)
+        sessions, cursor, more = query.fetch_page(batch_size)
+        while sessions:
+            cls.put_sessions(sessions)
+            cls.put_session_indexes(sessions)
+            cls.__queue_fan_out(sessions)
+            if not more:
+                break
+            sessions, cursor, more = query.fetch_page(batch_size, start_cursor=cursor)
+
+    @staticmethod
+    def __session_args(args):
+        """
+        Converts the data of a session from the format of the api.
+
+        :param args: dict containing the data of the session
+        :return: the dict for ``populate``
+        """
         if "start_date" in args:
             args['start_date'] = date_from_js_timestamp(args['start_date'])
         if "end_date" in args:
@@ -754,8 +1342,7 @@ class APIDB():
         if "on_after" in args:
             on_after = args.pop("on_after")
             args['on_after'] = [Key(urlsafe=i) for i in on_after]
-        cls.__create(session, **args)
-        return session
+        return args
 
     @classmethod
     def update_session(cls, session, **args):
@@ -781,7 +1368,7 @@ class APIDB():
         :param session: the session to delete
         :return: Tuple -> Bool, Object
         """
-        session.safe_delete()
+        cls.__counted_put(session, session.safe_delete)
         return True, session
 
     @classmethod
@@ -805,7 +1392,8 @@ class APIDB():
         """
         if exercise.key not in session.list_exercises:
             session.list_exercises.append(exercise.key)
-            session.put()
+            # the put can change the status
+            cls.__counted_put(session)
             return True
         else:
             return False
@@ -821,7 +1409,8 @@ class APIDB():
         """
         if exercise.key in session.list_exercises:
             session.list_exercises.remove(exercise.key)
-            session.put()
+            # the put can change the status
+            cls.__counted_put(session)
             return True
         else:
             return False
@@ -870,6 +1459,50 @@ class APIDB():
         else:
             return 0
 
+    @classmethod
+    def get_user_sessions_participations(cls, user, sessions):
+        """
+        Batch version of :py:meth:`.user_participated_in_session`, :py:meth:`.user_participation_details` with
+        ``count_only`` and :py:meth:`.session_completeness` for a page of sessions: the participations of the user
+        are loaded with one query.
+
+        :param user: the user
+        :param sessions: list of sessions
+        :return: dict ``session.key`` -> dict with ``participated``, ``participation_count`` and ``max_completeness``
+        """
+        ret = dict((session.key, dict(participated=False, participation_count=0, max_completeness=0))
+                   for session in sessions)
+        keys = []
+        # sessions of courses without max_level, the keys can't be built
+        session_keys = []
+        course_keys = list(set(session.course for session in sessions))
+        subscriptions = ndb.get_multi([ndb.Key(cls.model_course_user, cls.model_course_user.build_id(user, course))
+                                       for course in course_keys])
+        user_levels = dict((course, subscription.profile_level)
+                           for course, subscription in zip(course_keys, subscriptions) if subscription)
+        for session in sessions:
+            session_participations = cls.model_participation.keys_of_session(user, session,
+                                                                             user_levels.get(session.course))
+            if session_participations is None:
+                session_keys.append(session.key)
+            else:
+                keys += session_participations
+        participations = ndb.get_multi(keys)
+        # the IN has a limit on the number of values
+        for i in range(0, len(session_keys), 30):
+            query = cls.model_participation.query(cls.model_participation.user == user.key,
+                                                  cls.model_participation.session.IN(session_keys[i:i + 30]))
+            participations += query.order(cls.model_participation._key).fetch()
+        for participation in participations:
+            if participation is None:
+                continue
+            values = ret[participation.session]
+            # as get_by_data, the first participation of the session is used
+            if not values['participated']:
+                values.update(participated=True, participation_count=participation.participation_count,
+                              max_completeness=participation.max_completeness)
+        return ret
+
 
     @classmethod
     def get_session_user_activities(cls, session, user, **kwargs):
@@ -932,7 +1565,8 @@ class APIDB():
     @classmethod
     def get_sessions_im_subscribed(cls, user, club, date_from=None, date_to=None, session_type=None, **kwargs):
         """
-        Gets the sessions the user is subscribed to within a club
+        Gets the sessions the user is subscribed to within a club, with a keys only query on the ``SessionMember``
+        ordered by start date.
 
         :param user: the user
         :param club: the club
@@ -942,26 +1576,14 @@ class APIDB():
         :param kwargs: usual kwargs
         :return: list of sessions
         """
-        courses = cls.get_club_courses(club, keys_only=True)
-        subscription_keys = [ndb.Key(cls.model_course_user, cls.model_course_user.build_id(user, course))
-                             for course in courses]
-        real_list = [s.course for s in ndb.get_multi(subscription_keys) if s is not None]
-        if not real_list:
-            return cls.__get([], **kwargs)
-        sessions = cls.get_sessions(query_only=True)
-        sessions = sessions.filter(cls.model_session.course.IN(real_list))
-        if date_from:
-            sessions = sessions.filter(cls.model_session.start_date >= date_from)
-        if date_to:
-            sessions = sessions.filter(cls.model_session.start_date <= date_to)
-        if session_type:
-            sessions = sessions.filter(cls.model_session.session_type == session_type)
-        return cls.__get(sessions, **kwargs)
+        query = cls.__user_sessions_query(user, 'subscriber', club, date_from, date_to, session_type)
+        kwargs['projection'] = 'parent'
+        return cls.__get(query, **kwargs)
 
     @classmethod
     def get_session_im_trainer_of(cls, user, club, date_from=None, date_to=None, session_type=None, **kwargs):
         """
-        Gest the session within a club the user is trainer off
+        Gest the session within a club the user is trainer off, see :py:meth:`.get_sessions_im_subscribed`
 
         :param user: the user
         :param club: the club
@@ -971,23 +1593,33 @@ class APIDB():
         :param kwargs: usual kwargs
         :return: list of sessions
         """
+        query = cls.__user_sessions_query(user, 'trainer', club, date_from, date_to, session_type)
+        kwargs['projection'] = 'parent'
+        return cls.__get(query, **kwargs)
 
-        courses = cls.get_club_courses(club, keys_only=True)
-        subscription_keys = [ndb.Key(cls.model_course_trainers, cls.model_course_trainers.build_id(user, course))
-                             for course in courses]
-        real_list = [s.course for s in ndb.get_multi(subscription_keys) if s is not None]
-        if not real_list:
-            # this is to return the empty list and extra stuff that the dev may have required
-            return cls.__get([], **kwargs)
-        sessions = cls.get_sessions(query_only=True)
-        sessions = sessions.filter(cls.model_session.course.IN(real_list))
+    @classmethod
+    def __user_sessions_query(cls, user, role, club, date_from=None, date_to=None, session_type=None):
+        """
+        Builds the keys only query on the ``SessionMember`` of the sessions of a user in a club.
+
+        :param user: the user
+        :param role: ``subscriber`` or ``trainer``
+        :param club: the club
+        :param date_from: to filter sessions which have ``start_date >= data_from`` (default = ``None``)
+        :param date_to:  to filter sessions which have ``start_date <= data_from`` (default = ``None``)
+        :param session_type:  to filter sessions on type  (default = ``None``)
+        :return: the query
+        """
+        model = cls.model_session_member
+        query = model.query(model.member == user.key, getattr(model, role) == True, model.club == club.key,
+                            model.canceled == False, default_options=ndb.QueryOptions(keys_only=True))
         if date_from:
-            sessions = sessions.filter(cls.model_session.start_date >= date_from)
+            query = query.filter(model.start_date >= date_from)
         if date_to:
-            sessions = sessions.filter(cls.model_session.start_date <= date_to)
+            query = query.filter(model.start_date <= date_to)
         if session_type:
-            sessions = sessions.filter(cls.model_session.session_type == session_type)
-        return cls.__get(sessions, **kwargs)
+            query = query.filter(model.session_type == session_type)
+        return query.order(model.start_date)
 
     @classmethod
     def get_club_sessions(cls, club, date_from=None, date_to=None, session_type=None, status=None, not_status=None,
@@ -1003,21 +1635,63 @@ class APIDB():
         :param kwargs: usual kwargs
         :return:
         """
-        # get the session of all the courses
-        courses = cls.get_club_courses(club, keys_only=True)
-        logging.debug("Courses : %s", len(courses))
-        query = cls.model_session.query(cls.model_session.course.IN(courses))
+        # the sessions of the deleted courses have no club
+        query = cls.model_session.query(cls.model_session.club == club.key)
         if date_from:
             query = query.filter(cls.model_session.start_date >= date_from)
         if date_to:
             query = query.filter(cls.model_session.start_date <= date_to)
         if session_type:
             query = query.filter(cls.model_session.session_type == session_type)
+        query = cls.__filter_session_status(query, status, not_status)
+        return cls.__get(query.order(cls.model_session.start_date), **kwargs)
+
+    @classmethod
+    def __filter_session_status(cls, query, status=None, not_status=None):
+        """
+        Adds the filter on the status of the sessions.
+
+        ``not_status`` is an ``IN`` on the other values and not a ``!=``, so the query can be ordered by date.
+
+        :param query: the query
+        :param status: the status (default = ``None``)
+        :param not_status: the status to exclude, used only if ``status`` is not set (default = ``None``)
+        :return: the query
+        """
+        statuses = cls.model_session.status._choices
         if status:
-            query = query.filter(cls.model_session.status == status)
-        elif not_status:
-            query = query.filter(cls.model_session.status != not_status)
-        return cls.__get(query, **kwargs)
+            if status not in statuses:
+                raise BadParameters("status")
+            return query.filter(cls.model_session.status == status)
+        if not_status:
+            return query.filter(cls.model_session.status.IN([s for s in statuses if s != not_status]))
+        return query
+
+    @classmethod
+    def update_sessions_status(cls, batch_size=100):
+        """
+        Moves the sessions whose time has come from ``UPCOMING`` to ``ONGOING`` and from ``ONGOING`` to
+        ``FINISHED``. Called by the cron job, the new status is computed by the ``put``.
+
+        :param batch_size: the number of sessions stored with each ``put_multi``
+        :return: the number of sessions updated
+        """
+        now = datetime.datetime.now()
+        queries = [cls.model_session.query(cls.model_session.status == "UPCOMING",
+                                           cls.model_session.start_date <= now),
+                   cls.model_session.query(cls.model_session.status == "ONGOING",
+                                           cls.model_session.end_date < now)]
+        total = 0
+        for query in queries:
+            cursor = None
+            more = True
+            while more:
+                sessions, cursor, more = query.fetch_page(batch_size, start_cursor=cursor)
+                # the put computes the new status and moves the counters, if the index is behind and the entity is
+                # already finished nothing changes
+                cls.put_sessions(sessions)
+                total += len(sessions)
+        return total
 
     # [END] Session
 
@@ -1111,17 +1785,19 @@ class APIDB():
         return cls.__get(exercise.levels, **kwargs)
 
     @classmethod
-    def get_user_level_for_activity(cls, user, activity, session):
+    def get_user_level_for_activity(cls, user, activity, session, user_level_assigned=None):
         """
         Gets the user level for an activity
 
         :param user: the user
         :param activity: the activity
         :param session: the session of the activity
+        :param user_level_assigned: the level of the user in the course, if already known (default = ``None``)
         :return: the level
         """
         session_profile = session.profile
-        user_level_assigned = APIDB.get_course_subscription(session.course, user).profile_level
+        if user_level_assigned is None:
+            user_level_assigned = APIDB.get_course_subscription(session.course, user).profile_level
         # if there is no profile then return just the user level
         if not session_profile:
             # loop and search for the activity_level
@@ -1173,7 +1849,7 @@ class APIDB():
                 return cls.__get(cls.model_participation.query(cls.model_participation.session == session.key,
                                                                projection=[cls.model_participation.user],
                                                                group_by=[cls.model_participation.user]),
-                                 count_only=True)
+                                 count_only=True, counter=cls.__counter_name('participants', session))
         return cls.__get(cls.model_participation.query(cls.model_participation.session == session.key), **kwargs)
 
 
@@ -1204,13 +1880,50 @@ class APIDB():
         """
 
         level = cls.get_user_subscription(user, session.course).profile_level
-        participation = cls.get_participation(user, session, level)
-        if not participation:
-            participation = cls.model_participation()
-            participation.session = session.key
-            participation.user = user.key
-            participation.level = level
-        # NOTE: we should set a limit, otherwise this may grow too much.
+        key = cls.model_participation.build_key(user, session, level)
+        # the count of the participants is on the users, not on the participations (one for each level): the
+        # participations of the user at all the levels are read in the transaction, if they fit in its entity groups
+        keys = cls.model_participation.keys_of_session(user, session, level)
+        if keys is None or len(keys) + 1 > 25:
+            keys = [key]
+            participated = cls.user_participated_in_session(user, session)
+        else:
+            participated = False
+
+        # the key is the same for concurrent uploads, the transaction serializes them
+        @ndb.transactional(xg=True)
+        def txn():
+            stored = ndb.get_multi(keys)
+            participation = stored[keys.index(key)]
+            first = not participated and not any(stored)
+            created = participation is None
+            if created:
+                participation = cls.model_participation(key=key)
+                participation.session = session.key
+                participation.user = user.key
+                participation.level = level
+            cls.__add_to_participation(participation, completeness, join_time, leave_time, indicators)
+            if first and created:
+                counters.increment(cls.__counter_name('participants', session))
+            return participation
+
+        participation = txn()
+        cls.__update_timeline_participation(user, session)
+        return participation
+
+    @classmethod
+    def __add_to_participation(cls, participation, completeness, join_time, leave_time, indicators):
+        """
+        Adds the data of an upload to the participation and stores it, together with the old attempts moved out of
+        it (see :py:meth:`models.AttemptHistory.compact_history`)
+
+        :param participation: the participation
+        :param completeness: the completeness value
+        :param join_time: when user joined
+        :param leave_time: when he left
+        :param indicators: list of indicators (id, value)
+        :return: the participation
+        """
         # this is the rest that is updated
         participation.completeness.append(completeness)
         time_data = cls.model_time_data()
@@ -1218,9 +1931,125 @@ class APIDB():
         time_data.set_js('leave', leave_time)
         participation.time.append(time_data)
         participation.add_indicators([dict(id=indicator['id'], value=indicator['value']) for indicator in indicators])
-        participation.put()
+        ndb.put_multi([participation] + participation.compact_history())
+        return participation
+
+    @classmethod
+    def create_session_performances(cls, user, session, completeness, join_time, leave_time, indicators,
+                                    performances, transactional=True):
+        """
+        Stores the upload of a session: the participation and all the performances. It's the bulk version of
+        :py:meth:`.create_participation` and :py:meth:`.create_performance`: the upload is validated before
+        writing, the exercises and the stored entities are loaded with one ``get_multi`` each and everything is
+        written with one ``put_multi``.
+
+        :param user: the user
+        :param session: the session
+        :param completeness: the completeness value of the session
+        :param join_time: when user joined
+        :param leave_time: when he left
+        :param indicators: list of indicators (id, value) of the session
+        :param performances: list of dicts with ``activity_id``, ``completeness``, ``record_date`` and ``indicators``
+        :param transactional: if the write is done in a transaction, it's possible only if the entities are
+            less than 25 (the limit of the entity groups), otherwise the write is not transactional
+        :return: the participation
+        """
+        for performance in performances:
+            for prop in ('activity_id', 'completeness', 'record_date', 'indicators'):
+                if performance.get(prop) is None:
+                    raise BadParameters("Performance: %s is missing" % prop)
+        try:
+            activity_keys = [Key(urlsafe=performance['activity_id']) for performance in performances]
+            record_dates = [datetime.datetime.fromtimestamp(long(performance['record_date']) / 1000)
+                            for performance in performances]
+        except Exception:
+            raise BadParameters("Performance: activity_id and record_date must be valid")
+        activities = identity_map.get_multi(activity_keys)
+        if None in activities:
+            raise BadParameters("Performance: activity not found")
+        user_level = cls.get_user_subscription(user, session.course).profile_level
+        levels = [cls.get_user_level_for_activity(user, activity, session, user_level).level_number
+                  for activity in activities]
+        participation_key = cls.model_participation.build_key(user, session, user_level)
+        performance_keys = [cls.model_performance.build_key(participation_key, activity, level)
+                            for activity, level in zip(activities, levels)]
+        # the count of the participants is on the users, not on the participations (one for each level): the
+        # participations of the user at all the levels are read in the write, as in create_participation
+        participation_keys = cls.model_participation.keys_of_session(user, session, user_level)
+        if participation_keys is None:
+            participation_keys = [participation_key]
+            participated = cls.user_participated_in_session(user, session)
+        else:
+            participated = False
+
+        def write():
+            stored = ndb.get_multi(participation_keys + performance_keys)
+            participations = stored[:len(participation_keys)]
+            participation = participations[participation_keys.index(participation_key)]
+            first = not participated and not any(participations)
+            created = participation is None
+            if created:
+                participation = cls.model_participation(key=participation_key, session=session.key, user=user.key,
+                                                        level=user_level)
+            participation.completeness.append(completeness)
+            time_data = cls.model_time_data()
+            time_data.set_js('join', join_time)
+            time_data.set_js('leave', leave_time)
+            participation.time.append(time_data)
+            participation.add_indicators([dict(id=indicator['id'], value=indicator['value'])
+                                          for indicator in indicators])
+            # the same activity may be more than once in the upload
+            entities = dict()
+            for key, performance, activity, level, record_date, data in zip(performance_keys,
+                                                                             stored[len(participation_keys):],
+                                                                             activities, levels, record_dates,
+                                                                             performances):
+                performance = entities.get(key) or performance
+                if performance is None:
+                    performance = cls.model_performance(key=key, participation=participation_key,
+                                                        activity=activity.key, level=level)
+                performance.completeness.append(data['completeness'])
+                performance.record_date.append(record_date)
+                performance.add_indicators([dict(id=indicator['id'], value=indicator['value'])
+                                            for indicator in data['indicators']])
+                entities[key] = performance
+            # the old attempts are in the entity group of their participation or performance
+            attempts = participation.compact_history()
+            for performance in entities.values():
+                attempts += performance.compact_history()
+            ndb.put_multi([participation] + entities.values() + attempts)
+            if first and created:
+                counters.increment(cls.__counter_name('participants', session))
+            return participation
+
+        # participations, performances and the shard of the counter
+        if transactional and len(participation_keys) + len(set(performance_keys)) + 1 <= 25:
+            participation = ndb.transaction(write, xg=True)
+        else:
+            participation = write()
+        cls.__update_timeline_participation(user, session)
         return participation
 
+    @classmethod
+    def get_attempts_history(cls, entities):
+        """
+        Gets participations or performances with all their attempts, also the ones moved to
+        ``ParticipationAttempt``. The entities that have all the attempts inline are returned as they are, the
+        others are loaded with one async ancestor query each.
+
+        .. note::
+
+            the returned copies are read-only, they can't be stored.
+
+        :param entities: list of ``Participation`` or ``Performance``
+        :return: list of entities with the whole history
+        """
+        attempt = cls.model_participation_attempt
+        futures = [attempt.query(ancestor=entity.key).order(attempt.number).fetch_async()
+                   if entity.spilled_count else None for entity in entities]
+        return [entity.with_history(future.get_result()) if future else entity
+                for entity, future in zip(entities, futures)]
+
     @classmethod
     def get_performances_from_participation(cls, participation):
         """
@@ -1241,9 +2070,7 @@ class APIDB():
         :param level: the level
         :return: list of performances
         """
-        return cls.model_performance.query(cls.model_performance.participation == participation.key,
-                                           cls.model_performance.activity == activity.key,
-                                           cls.model_performance.level == level.level_number).get()
+        return cls.model_performance.build_key(participation, activity, level.level_number).get()
 
     @classmethod
     def create_performance(cls, participation, activity, completeness, record_date, indicators):
@@ -1262,18 +2089,25 @@ class APIDB():
         else:
             activity_id = activity.id
         activity = cls.model_exercise.get_by_id(activity_id)
-        level = cls.get_user_level_for_activity(participation.user, activity, participation.session.get())
-        performance = cls.get_performance(participation, activity, level)
-        if not performance:
-            performance = cls.model_performance()
-            performance.participation = participation.key
-            performance.level = level.level_number
-            performance.activity = activity.key
-        performance.completeness.append(completeness)
-        performance.record_date.append(datetime.datetime.fromtimestamp(long(record_date) / 1000))
-        performance.add_indicators([dict(id=indicator['id'], value=indicator['value']) for indicator in indicators])
-        performance.put()
-        return performance
+        level = cls.get_user_level_for_activity(participation.user, activity, identity_map.get(participation.session))
+        key = cls.model_performance.build_key(participation, activity, level.level_number)
+
+        @ndb.transactional
+        def txn():
+            performance = key.get()
+            if not performance:
+                performance = cls.model_performance(key=key)
+                performance.participation = participation.key
+                performance.level = level.level_number
+                performance.activity = activity.key
+            performance.completeness.append(completeness)
+            performance.record_date.append(datetime.datetime.fromtimestamp(long(record_date) / 1000))
+            performance.add_indicators([dict(id=indicator['id'], value=indicator['value'])
+                                        for indicator in indicators])
+            ndb.put_multi([performance] + performance.compact_history())
+            return performance
+
+        return txn()
 
     # [END] Performances
 
@@ -1402,13 +2236,13 @@ class APIDB():
         """
         if hasattr(obj, 'is_active'):
             obj.is_active = False
-            obj.put()
+            cls.__counted_put(obj)
             return True
         else:
             return False
 
-    @staticmethod
-    def __create(model, **args):
+    @classmethod
+    def __create(cls, model, **args):
         """
         Function to create a model and populate it
 
@@ -1425,7 +2259,7 @@ class APIDB():
             if key in not_allowed:
                 raise BadParameters(key)
         model.populate(**args)
-        model.put()
+        cls.__counted_put(model)
         return model
 
     @classmethod
@@ -1462,13 +2296,120 @@ class APIDB():
                     setattr(model, key, value)
                 except:
                     raise ServerError("Strange, this is an expando model and the exception should never occour")
-        model.put()
+        cls.__counted_put(model)
         return True, model
 
 
+    @staticmethod
+    def __counter_name(*parts):
+        """
+        Builds the name of a counter (see ``counters.py``) from the shape of the query.
+
+        :param parts: strings or objects (the id of the key is used)
+        :return: the name
+        """
+        values = []
+        for part in parts:
+            if isinstance(part, GCModel):
+                part = part.key
+            if isinstance(part, Key):
+                part = part.id()
+            values.append(str(part))
+        return "|".join(values)
+
+    @classmethod
+    def __counter_names(cls, entity):
+        """
+        Gets the counters that the entity is part of, the same used in the ``get_`` functions.
+
+        .. note::
+
+            the participants are counted by user, so they are incremented in ``create_participation``
+
+        :param entity: the entity (can be ``None``)
+        :return: list of names
+        """
+        if entity is None:
+            return []
+        if isinstance(entity, cls.model_club_user):
+            if not entity.is_active:
+                return []
+            return [cls.__counter_name('members', entity.club, entity.membership_type, entity.status),
+                    cls.__counter_name('members', entity.club, 'ALL', entity.status)]
+        if isinstance(entity, cls.model_course):
+            if entity.is_deleted:
+                return []
+            return [cls.__counter_name('courses', entity.club, 'ALL'),
+                    cls.__counter_name('courses', entity.club, entity.course_type)]
+        if isinstance(entity, cls.model_course_user):
+            if not entity.is_active or entity.status != "ACCEPTED":
+                return []
+            return [cls.__counter_name('subscribers', entity.course)]
+        if isinstance(entity, cls.model_session):
+            if entity.canceled:
+                return []
+            if entity.status == "FINISHED":
+                return [cls.__counter_name('sessions', entity.course),
+                        cls.__counter_name('sessions', entity.course, 'FINISHED')]
+            return [cls.__counter_name('sessions', entity.course)]
+        return []
+
+    @classmethod
+    def __counted_put(cls, entity, put=None):
+        """
+        Puts the entity and updates the counters it belongs to (see :py:meth:`._APIDB__counter_names`) in the same
+        transaction. When a session changes in the fields of the timelines the fan-out task is queued in the
+        transaction too (see :py:meth:`._APIDB__queue_fan_out`), when it changes in the fields of its
+        ``SessionMember`` they are written after it (see :py:meth:`.index_sessions`).
+
+        :param entity: the entity
+        :param put: the function that stores the entity (default ``entity.put``), e.g. ``safe_delete``
+        :return: the key of the entity
+        """
+        if put is None:
+            put = entity.put
+        if not isinstance(entity, (cls.model_club_user, cls.model_course, cls.model_course_user, cls.model_session,
+                                   cls.model_course_trainers)):
+            put()
+            identity_map.remember(entity)
+            return entity.key
+
+        @ndb.transactional(xg=True)
+        def txn():
+            # the transaction has its own cache, so this is what is stored.
+            old = entity.key.get() if entity.key else None
+            put()
+            counters.update(cls.__counter_names(old), cls.__counter_names(entity))
+            if isinstance(entity, cls.model_session) and cls.model_timeline_stub.changed(old, entity):
+                cls.__queue_fan_out([entity], transactional=True)
+            return isinstance(entity, cls.model_session) and cls.model_session_member.changed(old, entity)
+
+        index = txn()
+        identity_map.remember(entity)
+        role_cache.invalidate(entity)
+        if index:
+            cls.index_sessions([entity])
+        return entity.key
+
+    @classmethod
+    def __count(cls, o, counter=None):
+        """
+        Counts the elements of the query, using the counter if there's one.
+
+        :param o: the query
+        :param counter: the name of the counter
+        :return: the number of elements
+        """
+        if not counter:
+            return o.count()
+        value = counters.get_count(counter)
+        if value is None:
+            value = counters.initialize(counter, o.count())
+        return value
+
     @classmethod
     def __get(cls, o, size=-1, paginated=False, page=0, count_only=False, keys_only=False, query_only=False,
-              **kwargs):  # pragma: no cover
+              cursor=None, counter=None, **kwargs):  # pragma: no cover
         """
         Implements the get of the query or of a list of objects.
 
@@ -1485,6 +2426,8 @@ class APIDB():
             cls.__get(o, paginated=True)
             # can also specify size (of the page) and page(starting point)
             cls.__get(o, paginated=True,size=5,page=1)
+            # cursor pagination, '' is the first page, then pass the 'next' or 'prev' token received
+            cls.__get(o, paginated=True,size=5,cursor='')
             # can get just the keys if needed
             cls.__get(o, paginated=True,size=5,page=1,key_only = True)
             # or the query object
@@ -1500,6 +2443,9 @@ class APIDB():
 
         ** the function uses the `order(GCModel.created)` to keep the objects ordered as of the creation **
 
+        When only the ``projection`` field of the relations is needed they are loaded with a projection query
+        (see :py:meth:`._APIDB__projected`).
+
         :param o: the object
         :param paginated: if the result has to be paginated
         :param size: the size of the page or of the number of elements to retreive
@@ -1507,6 +2453,8 @@ class APIDB():
         :param count_only: if true, returns the count
         :param keys_only: if true, returns the keys only.
         :param query_only: if true returns the query object.
+        :param cursor: if not ``None`` the pagination uses cursors (see :py:meth:`._APIDB__get_page`).
+        :param counter: the name of the counter that has the count of the query (see ``counters.py``)
         :param kwargs: remaining args that are generally used for the relationship, thus they can be 'projection' and
         'merge'
 
@@ -1515,6 +2463,8 @@ class APIDB():
             - the query (if ``query_only = True``)
             - a list of objects (if ``paginated = False``)
             - a list of objects and the total number of elements (if ``paginated = True``)
+            - a list of objects, the total number of elements and the cursors (if ``paginated = True`` and \
+``cursor`` is not ``None``)
             - the total number of elements (if ``count_only = True``)
         """
         '''
@@ -1523,11 +2473,13 @@ class APIDB():
             this will save some `ifs` on the logic of the api since paginated and non-paginated
             query can be cast to the same tuple `res, total = ..`
         '''
+        if paginated and cursor is not None and not count_only and not keys_only and not query_only:
+            return cls.__get_page(o, size=size, page=page, cursor=cursor, counter=counter, **kwargs)
         if type(o) == Query:
             if query_only:
                 return o
             if count_only:
-                return o.count()
+                return cls.__count(o, counter)
             if keys_only:
                 return o.order(-GCModel.created).fetch(keys_only=True)
 
@@ -1536,10 +2488,10 @@ class APIDB():
                 # if it's a query, then use fetch
                 # if isinstance(o, ndb.Query):
                 if size == -1:
-                    return cls.__get_relation_if_needed(o.fetch(), **kwargs)
+                    return cls.__get_relation_if_needed(cls.__projected(o, **kwargs).fetch(), **kwargs)
                 if size == 0:
                     return []
-                return cls.__get_relation_if_needed(o.fetch(size), **kwargs)
+                return cls.__get_relation_if_needed(cls.__projected(o, **kwargs).fetch(size), **kwargs)
                 # else:
                 # logging.debug("Type %s %s", type(o), o)
                 # raise Exception("Type not found %s %s" % (type(o), o))
@@ -1548,7 +2500,7 @@ class APIDB():
                 if size == -1:
                     size = cfg.PAGE_SIZE
                 if size == 0:
-                    return [], o.count()
+                    return [], cls.__count(o, counter)
                 if page < 0:
                     page = 0
                 # if we want some limit here
@@ -1558,8 +2510,8 @@ class APIDB():
                 offset = page * size
                 # NOTE: this is slower then using the cursor
                 # http://youtu.be/xZsxWn58pS0?t=51m9s
-                data = cls.__get_relation_if_needed(o.fetch(size, offset=offset), **kwargs)
-                return data, o.count()
+                data = cls.__get_relation_if_needed(cls.__projected(o, **kwargs).fetch(size, offset=offset), **kwargs)
+                return data, cls.__count(o, counter)
         elif type(o) == list:
             # in case it's a list
             if count_only:
@@ -1580,6 +2532,188 @@ class APIDB():
                 data = o[start:end]
                 return cls.__get_multi_if_needed(data), len(o)
 
+    @classmethod
+    def __get_page(cls, o, size=-1, page=0, cursor='', counter=None, **kwargs):  # pragma: no cover
+        """
+        Cursor version of the pagination of :py:meth:`._APIDB__get`.
+
+        The ``cursor`` is the opaque token returned as ``next`` or ``prev`` by the previous call, an empty value
+        means the first page. The query restarts from the cursor, so it does not scan the skipped entities as the
+        ``offset`` does, and the count runs in parallel with the fetch.
+
+        If there's no cursor but the ``page`` is set, then it falls back to the offset (for old clients), and ``prev``
+        is the token of the offset of the previous page.
+
+        .. note::
+
+            ``prev`` runs the query with the orders reversed, this needs the descending version of the index
+            (see ``index.yaml``). If the query has no order ``prev`` is always ``None``.
+
+        :param o: the query or the list
+        :param size: the size of the page
+        :param page: the page number, used only when ``cursor`` is empty
+        :param cursor: the token
+        :param counter: the name of the counter for the total, see :py:meth:`._APIDB__count`
+        :param kwargs: 'projection' and 'merge', see :py:meth:`._APIDB__get_relation_if_needed`
+        :return: list of objects, the total, dict with the ``next`` and ``prev`` tokens (``None`` if there are no
+        more pages)
+        """
+        if size == -1:
+            size = cfg.PAGE_SIZE
+        if page < 0:
+            page = 0
+        direction, position = cls.__decode_cursor(cursor)
+        if type(o) == list:
+            # lists are already in memory, the token is just the offset
+            if direction is None:
+                offset = page * size
+            elif direction == 'o':
+                offset = position
+            else:
+                raise BadParameters("cursor")
+            offset = min(offset, len(o))
+            data = o[offset:offset + size]
+            cursors = dict(next=cls.__encode_cursor('o', offset + size) if offset + size < len(o) else None,
+                           prev=cls.__encode_cursor('o', max(offset - size, 0)) if offset > 0 else None)
+            return cls.__get_multi_if_needed(data), len(o), cursors
+
+        if isinstance(o.filters, DisjunctionNode):
+            # IN and OR are split in several queries, to have cursors they must be ordered by key
+            o = o.order(GCModel._key)
+        total = counters.get_count(counter) if counter else None
+        if total is None:
+            total = o.count_async()
+        if size == 0:
+            return [], cls.__total(total, counter), dict(next=None, prev=None)
+        reversible = o.orders is not None
+        # the count is on the original query
+        o = cls.__projected(o, **kwargs)
+        if direction == 'p':
+            if not reversible:
+                raise BadParameters("cursor")
+            # go backward: the reverse query starting from the cursor gives the items before it
+            r_data, r_cursor, more = cls.__reverse_query(o).fetch_page(size, start_cursor=position.reversed())
+            r_data.reverse()
+            data = r_data
+            cursors = dict(next=cls.__encode_cursor('n', position),
+                           prev=cls.__encode_cursor('p', r_cursor.reversed()) if more and r_cursor else None)
+        elif direction == 'n':
+            data, next_cursor, more = o.fetch_page(size, start_cursor=position)
+            cursors = dict(next=cls.__encode_cursor('n', next_cursor) if more else None,
+                           prev=cls.__encode_cursor('p', position) if reversible else None)
+        elif direction is None or direction == 'o':
+            # first page, or old clients that use the page number: the previous page is read by offset too
+            offset = page * size if direction is None else position
+            data, next_cursor, more = o.fetch_page(size, offset=offset)
+            cursors = dict(next=cls.__encode_cursor('n', next_cursor) if more else None,
+                           prev=cls.__encode_cursor('o', max(offset - size, 0)) if offset > 0 else None)
+        else:
+            raise BadParameters("cursor")
+        return cls.__get_relation_if_needed(data, **kwargs), cls.__total(total, counter), cursors
+
+    @classmethod
+    def __projected(cls, o, projection=None, merge=None, **kwargs):  # pragma: no cover
+        """
+        The query of the relations as a projection query on the ``projection`` field, when it's the only field read
+        by :py:meth:`._APIDB__get_relation_if_needed`. The relations are not loaded whole, e.g. the observations
+        of the subscriptions.
+
+        The query is not changed if the relations are merged, if it's ordered or split in several queries (the
+        index would need the projected field after the orders) or if the field is in an equality filter.
+        The projections need the index of the filters followed by the field (see ``index.yaml``).
+
+        :param o: the query
+        :param projection: the field of the relation
+        :param merge: the field where the relation is added
+        :param kwargs: not used
+        :return: the query
+        """
+        if not projection or merge or o.projection or o.orders is not None or isinstance(o.filters, DisjunctionNode):
+            return o
+        prop = getattr(ndb.Model._lookup_model(o.kind), projection, None)
+        if not isinstance(prop, ndb.Property) or prop._name in cls.__equality_filters(o.filters):
+            return o
+        return Query(kind=o.kind, ancestor=o.ancestor, filters=o.filters, orders=o.orders, app=o.app,
+                     namespace=o.namespace, default_options=o.default_options, projection=[prop._name])
+
+    @classmethod
+    def __equality_filters(cls, node):  # pragma: no cover
+        """
+        The names of the properties with an equality filter.
+
+        :param node: the filters of the query
+        :return: set of names
+        """
+        if isinstance(node, FilterNode):
+            name, opsymbol, _ = node.__getnewargs__()
+            return set([name]) if opsymbol == '=' else set()
+        if isinstance(node, ConjunctionNode):
+            return set().union(*[cls.__equality_filters(child) for child in node])
+        return set()
+
+    @staticmethod
+    def __total(total, counter):  # pragma: no cover
+        """
+        Gets the result of the count started in :py:meth:`._APIDB__get_page`, and initializes the counter with it.
+
+        :param total: the value or the future of the count
+        :param counter: the name of the counter
+        :return: the total
+        """
+        if isinstance(total, ndb.Future):
+            total = total.get_result()
+            if counter:
+                total = counters.initialize(counter, total)
+        return total
+
+    @staticmethod
+    def __encode_cursor(direction, position):  # pragma: no cover
+        """
+        Builds the token sent to the client.
+
+        :param direction: ``n`` (next), ``p`` (prev) or ``o`` (offset, of a list or of the pages by number)
+        :param position: the ``Cursor`` or the offset
+        :return: the token or ``None``
+        """
+        if position is None:
+            return None
+        if isinstance(position, ndb.Cursor):
+            position = position.urlsafe()
+        return "%s:%s" % (direction, position)
+
+    @staticmethod
+    def __decode_cursor(token):  # pragma: no cover
+        """
+        Reads the token created by :py:meth:`._APIDB__encode_cursor`
+
+        :param token: the token
+        :return: the direction and the ``Cursor`` (or the offset), ``None, None`` if the token is empty
+        :raises: BadParameters if the token is not valid
+        """
+        if not token:
+            return None, None
+        try:
+            direction, position = token.split(":", 1)
+            if direction == 'o':
+                return direction, int(position)
+            if direction in ('n', 'p'):
+                return direction, ndb.Cursor(urlsafe=position)
+        except Exception:
+            pass
+        raise BadParameters("cursor")
+
+    @staticmethod
+    def __reverse_query(o):  # pragma: no cover
+        """
+        Creates the same query with all the orders reversed.
+
+        :param o: the query
+        :return: the reversed query
+        """
+        return Query(kind=o.kind, ancestor=o.ancestor, filters=o.filters, orders=o.orders.reversed(), app=o.app,
+                     namespace=o.namespace, default_options=o.default_options, projection=o.projection,
+                     group_by=o.group_by)
+
     @classmethod
     def __get_multi_if_needed(cls, l):  # pragma: no cover
         """
@@ -1610,7 +2744,7 @@ class APIDB():
         can be accessed via ``user.relation`` and **it's not stored into the db**.
 
         :param result: the result of the query
-        :param projection: the field to use for getting back the data
+        :param projection: the field to use for getting back the data, ``parent`` to use the parent of the keys
         :param merge: the field where the relation is added (optional)
         :param kwargs: additoanl args not used in this function.
         :return: the list of objects
@@ -1631,7 +2765,11 @@ class APIDB():
             # it's paginated
             relations, total = result
         # gets all the keys with the specified fileds.
-        keys = [getattr(r, projection) for r in relations]
+        # 'parent' is for the keys only queries on the relation index entities, the object is the parent
+        if projection == 'parent':
+            keys = [r.parent() for r in relations]
+        else:
+            keys = [getattr(r, projection) for r in relations]
         res = ndb.get_multi(keys)
         # here we can acually do a merge if we want to keep some data from the middle table.
         if merge:
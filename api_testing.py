@@ -13,12 +13,11 @@ from api_db_utils import APIDB
 from gaebasepy.auth import GCAuth
 from gaebasepy.exceptions import BadParameters
 from gaebasepy.gc_utils import json_from_request
-from tasks import sync_user
+from tasks import sync_user, defer
 
 
 __author__ = 'stefano tranquillini'
 
-from google.appengine.ext import deferred
 
 from models import User
 
@@ -63,7 +62,7 @@ def auth(req):  # pragma: no cover
         response.status = 201
     token = GCAuth.get_token(s_token)
     response.write(json.dumps(token))
-    deferred.defer(sync_user, user, s_token)
+    defer(sync_user, user, s_token)
     return response
 
 
@@ -75,7 +74,7 @@ def auth(req, email):  # pragma: no cover
     response = webapp2.Response(content_type='application/json', charset='UTF-8')
     token = GCAuth.get_token(s_token)
     response.write(json.dumps(token))
-    deferred.defer(sync_user, user, s_token)
+    defer(sync_user, user, s_token)
     return response
 
 
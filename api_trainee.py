@@ -1,25 +1,24 @@
 import json
 
-from google.appengine.ext.deferred import deferred
-
 from gaebasepy.http_codes import HttpCreated
-from tasks import sync_user
+from tasks import sync_user, defer
 
 
 __author__ = 'Stefano Tranquillini <stefano.tranquillini@gmail.com>'
 
 from app import app
-from models import Version, Log
+from models import Version, Log, exercises_to_dict, resolve_details
+from serializer import serialize, response
 
 import datetime
 
 from api_db_utils import APIDB
+import identity_map
 from auth import user_has_role
 from gaebasepy.auth import GCAuth, user_required
 from gaebasepy.exceptions import AuthenticationError, BadParameters, NotFoundException, BadRequest
 from gaebasepy.gc_utils import sanitize_json, sanitize_list, json_from_paginated_request, \
     json_from_request
-from google.appengine.api import search
 from google.appengine.ext import ndb
 from google.appengine.ext.ndb.key import Key
 
@@ -111,7 +110,7 @@ def trainee_profile(req):
                 raise BadRequest("It seems that you want to activate a club that you are not member of")
         update, user = APIDB.update_user(req.user, **j_req)
         s_token = GCAuth.auth_user_token(user)
-        deferred.defer(sync_user, user, s_token)
+        defer(sync_user, user, s_token)
         return sanitize_json(user, out, except_on_missing=False)
 
 
@@ -135,7 +134,7 @@ def trainee_club_list(req):
     List of the clubs
     """
     # check if there's the filter
-    j_req = json_from_paginated_request(req, (('member', None),))
+    j_req = json_from_paginated_request(req, (('member', None), ('cursor', '')))
     if hasattr(req, 'member'):
         j_req['member'] = req.member
     user_filter = j_req['member'] == 'true'
@@ -147,27 +146,30 @@ def trainee_club_list(req):
         # get the user, just in case
         user = GCAuth.get_user_or_none(req)
         if user:
-            clubs, total = APIDB.get_user_member_of(user, paginated=True, page=page, size=size)
+            clubs, total, cursors = APIDB.get_user_member_of(user, paginated=True, page=page, size=size,
+                                                             cursor=j_req['cursor'])
         else:
             raise AuthenticationError("member is set but user is missing")
     else:
-        clubs, total = APIDB.get_clubs(paginated=True, page=page, size=size)
+        clubs, total, cursors = APIDB.get_clubs(paginated=True, cursor=j_req['cursor'], page=page, size=size)
 
     # render accordingly to the doc.
     ret = {}
     items = []
+    clubs = [club for club in clubs if not club.is_deleted]
+    aggregates = APIDB.get_clubs_aggregates(clubs, owners=True)
     for club in clubs:
-        if not club.is_deleted:
-            j_club = club.to_dict()
-            j_club['member_count'] = APIDB.get_club_members(club, count_only=True)
-            j_club['course_count'] = APIDB.get_club_courses(club, count_only=True)
-            j_club['owners'] = sanitize_list(APIDB.get_club_owners(club), ['name', 'picture'])
-            items.append(j_club)
+        j_club = club.to_dict()
+        j_club['member_count'] = aggregates[club.key]['member_count']
+        j_club['course_count'] = aggregates[club.key]['course_count']
+        j_club['owners'] = sanitize_list(aggregates[club.key]['owners'], ['name', 'picture'])
+        items.append(j_club)
     ret['results'] = sanitize_list(items,
                                    ['id', 'name', 'description', 'url', 'creation_date', 'is_open', 'tags', 'owners',
                                     'member_count', 'course_count'])
 
     ret['total'] = total
+    ret.update(cursors)
     return ret
 
 
@@ -200,21 +202,24 @@ def trainee_club_members(req, uskey_club):
         user = GCAuth.get_user(req)
         if APIDB.get_user_club_role(user, club) != "MEMBER":
             raise AuthenticationError("User is not subscribed to the course")
-    j_req = json_from_paginated_request(req)
+    j_req = json_from_paginated_request(req, (('cursor', ''),))
     page = int(j_req['page'])
     size = int(j_req['size'])
     role = req.get('role', None)
     status = req.get('status', "ACCEPTED")
     l_users = []
     if not role:
-        members, total = APIDB.get_club_all_members(club, status=status, paginated=True, page=page, size=size,
-                                                    merge="role")
+        members, total, cursors = APIDB.get_club_all_members(club, status=status, paginated=True, page=page, size=size,
+                                                             merge="role", cursor=j_req['cursor'])
     elif role == "MEMBER":
-        members, total = APIDB.get_club_members(club, status=status, paginated=True, page=page, size=size)
+        members, total, cursors = APIDB.get_club_members(club, status=status, paginated=True, page=page, size=size,
+                                                         cursor=j_req['cursor'])
     elif role == "TRAINER":
-        members, total = APIDB.get_club_trainers(club, status=status, paginated=True, page=page, size=size)
+        members, total, cursors = APIDB.get_club_trainers(club, status=status, paginated=True, page=page, size=size,
+                                                          cursor=j_req['cursor'])
     elif role == "OWNER":
-        members, total = APIDB.get_club_owners(club, status=status, paginated=True, page=page, size=size)
+        members, total, cursors = APIDB.get_club_owners(club, status=status, paginated=True, page=page, size=size,
+                                                        cursor=j_req['cursor'])
     # if the query is paginated, and the previous call has already fetched enough people.
     else:
         raise BadParameters("Role does not exists %s" % role)
@@ -233,7 +238,7 @@ def trainee_club_members(req, uskey_club):
         res_user['type'] = user_role
         l_users.append(res_user)
 
-    return dict(results=l_users, total=total)
+    return dict(results=l_users, total=total, **cursors)
 
 
 @app.route('/%s/clubs/<uskey_club>/courses' % APP_TRAINEE, methods=('GET',))
@@ -244,7 +249,8 @@ def trainee_course_list(req, uskey_club):
     List of the courses of a club
     """
     club = req.model
-    j_req = json_from_paginated_request(req, (('course_type', None), 'activeOnly', ('subscribed', False)))
+    j_req = json_from_paginated_request(req, (('course_type', None), 'activeOnly', ('subscribed', False),
+                                              ('cursor', '')))
     page = int(j_req['page'])
     size = int(j_req['size'])
     course_type = j_req['course_type']
@@ -252,17 +258,23 @@ def trainee_course_list(req, uskey_club):
     subscribed = j_req['subscribed'] == "True"
 
     if subscribed:
-        courses, total = APIDB.get_club_courses_im_subscribed_to(club, course_type=course_type, active_only=active_only,
-                                                                 paginated=True, page=page, size=size)
+        user = GCAuth.get_user_or_none(req)
+        if not user:
+            raise AuthenticationError("subscribed is set but user is missing")
+        courses, total, cursors = APIDB.get_club_courses_im_subscribed_to(user, club, course_type=course_type,
+                                                                          active_only=active_only, paginated=True,
+                                                                          page=page, size=size, cursor=j_req['cursor'])
     else:
-        courses, total = APIDB.get_club_courses(club, course_type=course_type, active_only=active_only,
-                                                paginated=True, page=page, size=size)
+        courses, total, cursors = APIDB.get_club_courses(club, course_type=course_type, active_only=active_only,
+                                                         paginated=True, page=page, size=size, cursor=j_req['cursor'])
     res_courses = []
+    stats = APIDB.get_courses_stats(courses)
     for course in courses:
         j_course = course.to_dict()
-        j_course["trainers"] = sanitize_list(APIDB.get_course_trainers(course), allowed=["id", "name", "picture"])
-        j_course["subscriber_count"] = APIDB.get_course_subscribers(course, count_only=True)
-        j_course["session_count"] = APIDB.get_course_sessions(course, count_only=True)
+        course_stats = stats[course.key]
+        j_course["trainers"] = sanitize_list(course_stats['trainers'], allowed=["id", "name", "picture"])
+        j_course["subscriber_count"] = course_stats['subscriber_count']
+        j_course["session_count"] = course_stats['session_count']
 
         allowed = ["id", "name", "description", "trainers", "subscriber_count", "session_count", "course_type"]
         if course.course_type == "SCHEDULED":
@@ -274,6 +286,7 @@ def trainee_course_list(req, uskey_club):
     ret = {}
     ret['results'] = res_courses
     ret['total'] = total
+    ret.update(cursors)
     return ret
 
 
@@ -287,9 +300,10 @@ def trainee_course_detail(req, uskey_course):
     """
     course = req.model
     j_course = course.to_dict()
-    j_course["trainers"] = sanitize_list(APIDB.get_course_trainers(course), allowed=["id", "name", "picture"])
-    j_course["subscriber_count"] = APIDB.get_course_subscribers(course, count_only=True)
-    j_course["session_count"] = APIDB.get_course_sessions(course, count_only=True)
+    course_stats = APIDB.get_courses_stats([course])[course.key]
+    j_course["trainers"] = sanitize_list(course_stats['trainers'], allowed=["id", "name", "picture"])
+    j_course["subscriber_count"] = course_stats['subscriber_count']
+    j_course["session_count"] = course_stats['session_count']
     allowed = ["id", "name", "description", "trainers", "subscriber_count", "session_count", "course_type"]
     if course.course_type == "SCHEDULED":
         allowed += ["start_date", "end_date"]
@@ -308,11 +322,12 @@ def trainee_course_subscribers_list(req, uskey_course):
     """
     # TODO: test
     course = req.model
-    j_req = json_from_paginated_request(req)
+    j_req = json_from_paginated_request(req, (('cursor', ''),))
     page = int(j_req['page'])
     size = int(j_req['size'])
-    subscribers, total = APIDB.get_course_subscribers(course, paginated=True, page=page, size=size)
-    ret = dict(results=sanitize_list(subscribers, allowed=["id", "nickname", "avatar"]), total=total)
+    subscribers, total, cursors = APIDB.get_course_subscribers(course, paginated=True, page=page, size=size,
+                                                               cursor=j_req['cursor'])
+    ret = dict(results=sanitize_list(subscribers, allowed=["id", "nickname", "avatar"]), total=total, **cursors)
     return ret
 
 
@@ -328,7 +343,7 @@ def trainee_course_session_list(req, uskey_course):
     course = req.model
     j_req = json_from_paginated_request(req, (('status', 'UPCOMING'), ('type', None),
                                               ('from', None),
-                                              ('to', None)))
+                                              ('to', None), ('cursor', '')))
 
     page = int(j_req['page'])
     size = int(j_req['size'])
@@ -342,28 +357,14 @@ def trainee_course_session_list(req, uskey_course):
         date_to = None
     session_type = j_req['type']
 
-    sessions, total = APIDB.get_course_sessions(course, date_from=date_from, date_to=date_to, session_type=session_type,
-                                                paginated=True, page=page, size=size)
-    res_list = []
-    for session in sessions:
-        res_obj = session.to_dict()
-        res_obj['status'] = session.status
-        res_obj['participated'] = APIDB.user_participated_in_session(req.user, session)
-        res_obj['participation_count'] = APIDB.user_participation_details(req.user, session, count_only=True)
-        # res_obj['actnoivity_count'] = session.activity_count
-        res_obj['max_score'] = APIDB.session_completeness(req.user, session)
-        allowed = ['id', 'name', 'status', 'participation_count',
-                   'session_type']
-        course_type = session.course.get().course_type
-        if session.session_type == "SINGLE":
-            allowed += ['url']
-        if course_type == "SCHEDULED":
-            allowed += ["start_date", "end_date"]
-        elif course_type == "PROGRAM":
-            allowed += ["week_no", "day_no"]
-        res_list.append(sanitize_json(res_obj, allowed=allowed))
-
-    return dict(total=total, results=res_list)
+    sessions, total, cursors = APIDB.get_course_sessions(course, date_from=date_from, date_to=date_to,
+                                                         session_type=session_type, paginated=True, page=page,
+                                                         size=size, cursor=j_req['cursor'])
+    participations = APIDB.get_user_sessions_participations(req.user, sessions)
+    res_list = [serialize(session, session.summary_fields(course),
+                          participation_count=participations[session.key]['participation_count'])
+                for session in sessions]
+    return response(total=total, results=res_list, **cursors)
 
 
 @app.route('/%s/clubs/<uskey_club>/sessions' % APP_TRAINEE, methods=('GET',))
@@ -378,7 +379,7 @@ def trainee_club_session_list(req, uskey_club):
     club = req.model
     j_req = json_from_paginated_request(req, (('type', None),
                                               ('from', None),
-                                              ('to', None)))
+                                              ('to', None), ('cursor', '')))
     page = int(j_req['page'])
     size = int(j_req['size'])
     try:
@@ -390,23 +391,16 @@ def trainee_club_session_list(req, uskey_club):
     except Exception as e:
         date_to = None
     session_type = j_req['type']
-    sessions, total = APIDB.get_sessions_im_subscribed(req.user, club, date_from, date_to, session_type, paginated=True,
-                                                       page=page, size=size)
+    stubs, total, cursors = APIDB.get_timeline_sessions(req.user, club, date_from, date_to, session_type,
+                                                        paginated=True, page=page, size=size, cursor=j_req['cursor'])
+    courses = dict((course.key, course) for course in identity_map.get_multi(list(set(s.course for s in stubs))))
+    res_list = [_timeline_item(stub, courses[stub.course]) for stub in stubs]
+    return response(total=total, results=res_list, **cursors)
 
-    res_list = []
-    for session in sessions:
-        res_obj = session.to_dict()
-        res_obj['status'] = session.status
-        res_obj['participated'] = APIDB.user_participated_in_session(req.user, session)
-        res_obj['participation_count'] = APIDB.user_participation_details(req.user, session, count_only=True)
-        res_obj['max_score'] = APIDB.session_completeness(req.user, session)
-        course = session.course.get()
-        res_obj['course_id'] = course.id
-        res_obj['course_name'] = course.name
-        # no edist here, since the data on the type are already removed
-        res_list.append(sanitize_json(res_obj, hidden=['course', 'list_exercises', 'profile', 'activities', 'on_before',
-                                                       'on_after', 'meta_data']))
-    return dict(total=total, results=res_list)
+
+def _timeline_item(stub, course):
+    # a session of the timeline of the user, see models.TimelineStub
+    return serialize(stub, stub.summary_fields(course), max_level=course.max_level, **stub.summary_values(course))
 
 
 @app.route('/%s/clubs/<uskey_club>/sessions/ongoing' % APP_TRAINEE, methods=('GET',))
@@ -421,22 +415,11 @@ def trainee_club_session_list_ongoing(req, uskey_club):
     club = req.model
     # j_req = json_from_request(req)
     # session_type = j_req['type']
-    sessions = APIDB.get_sessions_im_subscribed(req.user, club, paginated=False)
-
-    res_list = []
-    for session in sessions:
-        if session.status == "ONGOING":
-            res_obj = session.to_dict()
-            res_obj['status'] = session.status
-            res_obj['participated'] = APIDB.user_participated_in_session(req.user, session)
-            res_obj['participation_count'] = APIDB.user_participation_details(req.user, session, count_only=True)
-            res_obj['max_score'] = APIDB.session_completeness(req.user, session)
-            course = session.course.get()
-            res_obj['course_id'] = course.id
-            res_obj['course_name'] = course.name
-            # no edist here, since the data on the type are already removed
-            return sanitize_json(res_obj, hidden=['course', 'list_exercises', 'profile', 'activities', 'on_before',
-                                                  'on_after', 'meta_data'])
+    stubs = APIDB.get_timeline_sessions(req.user, club)
+    courses = dict((course.key, course) for course in identity_map.get_multi(list(set(s.course for s in stubs))))
+    for stub in stubs:
+        if stub.status(courses[stub.course].course_type) == "ONGOING":
+            return _timeline_item(stub, courses[stub.course])
     return dict()
 
     # Training session
@@ -461,10 +444,12 @@ def trainee_session_detail(req, uskey_session):
                                           allowed=["name", "indicator_type", "description", "possible_answers",
                                                    "required", 'id'])
     activities = APIDB.get_session_user_activities(session, req.user)
+    levels = [APIDB.get_user_level_for_activity(req.user, activity, session) for activity in activities]
+    # the details are already loaded by exercises_to_dict, the second call hits the identity map
+    j_activities = exercises_to_dict(activities)
+    details = resolve_details(levels)
     res_list = []
-    for activity in activities:
-        j_activity = activity.to_dict()
-        level = APIDB.get_user_level_for_activity(req.user, activity, session)
+    for activity, j_activity, level, level_details in zip(activities, j_activities, levels, details):
         j_activity['level'] = level.level_number
         j_activity['description'] = level.description
         j_activity['source'] = level.source
@@ -472,7 +457,7 @@ def trainee_session_detail(req, uskey_session):
                                                  allowed=["name", "indicator_type", "description", "possible_answers",
                                                           "required", 'id'])
         # this is already a json, see docs in the model
-        j_activity['details'] = level.details
+        j_activity['details'] = level_details
         res_list.append(j_activity)
     j_session['max_score'] = APIDB.session_completeness(req.user, session)
     j_session['activities'] = sanitize_list(res_list,
@@ -481,7 +466,7 @@ def trainee_session_detail(req, uskey_session):
     # there should be 'type',
     allowed = ['id', 'name', 'status', 'participation_count',
                'activities', 'session_type', 'max_score', 'on_before', 'on_after']
-    course_type = session.course.get().course_type
+    course_type = identity_map.get(session.course).course_type
     if course_type == "SCHEDULED":
         allowed += ["start_date", "end_date"]
     elif course_type == "PROGRAM":
@@ -504,11 +489,10 @@ def trainee_session_performance(req, uskey_session):
     participation = json_from_request(req, mandatory_props=['joinTime', 'leaveTime', 'indicators',
                                                             'activityPerformances', 'completeness'])
     performances = participation.pop('activity_performances')
-    # check the data from here. probably the particaipation goes into the creation
-    participation = APIDB.create_participation(req.user, req.model, **participation)
-    for performance in performances:
-        APIDB.create_performance(participation, performance['activityId'], performance['completeness'],
-                                 performance['recordDate'], performance['indicators'])
+    performances = [dict(activity_id=performance.get('activityId'), completeness=performance.get('completeness'),
+                         record_date=performance.get('recordDate'), indicators=performance.get('indicators'))
+                    for performance in performances]
+    APIDB.create_session_performances(req.user, req.model, performances=performances, **participation)
     return HttpCreated()
 
 
@@ -553,6 +537,8 @@ def search_user(req):
     offset = size * (int(j_req['page']))
     if not query_string:
         raise BadParameters("Missing 'query' parameter")
+    # imported here, only this endpoint uses the search api and it's slow to import
+    from google.appengine.api import search
     index = search.Index(name="users")
     query_options = search.QueryOptions(ids_only=True, offset=offset, limit=size)
     query = search.Query(query_string=query_string, options=query_options)
@@ -572,11 +558,11 @@ def club_room_list(req, uskey_club):
     :return:
     """
     club = req.model
-    j_req = json_from_paginated_request(req)
+    j_req = json_from_paginated_request(req, (('cursor', ''),))
     page = int(j_req['page'])
     size = int(j_req['size'])
-    rooms, total = APIDB.get_club_rooms(club, paginated=True, size=size, page=page)
-    return dict(results=rooms, total=total)
+    rooms, total, cursors = APIDB.get_club_rooms(club, paginated=True, size=size, page=page, cursor=j_req['cursor'])
+    return dict(results=rooms, total=total, **cursors)
 
 
 @app.route("/%s/rooms/<uskey_room>" % APP_TRAINEE, methods=('GET',))
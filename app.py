@@ -2,10 +2,15 @@
 App
 
 """
+import logging
+
 from google.appengine.ext.ndb.key import Key
 
 from api_db_utils import APIDB
 import cfg
+import identity_map
+import role_cache
+from serializer import Serialized
 from gaebasepy.app import WSGIApp
 from gaebasepy.auth import GCAuth
 from gaebasepy.exceptions import NotFoundException, AuthenticationError
@@ -21,6 +26,17 @@ class GCApp(WSGIApp):
 
     """
 
+    def __call__(self, environ, start_response):  # pragma: no cover
+        """
+        Runs the request and always removes its identity map, also when the handler or a decorator raises and
+        :py:meth:`.edit_response` is not called. Otherwise the map would stay on the thread and the tasks that
+        run later on it would read its entities.
+        """
+        try:
+            return super(GCApp, self).__call__(environ, start_response)
+        finally:
+            identity_map.clear()
+
     @staticmethod
     def edit_request(router, request, response):  # pragma: no cover
         """
@@ -32,6 +48,13 @@ class GCApp(WSGIApp):
 
         If the ``key`` does not exists it raises and exception.
 
+        It also installs the identity map of the request (see ``identity_map.py``), all the lookups by key go
+        through it until :py:meth:`.edit_response` (or the end of :py:meth:`.__call__` if the request fails).
+
+        The object, the user of the token and the relation of the user with the object that the role check will
+        need (see :py:func:`role_cache.prefetch_async`) are loaded concurrently, the user is set in
+        ``request.user`` so the decorators don't load it again.
+
         example::
 
             @app.route("/%s/hw/<uskey_obj>" % APP_ADMIN, methods=('GET', )) #method annotation, note the `uskey` param
@@ -47,6 +70,7 @@ class GCApp(WSGIApp):
         :param response: the response
         :return: the request edited
         """
+        identity_map.install()
         # check that there's a valid app code
         # depending on the url...
         app_id = request.headers.get("X-App-Id")
@@ -68,12 +92,24 @@ class GCApp(WSGIApp):
                         return request
                     if value != "current":
                         try:
-                            model = Key(urlsafe=value).get()
+                            model_key = Key(urlsafe=value)
+                            future = model_key.get_async()
+                        except:
+                            raise NotFoundException()
+                        # the model is loaded while the user is loaded
+                        user = GCApp.__preload_user(request)
+                        prefetch = None
+                        if user is not None:
+                            prefetch = role_cache.prefetch_async(user, model_key, "coach" in request.url)
+                        try:
+                            model = identity_map.remember(future.get_result())
                             if not model.active:
                                 raise NotFoundException()
                             setattr(request, cfg.MODEL_NAME, model)
                         except:
                             raise NotFoundException()
+                        if prefetch is not None:
+                            prefetch.get_result()
                     else:
                         # NOTE: api works also with the word `curren` as uskey parameter, in that case we do this trick to load the correct model.
                         # crurent works only for club..
@@ -88,17 +124,41 @@ class GCApp(WSGIApp):
                     return request
         return request
 
+    @staticmethod
+    def __preload_user(request):  # pragma: no cover
+        """
+        Loads the user of the token of the request, if there's one, and sets it in ``request.user``.
+
+        :param request: the request
+        :return: the user or ``None``
+        """
+        if hasattr(request, 'user'):
+            return request.user
+        if not request.headers.get("Authorization"):
+            return None
+        try:
+            user = GCAuth.get_user(request)
+        except AuthenticationError:
+            # the decorator raises it, if the endpoint needs the user
+            return None
+        if user is not None:
+            request.user = user
+        return user
+
     @staticmethod
     def edit_response(rv):
         """
-        Edits the response applying camel case
+        Edits the response applying camel case and clears the identity map of the request. The responses built
+        with ``serializer.response`` are already in camel case.
 
         :param rv: the response
         :return: the edited response
         """
+        logging.debug("identity map: %s", identity_map.stats())
+        identity_map.clear()
         if isinstance(rv, GCHttpCode):
             rv.message = camel_case(rv.message)
-        else:
+        elif not isinstance(rv, Serialized):
             rv = camel_case(rv)
         return rv
 
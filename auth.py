@@ -6,6 +6,7 @@ from gaebasepy.auth import GCAuth
 from gaebasepy.exceptions import AuthenticationError, NotFoundException
 from models import Club, ClubMembership, CourseSubscription, CourseTrainers, Course, Session, Exercise, Indicator, \
     Detail, Participation
+import role_cache
 
 # this beacuse the decorator is needed to create the docs but not to run the project
 # http://stackoverflow.com/questions/3687046/python-sphinx-autodoc-and-decorated-members
@@ -22,41 +23,45 @@ __author__ = 'stefano'
 logger = logging.getLogger('__name__')
 
 # NOTE: there's another auth in the submodule.
+# the relations come from role_cache, club and course can be the entities or their keys.
 
 def __club_role(user, club, roles):
-    rel = ClubMembership.get_by_id(user, club)
+    rel = role_cache.club_membership(user, club)
     if not rel:
         raise AuthenticationError("user has not the role (%s) in the club" % roles)
-    if rel.membership_type not in roles:
+    membership_type, is_active = rel
+    if membership_type not in roles:
         raise AuthenticationError("user has not the role (%s) in the club" % roles)
-    if not rel.is_active:
+    if not is_active:
         raise AuthenticationError("user relationship is inactive")
     return True
 
 
 def __course_role(user, course, roles):
     if "MEMBER" in roles:
-        rel = CourseSubscription.get_by_id(user, course)
-        if rel is None:
+        is_active = role_cache.course_relation(CourseSubscription, user, course)
+        if is_active is None:
             raise AuthenticationError("user is not member of the course")
-        if not rel.is_active:
+        if not is_active:
             raise AuthenticationError("user is not ACTIVE member of the course")
     elif "TRAINER" in roles:
-        rel = CourseTrainers.get_by_id(user, course)
-        if rel is None:
+        is_active = role_cache.course_relation(CourseTrainers, user, course)
+        if is_active is None:
             raise AuthenticationError("user is not trainer of the course")
-        if not rel.is_active:
+        if not is_active:
             raise AuthenticationError("user is not ACTIVE trainer of the course")
     elif "OWNER" in roles:
         # in case this rises and exception.
-        __club_role(user, course.club, ['OWNER'])
+        __club_role(user, role_cache.parent(course, 'club'), ['OWNER'])
     else:
         raise AuthenticationError("Role (%s) is not permitted for course" % roles)
 
 
 def __club_membership_role(user, club, roles):
-    role = user.membership_type(club)
-    if role not in roles:
+    rel = role_cache.club_membership(user, club)
+    if not rel or not rel[1]:
+        raise AuthenticationError("User is not connected to the Club")
+    if rel[0] not in roles:
         raise AuthenticationError("You are not trainer nor owner of this club")
 
 
@@ -103,7 +108,7 @@ def user_has_role(roles):
                 elif isinstance(obj, (Exercise, Indicator, Detail)):
                     __club_role(req.user, obj.created_for, roles)
                 elif isinstance(obj, Participation):
-                    __course_role(req.user, obj.session.get().course, roles)
+                    __course_role(req.user, role_cache.parent(obj.session, 'course'), roles)
                 else:
                     raise AuthenticationError("Object %s not known" % type(obj))
                 return handler(req, *args, **kwargs)
@@ -0,0 +1,158 @@
+"""
+Sharded counters used to have the totals of the list calls without counting the entities every time.
+
+A counter is identified by its name (see ``APIDB.__counter_names``). The value is the ``offset`` stored in the
+:py:class:`Counter` entity plus the sum of its :py:class:`CounterShard`. The writes pick a random shard so that
+they don't fight on the same entity group, the reads are fronted by memcache.
+
+A counter that has no :py:class:`Counter` entity is not initialized, :py:func:`get_count` returns ``None`` and
+the caller has to count with the query and call :py:func:`initialize`.
+"""
+import random
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+
+__author__ = 'stefano tranquillini'
+
+NUM_SHARDS = 10
+MEMCACHE_PREFIX = "counter:"
+
+
+class Counter(ndb.Model):
+    # the id is the name of the counter.
+    # offset is the value of the count when the counter was initialized minus what was in the shards
+    offset = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class CounterShard(ndb.Model):
+    # the id is name|number of the shard
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
+
+def _shard_keys(name):
+    return [ndb.Key(CounterShard, "%s|%s" % (name, i)) for i in range(NUM_SHARDS)]
+
+
+def _memcache_key(name):
+    return MEMCACHE_PREFIX + name
+
+
+def get_count(name):
+    """
+    Gets the value of a counter
+
+    :param name: the name of the counter
+    :return: the value or ``None`` if the counter is not initialized
+    """
+    return get_counts([name])[name]
+
+
+def get_counts(names):
+    """
+    Gets the values of many counters, with one call to memcache and one ``get_multi`` for the missing ones.
+
+    :param names: list of names
+    :return: dict name -> value (``None`` if the counter is not initialized)
+    """
+    names = list(set(names))
+    cached = memcache.get_multi(names, key_prefix=MEMCACHE_PREFIX)
+    ret = dict((name, cached[name]) for name in names if name in cached)
+    missing = [name for name in names if name not in ret]
+    if not missing:
+        return ret
+    keys = []
+    for name in missing:
+        keys.append(ndb.Key(Counter, name))
+        keys += _shard_keys(name)
+    entities = ndb.get_multi(keys)
+    to_cache = {}
+    step = NUM_SHARDS + 1
+    for i, name in enumerate(missing):
+        head = entities[i * step]
+        if head is None:
+            ret[name] = None
+            continue
+        shards = entities[i * step + 1:(i + 1) * step]
+        ret[name] = to_cache[name] = head.offset + sum(shard.count for shard in shards if shard)
+    if to_cache:
+        memcache.add_multi(to_cache, key_prefix=MEMCACHE_PREFIX)
+    return ret
+
+
+def initialize(name, value):
+    """
+    Initializes a counter with the value counted from the query. If it's already initialized it does nothing.
+
+    .. note::
+
+        the value comes from a query, so the writes that happen while counting may be lost.
+
+    :param name: the name of the counter
+    :param value: the current value
+    :return: the value of the counter
+    """
+
+    @ndb.transactional(xg=True)
+    def txn():
+        head = Counter.get_by_id(name)
+        if head is not None:
+            return None
+        # increments done before the initialization are already in the value.
+        shards = ndb.get_multi(_shard_keys(name))
+        head = Counter(id=name, offset=value - sum(shard.count for shard in shards if shard))
+        head.put()
+        return value
+
+    if txn() is not None:
+        memcache.set(_memcache_key(name), value)
+        return value
+    return get_count(name)
+
+
+def increment(name, delta=1):
+    """
+    Increments a counter. If called inside a transaction the increment is part of it (the transaction must be
+    ``xg``) and memcache is updated only when it commits.
+
+    :param name: the name of the counter
+    :param delta: the value to add (can be negative)
+    """
+    key = random.choice(_shard_keys(name))
+
+    def txn():
+        shard = key.get()
+        if shard is None:
+            shard = CounterShard(key=key)
+        shard.count += delta
+        shard.put()
+
+    if ndb.in_transaction():
+        txn()
+        ndb.get_context().call_on_commit(lambda: _incr_cache(name, delta))
+    else:
+        ndb.transaction(txn)
+        _incr_cache(name, delta)
+
+
+def update(before, after):
+    """
+    Moves the counters when an entity changes: decrements the names that are only in ``before`` and increments
+    the ones that are only in ``after``.
+
+    :param before: the counter names of the old entity
+    :param after: the counter names of the new one
+    """
+    for name in set(before) - set(after):
+        increment(name, -1)
+    for name in set(after) - set(before):
+        increment(name, 1)
+
+
+def _incr_cache(name, delta):
+    # if the value is not in memcache there's nothing to do, the next read loads it.
+    if delta >= 0:
+        memcache.incr(_memcache_key(name), delta)
+    else:
+        memcache.decr(_memcache_key(name), -delta)
@@ -0,0 +1,101 @@
+"""
+Request-scoped identity map for the ndb lookups by key.
+
+:py:meth:`app.GCApp.edit_request` installs an empty map for the request and :py:meth:`app.GCApp.edit_response`
+removes it (``GCApp.__call__`` removes it also when the request fails), so every key is fetched at most once per
+request and the same object is returned to all the callers (e.g. the ``Course`` of a ``Session`` used by
+``to_dict``, ``max_level``, ``profile`` and ``status``).
+
+When no map is installed (tasks, cron, shell) the functions fall back to the plain ndb calls.
+
+.. note::
+
+    the map is not used inside transactions, the ``get`` there must read the stored entity.
+"""
+import threading
+
+from google.appengine.ext import ndb
+
+
+__author__ = 'stefano tranquillini'
+
+_local = threading.local()
+
+
+def install():
+    """
+    Installs an empty map for the current request and resets the counters.
+    """
+    _local.entities = {}
+    _local.hits = 0
+    _local.misses = 0
+
+
+def clear():
+    """
+    Removes the map of the current request.
+    """
+    _local.entities = None
+
+
+def _entities():
+    if ndb.in_transaction():
+        return None
+    return getattr(_local, 'entities', None)
+
+
+def get(key):
+    """
+    Gets the entity of the key, from the map if it was already loaded in this request.
+
+    :param key: the key (can be ``None``)
+    :return: the entity or ``None``
+    """
+    if key is None:
+        return None
+    return get_multi([key])[0]
+
+
+def get_multi(keys):
+    """
+    Gets the entities of the keys, loading the missing ones with a single ``get_multi``.
+
+    :param keys: list of keys
+    :return: list of entities (``None`` if the entity does not exist)
+    """
+    entities = _entities()
+    if entities is None:
+        return ndb.get_multi(keys)
+    missing = list(set(key for key in keys if key not in entities))
+    _local.hits += len(keys) - len(missing)
+    _local.misses += len(missing)
+    if missing:
+        for key, entity in zip(missing, ndb.get_multi(missing)):
+            # a missing entity may be created later in the request, it's not stored
+            if entity is not None:
+                entities[key] = entity
+    return [entities.get(key) for key in keys]
+
+
+def remember(entity):
+    """
+    Stores the entity in the map, used after a write so that the next ``get`` returns the new version.
+
+    :param entity: the entity
+    :return: the entity
+    """
+    entities = _entities()
+    if entities is not None and entity is not None and entity.key is not None:
+        entities[entity.key] = entity
+    return entity
+
+
+def stats():
+    """
+    Gets the counters of the current request.
+
+    :return: dict with ``hits``, ``misses`` and ``size`` of the map
+    """
+    entities = getattr(_local, 'entities', None)
+    return dict(hits=getattr(_local, 'hits', 0), misses=getattr(_local, 'misses', 0),
+                size=len(entities) if entities else 0)
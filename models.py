@@ -6,13 +6,14 @@ from google.appengine.ext.ndb.key import Key
 
 from gaebasepy.gc_models import GCModel, GCModelMtoMNoRep, GCUser
 from gaebasepy.gc_utils import date_to_js_timestamp, date_from_js_timestamp
-from gaebasepy.exceptions import AuthenticationError, BadParameters
+from gaebasepy.exceptions import AuthenticationError, BadParameters, ServerError
+import identity_map
+import search_index
 
 
 __author__ = 'fab,stefano.tranquillini'
 
 from google.appengine.ext import ndb
-from google.appengine.api import search
 
 # TODO create a GCMOdel for the support table that automatically has the get/build id
 
@@ -35,6 +36,8 @@ class User(GCUser):
     _default_indexed = False
 
     email = ndb.StringProperty(indexed=True, required=True, default="none@gymcentral.net")
+    # hash of the fields in the search index, see search_index.py
+    search_hash = ndb.StringProperty(indexed=False)
 
     # some handy queries already implemented.
     @property
@@ -81,19 +84,21 @@ class User(GCUser):
         del d['created']
         del d['auth_ids']
         del d['password']
+        del d['search_hash']
         return d
 
+    def search_fields(self):
+        return [('name', self.name), ('email', self.email), ('nickname', getattr(self, 'nickname', None))]
+
+    def _pre_put_hook(self):
+        super(User, self)._pre_put_hook()
+        # the search doc is updated only if the indexed fields changed, the hash is stored by search_index.drain
+        self._search_dirty = search_index.fields_hash(self.search_fields()) != self.search_hash
+
     def _post_put_hook(self, future):
         # create the search doc
-        user_doc = search.Document(
-            doc_id=self.id,
-            fields=[
-                search.TextField(name='name', value=self.name),
-                search.TextField(name='email', value=self.email),
-                search.TextField(name='nickname', value=self.nickname)
-            ])
-        index = search.Index(name="users")
-        index.put(user_doc)
+        if getattr(self, '_search_dirty', False):
+            search_index.enqueue("users", self)
         # this is needed for the realtime API, now is inside the model calls
         # deferred.defer(sync_user, self)
 
@@ -132,6 +137,36 @@ class Course(GCModel):
     def active(self):
         return not self.is_deleted
 
+    def window_contains(self, start_date, end_date):
+        # true if the dates are inside the course time
+        if self.start_date is None or self.end_date is None:
+            return False
+        return self.start_date <= start_date and end_date <= self.end_date
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def extend_window(cls, key, start_date, end_date):
+        """
+        Grows the course time to contain the dates, the course is written only if it changes. When it grows, the
+        ``course_end_date`` of its relations is synced by a task queued in the same transaction
+        (see ``tasks.sync_course_relations``).
+
+        :param key: the key of the course
+        :param start_date: the first start date
+        :param end_date: the last end date
+        :return: the course
+        """
+        course = key.get()
+        if course.window_contains(start_date, end_date):
+            return course
+        course.start_date = min(course.start_date or start_date, start_date)
+        course.end_date = max(course.end_date or end_date, end_date)
+        course.put()
+        # tasks imports the models
+        from tasks import defer, sync_course_relations
+        defer(sync_course_relations, key, _transactional=True)
+        return course
+
     # levels or profile to be added
 
     def safe_delete(self):
@@ -186,7 +221,45 @@ class Course(GCModel):
         super(Course, self).populate(**kwds)
 
 
-class CourseTrainers(GCModelMtoMNoRep):
+class CourseRelation(object):
+    """
+    The relations between a user and a course have a copy of the fields of the course that are used to list the
+    courses of the user (see ``APIDB.get_club_courses_im_subscribed_to``), so the list is a single query.
+    ``APIDB`` copies them when the relation is created and when the course is updated or deleted.
+    """
+    course_fields = ('club', 'course_type', 'course_end_date', 'is_deleted')
+
+    @staticmethod
+    def course_values(course):
+        """
+        The values of the course that are copied in the relations, compared to know if they have to be written.
+
+        :param course: the course
+        :return: dict field of the relation -> value
+        """
+        return dict(club=course.club, course_type=course.course_type, course_end_date=course.end_date,
+                    is_deleted=bool(course.is_deleted))
+
+    def copy_course(self, course):
+        """
+        Copies the fields of the course.
+
+        :param course: the course
+        :return: ``True`` if a value changed
+        """
+        values = self.course_values(course)
+        changed = any(getattr(self, name) != value for name, value in values.iteritems())
+        self.populate(**values)
+        return changed
+
+    def to_dict(self):
+        result = super(CourseRelation, self).to_dict()
+        for name in self.course_fields:
+            del result[name]
+        return result
+
+
+class CourseTrainers(CourseRelation, GCModelMtoMNoRep):
     # Probably can be put as a repeated property, the number of trainers should be limited in a club..
     # http://docs.gymcentralapi.apiary.io/#reference/training-subscription
     # probably is worth switching to this structure http://stackoverflow.com/a/27837999/1257185
@@ -194,6 +267,11 @@ class CourseTrainers(GCModelMtoMNoRep):
     course = ndb.KeyProperty(kind='Course', required=True)
     is_active = ndb.BooleanProperty(default=True)
     creation_date = ndb.DateTimeProperty(auto_now=True)
+    # copy of the course, see CourseRelation
+    club = ndb.KeyProperty(kind='Club')
+    course_type = ndb.StringProperty()
+    course_end_date = ndb.DateTimeProperty()
+    is_deleted = ndb.BooleanProperty(default=False)
 
     @property
     def active(self):
@@ -206,7 +284,7 @@ class Observation(GCModel):
     when = ndb.DateTimeProperty(auto_now=True)
 
 
-class CourseSubscription(GCModelMtoMNoRep):
+class CourseSubscription(CourseRelation, GCModelMtoMNoRep):
     # http://docs.gymcentralapi.apiary.io/#reference/training-subscription
     member = ndb.KeyProperty(kind='User', required=True)
     course = ndb.KeyProperty(kind='Course', required=True)
@@ -222,10 +300,15 @@ class CourseSubscription(GCModelMtoMNoRep):
     observations = ndb.StructuredProperty(Observation, repeated=True)
     start_date = ndb.DateTimeProperty(auto_now_add=True)
     end_date = ndb.DateTimeProperty()
+    # copy of the course, see CourseRelation
+    club = ndb.KeyProperty(kind='Club')
+    course_type = ndb.StringProperty()
+    course_end_date = ndb.DateTimeProperty()
+    is_deleted = ndb.BooleanProperty(default=False)
 
     def to_dict(self):
         result = super(CourseSubscription, self).to_dict()
-        course = self.course.get()
+        course = identity_map.get(self.course)
         result['max_level']=course.max_level
         result['profile']=course.profile
         return result
@@ -254,11 +337,11 @@ class ClubMembership(GCModelMtoMNoRep):
 
     @property
     def get_member(self):
-        return self.member.get()
+        return identity_map.get(self.member)
 
     @property
     def get_club(self):
-        return self.club.get()
+        return identity_map.get(self.club)
 
 
 class Club(GCModel):
@@ -275,11 +358,22 @@ class Club(GCModel):
     training_type = ndb.StringProperty(repeated=True, indexed=True)
     is_open = ndb.BooleanProperty(default=True)
     tags = ndb.StringProperty(repeated=True)
+    # hash of the fields in the search index, see search_index.py
+    search_hash = ndb.StringProperty(indexed=False)
 
     def is_valid(self):
         # this has to be implemented, used by the put
         return True
 
+    def to_dict(self):
+        result = super(Club, self).to_dict()
+        del result['search_hash']
+        return result
+
+    def search_fields(self):
+        return [('name', self.name), ('email', self.email), ('description', self.description),
+                ('tags', " ".join(self.tags))]
+
     def safe_delete(self):
         self.is_deleted = True
         self.is_open = False
@@ -306,19 +400,15 @@ class Club(GCModel):
     def owners(self):
         return self.all_memberships.filter(ClubMembership.membership_type == "OWNER")
 
+    def _pre_put_hook(self):
+        super(Club, self)._pre_put_hook()
+        # the search doc is updated only if the indexed fields changed, the hash is stored by search_index.drain
+        self._search_dirty = search_index.fields_hash(self.search_fields()) != self.search_hash
+
     def _post_put_hook(self, future):
         # create the search doc
-        club_doc = search.Document(
-            doc_id=self.id,
-            fields=[
-                search.TextField(name='name', value=self.name),
-                search.TextField(name='email', value=self.email),
-                search.TextField(name='description', value=self.description),
-                search.TextField(name='tags', value=" ".join(self.tags))
-            ])
-
-        index = search.Index(name="clubs")
-        index.put(club_doc)
+        if getattr(self, '_search_dirty', False):
+            search_index.enqueue("clubs", self)
         # these methods are not used anymore, there's the query()
         # @classmethod
         # def get_by_email(cls, email, **kwargs):
@@ -333,6 +423,19 @@ class Club(GCModel):
         # return cls.query(cls.training_type.IN(training)), kwargs
 
 
+def session_status(canceled, course_type, start_date, end_date, now=None):
+    # the status of a session, only the sessions of the scheduled courses have a time
+    if canceled:
+        return "CANCELED"
+    if course_type == "SCHEDULED":
+        now = now or datetime.now()
+        if now < start_date:
+            return "UPCOMING"
+        elif now > end_date:
+            return "FINISHED"
+    return "ONGOING"
+
+
 class Session(GCModel):
     name = ndb.StringProperty(required=True)
     url = ndb.StringProperty(required=False, default="")
@@ -350,7 +453,12 @@ class Session(GCModel):
     meta_data = ndb.JsonProperty()
     on_before = ndb.KeyProperty(kind='Indicator', repeated=True)
     on_after = ndb.KeyProperty(kind='Indicator', repeated=True)
-    status = ndb.ComputedProperty(lambda self: self._compute_status())
+    # stored when the session is saved and moved on by the cron job (APIDB.update_sessions_status),
+    # so that it can be used in the queries
+    status = ndb.StringProperty(choices=["UPCOMING", "ONGOING", "FINISHED", "CANCELED"])
+    # the club of the course, None if the course is deleted. set when the session is saved, it's used to list the
+    # sessions of a club with one query
+    club = ndb.KeyProperty(kind="Club")
 
     @property
     def active(self):
@@ -370,7 +478,7 @@ class Session(GCModel):
 
     def is_valid(self):
         # check for the update/creation.
-        course = self.course.get()
+        course = identity_map.get(self.course)
         course_type = course.course_type
         if self.session_type == "SINGLE":
             if not self.url:
@@ -395,22 +503,23 @@ class Session(GCModel):
 
     @property
     def max_level(self):
-        return self.course.get().max_level
+        return identity_map.get(self.course).max_level
 
     @property
     def profile(self):
-        return self.course.get().profile
+        return identity_map.get(self.course).profile
 
     def to_dict(self):
         result = super(Session, self).to_dict()
-        course = self.course.get().course_type
+        course = identity_map.get(self.course).course_type
         del result['course']
+        del result['club']
         del result['list_exercises']
         result['activities'] = self.get_exercises
         result['on_before'] = self.get_on_before
         result['on_after'] = self.get_on_after
         result['max_level'] =  self.max_level
-        result['profile'] =  self.course.get().profile
+        result['profile'] =  identity_map.get(self.course).profile
 
         del result['canceled']
         if self.session_type != "SINGLE":
@@ -423,27 +532,35 @@ class Session(GCModel):
             del result['day_no']
         return result
 
+    def summary_fields(self, course=None):
+        # the fields shown in the lists of sessions (see serializer.serialize), to_dict loads the exercises and the
+        # indicators
+        course_type = (course or identity_map.get(self.course)).course_type
+        fields = ['id', 'name', 'session_type', 'status']
+        if self.session_type == "SINGLE":
+            fields.append('url')
+        if course_type == "SCHEDULED":
+            fields += ['start_date', 'end_date']
+        elif course_type == "PROGRAM":
+            fields += ['week_no', 'day_no']
+        return fields
+
     def _compute_status(self):
-        if self.canceled:
-            return "CANCELED"
-        course = self.course.get().course_type
-        if course == "SCHEDULED":
-            now = datetime.now()
-            if now < self.start_date:
-                return "UPCOMING"
-            elif now > self.end_date:
-                return "FINISHED"
-        return "ONGOING"
+        course = identity_map.get(self.course).course_type
+        return session_status(self.canceled, course, self.start_date, self.end_date)
+
+    def _pre_put_hook(self):
+        super(Session, self)._pre_put_hook()
+        course = identity_map.get(self.course)
+        self.club = None if course.is_deleted else course.club
+        self.status = self._compute_status()
 
     def _post_put_hook(self, future):
         # check if startdate or and enddate are outside course time, then update course.
-        course = self.course.get()
-        if course.course_type == "SCHEDULED":
-            if self.start_date < course.start_date:
-                course.start_date = self.start_date
-            if self.end_date > course.end_date:
-                course.end_date = self.end_date
-        course.put()
+        # the course is written only if the window has to grow
+        course = identity_map.get(self.course)
+        if course.course_type == "SCHEDULED" and not course.window_contains(self.start_date, self.end_date):
+            identity_map.remember(Course.extend_window(self.course, self.start_date, self.end_date))
 
     def safe_delete(self):
         self.canceled = True
@@ -500,15 +617,7 @@ class Level(GCModel):
 
     @property
     def details(self):
-        ret = []
-        # noinspection PyTypeChecker
-        for detail in self.details_list:
-            indicator = Key(urlsafe=detail['detail']).get()
-            # we make a copy, it's direct access to it..
-            d_indicator = indicator.to_dict()
-            d_indicator['value'] = detail['value']
-            ret.append(d_indicator)
-        return ret
+        return resolve_details([self])[0]
 
     def add_detail(self, detail, value):
         # noinspection PyTypeChecker
@@ -518,13 +627,218 @@ class Level(GCModel):
         self.details_list.append(dict(detail=detail, value=value))
         # self.put()
 
-    def to_dict(self):
+    def to_dict(self, details=None):
+        # details can be passed when resolved in batch, see resolve_details
         result = super(Level, self).to_dict()
         del result['details_list']
-        result['details'] = self.details
+        result['details'] = self.details if details is None else details
         return result
 
 
+def resolve_details(levels):
+    """
+    Renders the details of many levels, loading all the distinct details with one ``get_multi``.
+
+    :param levels: list of ``Level``
+    :return: list, one for each level, of the details with their ``value``
+    """
+    ids = list(set(detail['detail'] for level in levels for detail in level.details_list))
+    details = identity_map.get_multi([Key(urlsafe=id_detail) for id_detail in ids])
+    rendered = dict((id_detail, detail.to_dict()) for id_detail, detail in zip(ids, details))
+    ret = []
+    for level in levels:
+        ret_l = []
+        for detail in level.details_list:
+            # we make a copy, the rendered detail is shared
+            d_detail = dict(rendered[detail['detail']])
+            d_detail['value'] = detail['value']
+            ret_l.append(d_detail)
+        ret.append(ret_l)
+    return ret
+
+
+class SessionMember(ndb.Model):
+    """
+    Relation index of a session, it's its child: one for each user subscribed to the course or trainer of it, with a
+    copy of the fields of the session used to list the sessions of a user in a club (see
+    ``APIDB.get_sessions_im_subscribed``). They are read only by the keys only queries and written by ``APIDB`` in
+    transactions on the session, a user is never removed.
+    """
+    # the fields copied from the session
+    session_fields = ('course', 'club', 'session_type', 'start_date', 'canceled')
+    member = ndb.KeyProperty(kind="User")
+    subscriber = ndb.BooleanProperty(default=False)
+    trainer = ndb.BooleanProperty(default=False)
+    course = ndb.KeyProperty(kind="Course")
+    club = ndb.KeyProperty(kind="Club")
+    session_type = ndb.StringProperty()
+    start_date = ndb.DateTimeProperty()
+    canceled = ndb.BooleanProperty(default=False)
+
+    @classmethod
+    def build_key(cls, user, session):
+        # one for each user and session
+        return ndb.Key(cls, _key_of(user).id(), parent=_key_of(session))
+
+    @classmethod
+    def changed(cls, before, after):
+        """
+        If the session changed in the fields copied in its members, see :py:meth:`.copy_session`.
+
+        :param before: the session before the put (``None`` if it's new)
+        :param after: the session
+        :return: ``True`` if the members have to be written
+        """
+        if before is None:
+            return True
+        return any(getattr(before, name) != getattr(after, name) for name in cls.session_fields)
+
+    def copy_session(self, session):
+        """
+        Copies the fields of the session.
+
+        :param session: the session
+        :return: ``True`` if a value changed
+        """
+        values = dict((name, getattr(session, name)) for name in self.session_fields)
+        values['canceled'] = bool(session.canceled)
+        changed = any(getattr(self, name) != value for name, value in values.iteritems())
+        self.populate(**values)
+        return changed
+
+
+TIMELINE_SIZE = 500
+
+
+class TimelineStub(ndb.Model):
+    """
+    A session in a ``Timeline``: the fields of the session shown in the lists and the data of the participation of
+    the user. The data of the course are not copied, they are rendered from the course (see :py:meth:`.to_dict`).
+    """
+    # the fields copied from the session
+    session_fields = ('name', 'url', 'session_type', 'start_date', 'end_date', 'week_no', 'day_no', 'created',
+                      'updated')
+    session = ndb.KeyProperty(kind="Session")
+    name = ndb.StringProperty()
+    url = ndb.StringProperty()
+    session_type = ndb.StringProperty()
+    start_date = ndb.DateTimeProperty()
+    end_date = ndb.DateTimeProperty()
+    week_no = ndb.IntegerProperty()
+    day_no = ndb.IntegerProperty()
+    created = ndb.DateTimeProperty()
+    updated = ndb.DateTimeProperty()
+    course = ndb.KeyProperty(kind="Course")
+    participated = ndb.BooleanProperty(default=False)
+    participation_count = ndb.IntegerProperty(default=0)
+    max_score = ndb.IntegerProperty(default=0)
+
+    @classmethod
+    def of_session(cls, session, participation=None):
+        stub = cls(session=session.key, course=session.course,
+                   **dict((name, getattr(session, name)) for name in cls.session_fields))
+        if participation:
+            stub.set_participation(participation)
+        return stub
+
+    def set_participation(self, participation):
+        # participation is a dict as the ones of APIDB.get_user_sessions_participations
+        self.populate(participated=participation['participated'],
+                      participation_count=participation['participation_count'],
+                      max_score=participation['max_completeness'])
+
+    @classmethod
+    def changed(cls, before, after):
+        """
+        If the session changed in the fields shown in the timelines, or it was canceled or detached from the club.
+        ``updated`` is not compared, it changes with every put.
+
+        :param before: the session before the put (``None`` if it's new)
+        :param after: the session
+        :return: ``True`` if the timelines have to be updated
+        """
+        if before is None:
+            return True
+        return any(getattr(before, name) != getattr(after, name)
+                   for name in cls.session_fields + ('canceled', 'club') if name != 'updated')
+
+    def status(self, course_type, now=None):
+        return session_status(False, course_type, self.start_date, self.end_date, now)
+
+    def summary_fields(self, course):
+        # the fields shown in the lists (see serializer.serialize), as Session.to_dict without the lists
+        fields = [name for name in self._properties if name not in ('session', 'course')]
+        excluded = []
+        if self.session_type != "SINGLE":
+            excluded.append('url')
+        if course.course_type != "SCHEDULED":
+            excluded += ['start_date', 'end_date']
+        if course.course_type != "PROGRAM":
+            excluded += ['week_no', 'day_no']
+        return [name for name in fields if name not in excluded]
+
+    def summary_values(self, course):
+        # the values shown in the lists that are not fields of the stub
+        return dict(id=self.session.urlsafe(), course_id=self.course.urlsafe(), course_name=course.name,
+                    status=self.status(course.course_type))
+
+    @property
+    def sort_date(self):
+        # the sessions without date are the first ones, as in the queries
+        return self.start_date or datetime.min
+
+
+class Timeline(ndb.Model):
+    """
+    The sessions of a user in a club (the ones of ``APIDB.get_sessions_im_subscribed``) as stubs ordered by start
+    date, so the session lists of the trainee app read one entity. It's written by ``APIDB`` when the sessions, the
+    subscriptions and the participations change, by deferred tasks for the sessions and the subscriptions.
+
+    It keeps the last :py:data:`TIMELINE_SIZE` sessions, the sessions that start before ``truncated_before`` may
+    be missing.
+    """
+    stubs = ndb.LocalStructuredProperty(TimelineStub, repeated=True, compressed=True)
+    truncated_before = ndb.DateTimeProperty(indexed=False)
+
+    @classmethod
+    def build_key(cls, user, club):
+        # one for user and club, as the GCModelMtoMNoRep ids
+        return ndb.Key(cls, "%s|%s" % (_key_of(user).id(), _key_of(club).id()))
+
+    def covers(self, date_from=None):
+        # if the timeline has all the sessions that start after date_from
+        if self.truncated_before is None:
+            return True
+        return date_from is not None and date_from > self.truncated_before
+
+    def find(self, session):
+        return next((stub for stub in self.stubs if stub.session == _key_of(session)), None)
+
+    def remove(self, session):
+        # True if the session was there
+        stub = self.find(session)
+        if stub is not None:
+            self.stubs.remove(stub)
+        return stub is not None
+
+    def add(self, stub):
+        self.remove(stub.session)
+        stubs = self.stubs
+        i = len(stubs)
+        while i > 0 and stubs[i - 1].sort_date > stub.sort_date:
+            i -= 1
+        stubs.insert(i, stub)
+        while len(stubs) > TIMELINE_SIZE:
+            dropped = stubs.pop(0)
+            self.truncated_before = max(self.truncated_before or datetime.min, dropped.sort_date)
+
+    def select(self, date_from=None, date_to=None, session_type=None):
+        return [stub for stub in self.stubs
+                if (date_from is None or stub.start_date is not None and stub.start_date >= date_from) and
+                (date_to is None or stub.start_date is not None and stub.start_date <= date_to) and
+                (not session_type or stub.session_type == session_type)]
+
+
 class TimeData(GCModel):
     join = ndb.DateTimeProperty()
     leave = ndb.DateTimeProperty()
@@ -539,97 +853,274 @@ class TimeData(GCModel):
         return dict(join=date_to_js_timestamp(self.join), leave=date_to_js_timestamp(self.leave))
 
 
-class Participation(GCModel):
+def _key_of(obj):
+    # the key of an entity, or the key itself
+    if isinstance(obj, ndb.Model):
+        return obj.key
+    return obj
+
+
+def resolve_indicators(objects):
+    """
+    Renders the indicators of many participations or performances. All the distinct indicators are loaded
+    with one ``get_multi`` and rendered once.
+
+    :param objects: list of ``Participation`` or ``Performance``
+    :return: list, one for each object, of lists of indicators with their ``value``
+    """
+    rows = [obj.indicator_rows() for obj in objects]
+    ids = list(set(id_indicator for obj_rows in rows for row in obj_rows for id_indicator, _ in row))
+    indicators = identity_map.get_multi([ndb.Key(Indicator, id_indicator) for id_indicator in ids])
+    rendered = dict((id_indicator, indicator.to_dict()) for id_indicator, indicator in zip(ids, indicators))
+    ret = []
+    for obj_rows in rows:
+        ret_obj = []
+        for row in obj_rows:
+            ret_i = []
+            for id_indicator, value in row:
+                # we make a copy, the rendered indicator is shared
+                d_indicator = dict(rendered[id_indicator])
+                d_indicator['value'] = value
+                ret_i.append(d_indicator)
+            ret_obj.append(ret_i)
+        ret.append(ret_obj)
+    return ret
+
+
+def encode_indicators(attempts):
+    """
+    Encodes the indicators of the attempts in columns: the integer ids of the indicators, their values and, for
+    each attempt, the position of its first indicator.
+
+    :param attempts: list, one for each attempt, of lists of dicts with ``id`` (urlsafe) and ``value``
+    :return: tuple ids, values, offsets
+    """
+    ids, values, offsets = [], [], []
+    for inds in attempts:
+        offsets.append(len(ids))
+        for ind in inds:
+            try:
+                id_indicator = Key(urlsafe=ind['id']).id()
+            except Exception:
+                id_indicator = None
+            if not isinstance(id_indicator, (int, long)):
+                raise BadParameters("Indicator: %s is not valid" % ind['id'])
+            ids.append(id_indicator)
+            values.append(ind['value'])
+    return ids, values, offsets
+
+
+class IndicatorColumns(object):
+    """
+    Access to the indicators of each attempt, stored with :py:func:`encode_indicators` in ``indicator_ids``,
+    ``indicator_values`` and ``indicator_offsets``.
+    The entities written before the encoding have the pickled list in ``legacy_indicator_list``
+    (see ``tasks.migrate_indicators``).
+    """
+
+    def indicator_rows(self):
+        """
+        :return: list, one for each attempt, of lists of ``(id of the indicator, value)``
+        """
+        if self.legacy_indicator_list is not None:
+            return [[(Key(urlsafe=ind['id']).id(), ind['value']) for ind in inds]
+                    for inds in self.legacy_indicator_list]
+        ends = self.indicator_offsets[1:] + [len(self.indicator_ids)]
+        return [zip(self.indicator_ids[start:end], self.indicator_values[start:end])
+                for start, end in zip(self.indicator_offsets, ends)]
+
+    @property
+    def indicator_list(self):
+        # the format of the uploads: list, one for each attempt, of lists of dicts with id (urlsafe) and value
+        if self.legacy_indicator_list is not None:
+            return self.legacy_indicator_list
+        urlsafe = dict((id_indicator, ndb.Key(Indicator, id_indicator).urlsafe())
+                       for id_indicator in set(self.indicator_ids))
+        return [[dict(id=urlsafe[id_indicator], value=value) for id_indicator, value in row]
+                for row in self.indicator_rows()]
+
+    @indicator_list.setter
+    def indicator_list(self, attempts):
+        self.indicator_ids, self.indicator_values, self.indicator_offsets = encode_indicators(attempts)
+        self.legacy_indicator_list = None
+
+    def add_indicators(self, indicators):
+        # the caller stores the entity, once.
+        if self.legacy_indicator_list is not None:
+            # the first write after the encoding converts the whole list
+            self.indicator_list = self.legacy_indicator_list + [indicators]
+            return
+        ids, values, _ = encode_indicators([indicators])
+        # new lists, the default of the JsonProperty is shared
+        self.indicator_offsets = self.indicator_offsets + [len(self.indicator_ids)]
+        self.indicator_ids = self.indicator_ids + ids
+        self.indicator_values = self.indicator_values + values
+
+    @property
+    def indicators(self):
+        return resolve_indicators([self])[0]
+
+
+# number of attempts kept in Participation and Performance, the older ones are moved to ParticipationAttempt
+HISTORY_SIZE = 10
+
+
+class ParticipationAttempt(ndb.Model):
+    # an old attempt of a Participation or a Performance (the parent), see AttemptHistory
+    number = ndb.IntegerProperty(required=True)
+    completeness = ndb.IntegerProperty(indexed=False)
+    # only for participations
+    time = ndb.LocalStructuredProperty(TimeData)
+    # only for performances
+    record_date = ndb.DateTimeProperty(indexed=False)
+    # list of dicts with id (urlsafe) and value
+    indicators = ndb.JsonProperty()
+
+
+class AttemptHistory(object):
+    """
+    Keeps in the entity only the last ``HISTORY_SIZE`` attempts, the older ones are moved to
+    :py:class:`ParticipationAttempt` children and loaded only when the whole history is needed.
+    """
+    # (name of the list in the entity, name of the field in ParticipationAttempt)
+    _attempt_lists = ()
+
+    def compact_history(self):
+        """
+        Moves the old attempts out of the entity. The entity must have its key.
+
+        :return: the ``ParticipationAttempt`` to store together with the entity
+        """
+        extra = len(self.completeness) - HISTORY_SIZE
+        if extra <= 0:
+            return []
+        attempts = []
+        for i in range(extra):
+            number = (self.spilled_count or 0) + i + 1
+            attempt = ParticipationAttempt(parent=self.key, id=number, number=number)
+            for name, field in self._attempt_lists:
+                values = getattr(self, name)
+                if i < len(values):
+                    setattr(attempt, field, values[i])
+            attempts.append(attempt)
+        self.best_completeness = max(self.completeness[:extra] + [self.best_completeness or 0])
+        for name, _ in self._attempt_lists:
+            setattr(self, name, getattr(self, name)[extra:])
+        self.spilled_count = (self.spilled_count or 0) + extra
+        return attempts
+
+    def with_history(self, attempts):
+        """
+        Copy of the entity with all the attempts, it can't be stored.
+
+        :param attempts: the ``ParticipationAttempt`` of the entity, sorted by number
+        :return: the copy
+        """
+        full = self.__class__(key=self.key)
+        full.populate(**dict((prop._code_name, getattr(self, prop._code_name))
+                             for prop in self._properties.itervalues() if not isinstance(prop, ndb.ComputedProperty)))
+        for name, field in self._attempt_lists:
+            setattr(full, name, [getattr(attempt, field) for attempt in attempts] + getattr(self, name))
+        full._full_history = True
+        return full
+
+    def _pre_put_hook(self):
+        if getattr(self, '_full_history', False):
+            raise ServerError("The entity with the whole history can't be stored")
+        super(AttemptHistory, self)._pre_put_hook()
+
+    @property
+    def max_completeness(self):
+        return max(self.completeness + [self.best_completeness or 0])
+
+
+class Participation(AttemptHistory, IndicatorColumns, GCModel):
     session = ndb.KeyProperty(kind="Session", required=True)
     user = ndb.KeyProperty(kind="User", required=True)
     level = ndb.IntegerProperty()
     time = ndb.StructuredProperty(TimeData, repeated=True)
     completeness = ndb.IntegerProperty(repeated=True)
     # when = ndb.DateTimeProperty(repeated=True)
-    # this is a list of list, as for completeness it is updated everytime
-    indicator_list = ndb.PickleProperty(default=[])
+    # this is a list of list, as for completeness it is updated everytime, see IndicatorColumns
+    indicator_ids = ndb.IntegerProperty(repeated=True)
+    indicator_values = ndb.JsonProperty(default=[])
+    indicator_offsets = ndb.IntegerProperty(repeated=True, indexed=False)
+    legacy_indicator_list = ndb.PickleProperty('indicator_list')
+    # attempts moved to ParticipationAttempt and their max completeness
+    spilled_count = ndb.IntegerProperty(default=0, indexed=False)
+    best_completeness = ndb.IntegerProperty(indexed=False)
+
+    _attempt_lists = (('time', 'time'), ('completeness', 'completeness'), ('indicator_list', 'indicators'))
+
+    @classmethod
+    def build_key(cls, user, session, level):
+        # one participation for user, session and level, as the GCModelMtoMNoRep ids
+        return ndb.Key(cls, "%s|%s|%s" % (_key_of(user).id(), _key_of(session).id(), level))
+
+    @classmethod
+    def keys_of_session(cls, user, session, user_level=None):
+        # the keys of all the possible participations of the user: one for each level of the course and one for the
+        # current level of the user, that can be higher. None if the levels of the course are not known, the
+        # participation may be stored at an old level of the user
+        if not session.max_level:
+            return None
+        levels = set(range(1, session.max_level + 1))
+        if user_level:
+            levels.add(user_level)
+        return [cls.build_key(user, session, level) for level in sorted(levels)]
 
     @classmethod
     def get_by_data(cls, user, session, level=None):
         # gets the participation by its data
-        query = cls.query(
-            ndb.AND(cls.session == session.key,
-                    cls.user == user.key))
         if level:
-            query = query.filter(cls.level == level)
-        res = query.get()
-        # if there's more then return the last one.
-        if isinstance(res, list):
-            if res:
-                return res[-1]
-        return res
+            return cls.build_key(user, session, level).get()
+        subscription = CourseSubscription.get_by_id(user, session.course)
+        keys = cls.keys_of_session(user, session, subscription.profile_level if subscription else None)
+        if keys is None:
+            return cls.query(cls.session == session.key, cls.user == user.key).get()
+        # the one with the lowest level
+        return next((participation for participation in ndb.get_multi(keys) if participation), None)
 
     @property
     def participation_count(self):
         # noinspection PyTypeChecker
-        return len(self.time)
-
-    @property
-    def indicators(self):
-        ret = []
-        # noinspection PyTypeChecker
-        for inds in self.indicator_list:
-            ret_i = []
-            for ind in inds:
-                indicator = Key(urlsafe=ind['id']).get()
-                # we make a copy, it's direct access to it..
-                d_indicator = indicator.to_dict()
-                d_indicator['value'] = ind['value']
-                ret_i.append(d_indicator)
-            ret.append(ret_i)
-        return ret
+        return len(self.time) + (0 if getattr(self, '_full_history', False) else self.spilled_count or 0)
 
-    def add_indicators(self, indicators):
-        self.indicator_list.append(indicators)
-        self.put()
-
-    @property
-    def max_completeness(self):
-        return max(self.completeness)
 
 
-class Performance(GCModelMtoMNoRep):
+class Performance(AttemptHistory, IndicatorColumns, GCModelMtoMNoRep):
     activity = ndb.KeyProperty(kind="Exercise", required=True)
     participation = ndb.KeyProperty(kind="Participation", required=True)
     level = ndb.IntegerProperty()
     record_date = ndb.DateTimeProperty(repeated=True)
     completeness = ndb.IntegerProperty(repeated=True)
-    indicator_list = ndb.PickleProperty(default=[])
+    # this is a list of list, as for completeness it is updated everytime, see IndicatorColumns
+    indicator_ids = ndb.IntegerProperty(repeated=True)
+    indicator_values = ndb.JsonProperty(default=[])
+    indicator_offsets = ndb.IntegerProperty(repeated=True, indexed=False)
+    legacy_indicator_list = ndb.PickleProperty('indicator_list')
+    # attempts moved to ParticipationAttempt and their max completeness
+    spilled_count = ndb.IntegerProperty(default=0, indexed=False)
+    best_completeness = ndb.IntegerProperty(indexed=False)
+
+    _attempt_lists = (('record_date', 'record_date'), ('completeness', 'completeness'),
+                      ('indicator_list', 'indicators'))
 
-    @property
-    def indicators(self):
-        ret = []
-        # noinspection PyTypeChecker
-        for inds in self.indicator_list:
-            ret_i = []
-            for ind in inds:
-                indicator = Key(urlsafe=ind['id']).get()
-                # we make a copy, it's direct access to it..
-                d_indicator = indicator.to_dict()
-                d_indicator['value'] = ind['value']
-                ret_i.append(d_indicator)
-            ret.append(ret_i)
-        return ret
-
-    def add_indicators(self, indicators):
-        self.indicator_list.append(indicators)
-        self.put()
+    @classmethod
+    def build_key(cls, participation, activity, level):
+        # one performance for participation, activity and level
+        return ndb.Key(cls, "%s|%s|%s" % (_key_of(participation).id(), _key_of(activity).id(), level))
 
-    @property
-    def max_completeness(self):
-        return max(self.completeness)
 
     def to_dict(self):
         d = super(Performance, self).to_dict()
         d['record_date'] = [date_to_js_timestamp(data) for data in self.record_date]
         d['indicators'] = self.indicators
         d['max_completeness']=self.max_completeness
-        del d['indicator_list']
+        for prop in ('indicator_ids', 'indicator_values', 'indicator_offsets', 'legacy_indicator_list'):
+            del d[prop]
+        del d['spilled_count']
+        del d['best_completeness']
         return d
 
 
@@ -675,11 +1166,14 @@ class Exercise(GCModel):
         # noinspection PyTypeChecker
         return len(self.indicator_list)
 
-    def to_dict(self):
+    def to_dict(self, details=None):
+        # details can be passed when resolved in batch, see exercises_to_dict
         result = super(Exercise, self).to_dict()
+        if details is None:
+            details = resolve_details(self.levels)
         levels = []
-        for level in self.levels:
-            levels.append(level.to_dict())
+        for level, level_details in zip(self.levels, details):
+            levels.append(level.to_dict(level_details))
         result['levels'] = levels
         result['level_count'] = self.level_count
         result['indicator_count'] = self.indicator_count
@@ -692,6 +1186,23 @@ class Exercise(GCModel):
         # result['list_levels'] = [l.to_dict() for l in self.list_levels]
         # return result
 
+
+def exercises_to_dict(exercises):
+    """
+    Renders many exercises, resolving the details of all their levels with one ``get_multi``.
+
+    :param exercises: list of ``Exercise``
+    :return: list of dicts, as ``Exercise.to_dict``
+    """
+    details = resolve_details([level for exercise in exercises for level in exercise.levels])
+    ret = []
+    start = 0
+    for exercise in exercises:
+        end = start + len(exercise.levels)
+        ret.append(exercise.to_dict(details[start:end]))
+        start = end
+    return ret
+
 class Room(GCModel):
     name = ndb.StringProperty(required=True)
     room_type = ndb.StringProperty(required=True)
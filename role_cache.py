@@ -0,0 +1,183 @@
+"""
+Cache of what :py:func:`auth.user_has_role` needs to check the roles: the relations between a user and a club or a
+course (``ClubMembership``, ``CourseSubscription``, ``CourseTrainers``) and the parents of the objects (the course
+of a session, the club of a course).
+
+The values are kept in memory by the instance for :py:data:`INSTANCE_TTL` seconds and in memcache for
+:py:data:`MEMCACHE_TTL` seconds, so a role check usually costs no RPC. ``APIDB`` calls :py:func:`invalidate`
+after writing a relation. :py:func:`prefetch_async` lets ``GCApp.edit_request`` load the relation while it loads
+the object of the request.
+
+.. note::
+
+    the memory of the other instances is not invalidated, they can use the old relation for
+    :py:data:`INSTANCE_TTL` seconds.
+"""
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import ClubMembership, CourseSubscription, CourseTrainers
+
+
+__author__ = 'stefano tranquillini'
+
+MEMCACHE_PREFIX = "role:"
+MEMCACHE_TTL = 60
+INSTANCE_TTL = 10
+# after an invalidation memcache refuses the value for this time
+LOCK_SECONDS = 5
+# when there are more entries the memory of the instance is emptied
+INSTANCE_SIZE = 5000
+
+# name -> (expiration, value)
+_instance = {}
+
+
+def clear():
+    """
+    Empties the memory of the instance.
+    """
+    _instance.clear()
+
+
+def _key_of(obj):
+    if isinstance(obj, ndb.Model):
+        return obj.key
+    return obj
+
+
+def _relation_key(model, user, target):
+    return ndb.Key(model, model.build_id(_key_of(user), _key_of(target)))
+
+
+def _name(key, *parts):
+    return ":".join([MEMCACHE_PREFIX + key.kind(), str(key.id())] + list(parts))
+
+
+@ndb.tasklet
+def _cached_async(name, load):
+    now = time.time()
+    hit = _instance.get(name)
+    if hit is not None and hit[0] > now:
+        raise ndb.Return(hit[1])
+    ctx = ndb.get_context()
+    value = yield ctx.memcache_get(name)
+    if value is None:
+        # memcache can't store None, a missing relation is ()
+        value = yield load()
+        yield ctx.memcache_add(name, value, time=MEMCACHE_TTL)
+    if len(_instance) >= INSTANCE_SIZE:
+        _instance.clear()
+    _instance[name] = (now + INSTANCE_TTL, value)
+    raise ndb.Return(value)
+
+
+@ndb.tasklet
+def club_membership_async(user, club):
+    """
+    Async version of :py:func:`club_membership`.
+
+    :return: the future
+    """
+    key = _relation_key(ClubMembership, user, club)
+
+    @ndb.tasklet
+    def load():
+        rel = yield key.get_async()
+        raise ndb.Return((rel.membership_type, rel.is_active) if rel else ())
+
+    value = yield _cached_async(_name(key), load)
+    raise ndb.Return(value or None)
+
+
+def club_membership(user, club):
+    """
+    Gets the membership of the user in the club.
+
+    :param user: the user (or its key)
+    :param club: the club (or its key)
+    :return: tuple ``(membership_type, is_active)`` or ``None`` if the user is not in the club
+    """
+    return club_membership_async(user, club).get_result()
+
+
+@ndb.tasklet
+def course_relation_async(model, user, course):
+    """
+    Async version of :py:func:`course_relation`.
+
+    :return: the future
+    """
+    key = _relation_key(model, user, course)
+
+    @ndb.tasklet
+    def load():
+        rel = yield key.get_async()
+        raise ndb.Return((rel.is_active,) if rel else ())
+
+    value = yield _cached_async(_name(key), load)
+    raise ndb.Return(value[0] if value else None)
+
+
+def course_relation(model, user, course):
+    """
+    Gets the subscription or the trainer relation of the user to the course.
+
+    :param model: ``CourseSubscription`` or ``CourseTrainers``
+    :param user: the user (or its key)
+    :param course: the course (or its key)
+    :return: ``is_active`` of the relation or ``None`` if there's no relation
+    """
+    return course_relation_async(model, user, course).get_result()
+
+
+def parent(obj, prop):
+    """
+    Gets the key of the parent of an object, e.g. the course of a session. The parents never change.
+
+    :param obj: the object (or its key)
+    :param prop: the name of the property that has the parent (``course``, ``club``)
+    :return: the key of the parent
+    """
+    if isinstance(obj, ndb.Model):
+        return getattr(obj, prop)
+
+    @ndb.tasklet
+    def load():
+        entity = yield obj.get_async()
+        raise ndb.Return(getattr(entity, prop))
+
+    return _cached_async(_name(obj, prop), load).get_result()
+
+
+def prefetch_async(user, key, coach):
+    """
+    Starts loading the relation that the role check of the object will probably need. It's used by
+    ``GCApp.edit_request`` while the object is loaded.
+
+    :param user: the user
+    :param key: the key of the object of the request
+    :param coach: if it's a request of the coach app (the courses check the trainers instead of the subscribers)
+    :return: the future, ``None`` if the relation can't be known from the key
+    """
+    if key.kind() == 'Club':
+        return club_membership_async(user, key)
+    if key.kind() == 'Course':
+        return course_relation_async(CourseTrainers if coach else CourseSubscription, user, key)
+    return None
+
+
+def invalidate(relation):
+    """
+    Removes a relation from the cache, it's called after the relation is written.
+
+    :param relation: ``ClubMembership``, ``CourseSubscription`` or ``CourseTrainers``
+    """
+    if not isinstance(relation, (ClubMembership, CourseSubscription, CourseTrainers)) or relation.key is None:
+        return
+    name = _name(relation.key)
+    _instance.pop(name, None)
+    # the lock stops the requests that read the old relation from adding it back
+    memcache.delete(name, seconds=LOCK_SECONDS)
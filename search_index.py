@@ -0,0 +1,124 @@
+"""
+Batched maintenance of the search documents of ``User`` and ``Club``.
+
+The ``_post_put_hook`` of the models does not write the search index anymore, it adds the id of the entity to the
+``search-index`` pull queue (see ``queue.yaml``) and only if one of the indexed fields changed (see
+:py:func:`fields_hash`). :py:func:`drain`, called by the cron job ``/api/admin/search-index``, leases the ids,
+loads the entities with one ``get_multi`` and writes up to :py:data:`BATCH_SIZE` documents with one ``Index.put``.
+The hash is stored in the entity by :py:func:`drain` once the document is written, so an entity whose add to the
+queue failed is queued again by its next put.
+
+The search and task queue apis are imported by the functions, the module is imported by ``models`` in every
+instance.
+"""
+import hashlib
+import logging
+
+from google.appengine.ext import ndb
+from google.appengine.ext.ndb.key import Key
+
+
+__author__ = 'stefano tranquillini'
+
+QUEUE_NAME = "search-index"
+# max number of documents of Index.put
+BATCH_SIZE = 200
+LEASE_SECONDS = 60
+
+
+def fields_hash(fields):
+    """
+    Hash of the values of the indexed fields, stored in the entity when its document is written (see
+    :py:func:`store_hashes`) to skip the reindex when nothing changed.
+
+    :param fields: list of ``(name, value)``
+    :return: the hash
+    """
+    return hashlib.sha1(repr([(name, unicode(value or "")) for name, value in fields])).hexdigest()
+
+
+def document(doc_id, fields):
+    """
+    Builds the search document.
+
+    :param doc_id: the id of the document (the id of the entity)
+    :param fields: list of ``(name, value)``
+    :return: the document
+    """
+    from google.appengine.api import search
+    return search.Document(doc_id=doc_id,
+                           fields=[search.TextField(name=name, value=value) for name, value in fields])
+
+
+def enqueue(index_name, entity):
+    """
+    Marks the entity as to be reindexed. The add is async, it's completed at the end of the request.
+
+    :param index_name: the name of the index (``users`` or ``clubs``)
+    :param entity: the entity
+    """
+    from google.appengine.api import taskqueue
+    taskqueue.Queue(QUEUE_NAME).add_async(taskqueue.Task(payload=entity.id, method='PULL', tag=index_name))
+
+
+def store_hashes(hashes):
+    """
+    Stores the hashes of the fields of the documents just written in their entities, each one in its transaction,
+    all in parallel. An entity that changed after it was read keeps its hash, its put queued it again.
+
+    :param hashes: dict key of the entity -> hash of the fields of its document
+    """
+
+    @ndb.tasklet
+    def txn(key, search_hash):
+        entity = yield key.get_async()
+        if entity is not None and entity.search_hash != search_hash and \
+                fields_hash(entity.search_fields()) == search_hash:
+            entity.search_hash = search_hash
+            yield entity.put_async()
+
+    futures = [ndb.transaction_async(lambda key=key, search_hash=search_hash: txn(key, search_hash))
+               for key, search_hash in hashes.iteritems()]
+    ndb.Future.wait_all(futures)
+    for key, future in zip(hashes, futures):
+        if future.get_exception():
+            # the next put of the entity queues it again
+            logging.warning("search index: hash of %s not stored", key)
+
+
+def drain(index_name, batch_size=BATCH_SIZE):
+    """
+    Reindexes the entities that are in the queue for the index, in batches.
+
+    :param index_name: the name of the index (``users`` or ``clubs``)
+    :param batch_size: the max number of documents for each ``Index.put``
+    :return: the number of documents written
+    """
+    from google.appengine.api import search
+    from google.appengine.api import taskqueue
+    queue = taskqueue.Queue(QUEUE_NAME)
+    index = search.Index(name=index_name)
+    total = 0
+    while True:
+        tasks = queue.lease_tasks_by_tag(LEASE_SECONDS, batch_size, tag=index_name)
+        if not tasks:
+            return total
+        # the same entity may be in the queue more than once.
+        ids = list(set(task.payload for task in tasks))
+        documents = []
+        hashes = dict()
+        for entity in ndb.get_multi([Key(urlsafe=id_entity) for id_entity in ids]):
+            if entity is not None:
+                fields = entity.search_fields()
+                documents.append(document(entity.id, fields))
+                hashes[entity.key] = fields_hash(fields)
+        if documents:
+            try:
+                index.put(documents)
+            except search.Error:
+                # the tasks are leased again when the lease expires
+                logging.exception("search index %s: put failed", index_name)
+                return total
+            store_hashes(hashes)
+        queue.delete_tasks(tasks)
+        total += len(documents)
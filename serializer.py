@@ -0,0 +1,93 @@
+"""
+Single pass serialization of the list responses.
+
+:py:meth:`app.GCApp.edit_response` applies ``camel_case`` to the whole response, after the handler has built the
+items with ``to_dict`` and filtered them with ``sanitize_json``, so every item is copied three times. The list
+endpoints use :py:func:`serialize` instead: it reads only the allowed fields of the model and writes them with their
+camelCase keys, taken from the field map of the model (see :py:func:`field_map`), in a single dict. The endpoints
+return a :py:func:`response`, which ``edit_response`` returns as it is.
+
+The camelCase of each key is computed once by ``camel_case`` and kept, so the output is the same as before.
+"""
+from gaebasepy.gc_utils import camel_case
+
+
+__author__ = 'stefano tranquillini'
+
+# snake_case -> camelCase
+_keys = {}
+# model class -> field map
+_field_maps = {}
+
+
+class Serialized(dict):
+    """
+    A dict whose keys, also the nested ones, are already in camelCase.
+    """
+    pass
+
+
+def camel_key(name):
+    """
+    The camelCase of a key, as ``camel_case`` does it.
+
+    :param name: the key
+    :return: the key in camelCase
+    """
+    try:
+        return _keys[name]
+    except KeyError:
+        key = _keys[name] = camel_case({name: None}).keys()[0]
+        return key
+
+
+def field_map(model):
+    """
+    The camelCase keys of the fields of a model, computed the first time the model is serialized.
+
+    :param model: the model class
+    :return: dict field name -> camelCase key
+    """
+    try:
+        return _field_maps[model]
+    except KeyError:
+        fields = _field_maps[model] = dict((name, camel_key(name)) for name in list(model._properties) + ['id'])
+        return fields
+
+
+def _value(value):
+    if isinstance(value, Serialized):
+        return value
+    if isinstance(value, list):
+        return [_value(item) for item in value]
+    if isinstance(value, dict):
+        return Serialized((camel_key(key), _value(item)) for key, item in value.iteritems())
+    return value
+
+
+def serialize(entity, fields, **values):
+    """
+    The camelCase dict of the fields of an entity, it's what ``camel_case(sanitize_json(entity.to_dict(),
+    allowed=fields))`` returns for the scalar fields, without the intermediate dicts.
+
+    :param entity: the entity
+    :param fields: the names of the fields (the properties and ``id``)
+    :param values: other values of the item, e.g. the counts (the dicts are converted too)
+    :return: the ``Serialized`` dict
+    """
+    keys = field_map(type(entity))
+    result = Serialized((keys.get(name) or camel_key(name), getattr(entity, name)) for name in fields)
+    for name, value in values.iteritems():
+        result[camel_key(name)] = _value(value)
+    return result
+
+
+def response(**values):
+    """
+    The response of a list endpoint, ``GCApp.edit_response`` doesn't apply ``camel_case`` to it.
+
+    :param values: the values of the response (``results``, ``total``, the cursors), the items of ``results``
+        are built with :py:func:`serialize`
+    :return: the ``Serialized`` response
+    """
+    return _value(values)
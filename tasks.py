@@ -1,11 +1,13 @@
 import json
 import logging
 import logging.config
-from google.appengine.api import urlfetch
+from google.appengine.ext import ndb
 import cfg
+from gaebasepy.exceptions import BadParameters
 from gaebasepy.gc_utils import camel_case, json_serializer, sanitize_json
 
 import models
+from api_db_utils import APIDB
 
 
 __author__ = 'Stefano Tranquillini <stefano.tranquillini@gmail.com>'
@@ -13,8 +15,20 @@ __author__ = 'Stefano Tranquillini <stefano.tranquillini@gmail.com>'
 # logging.config.fileConfig('logging.conf')
 # logger = logging.getLogger('myLogger')
 
+def defer(fn, *args, **kwargs):
+    """
+    ``deferred.defer``, deferred (and the task queue api) is imported only when a task is queued.
+
+    :param fn: the function to run in the task
+    :return: the task
+    """
+    from google.appengine.ext import deferred
+    return deferred.defer(fn, *args, **kwargs)
+
+
 def sync_user(user,token):
-    
+    from google.appengine.api import urlfetch
+
     url = "https://gcrt3.herokuapp.com/sync?pass=6sWreKWwYJwNbpBPYY3Ggfvqeaw48B4PSCQXcpj3WrsYrDqZt3ykTDAYqVD88hMC"
     d = user.to_dict()
     # user_id = user.get_id()
@@ -28,4 +42,221 @@ def sync_user(user,token):
     result = urlfetch.fetch(url=url,
                             payload=data,
                             method=urlfetch.POST,
-                            headers={'Content-Type': 'application/json'})
\ No newline at end of file
+                            headers={'Content-Type': 'application/json'})
+
+def _values(entity):
+    # the values of the stored properties, to copy the entity
+    return dict((prop._code_name, getattr(entity, prop._code_name)) for prop in entity._properties.itervalues()
+                if not isinstance(prop, ndb.ComputedProperty))
+
+
+def _history(entity):
+    # the attempts of a Participation or a Performance, also the ones moved to ParticipationAttempt, as dicts
+    full = APIDB.get_attempts_history([entity])[0]
+    lists = [(name, getattr(full, name)) for name, _ in entity._attempt_lists]
+    return [dict((name, values[i] if i < len(values) else ([] if name == 'indicator_list' else None))
+                 for name, values in lists)
+            for i in range(len(full.completeness))]
+
+
+def _rekey(entity, key, date):
+    """
+    Moves the entity to the new key, with its ``ParticipationAttempt`` (see ``models.AttemptHistory``). If there's
+    already an entity with that key, the whole histories of the two are merged by date and compacted again under the
+    new key, the old attempts are deleted.
+
+    :param entity: the ``Participation`` or the ``Performance``
+    :param key: the new key
+    :param date: function that returns the date of an attempt, from the dict of its values
+    :return: the new entity
+    """
+
+    @ndb.transactional(xg=True)
+    def txn():
+        target = key.get()
+        old = models.ParticipationAttempt.query(ancestor=entity.key).fetch()
+        if target is None:
+            merged = entity.__class__(key=key, **_values(entity))
+            spilled = [models.ParticipationAttempt(parent=key, id=attempt.key.id(), **_values(attempt))
+                       for attempt in old]
+            to_delete = [attempt.key for attempt in old]
+        else:
+            # sorted is stable, the attempts with the same date keep their order
+            attempts = sorted(_history(target) + _history(entity), key=date)
+            merged = entity.__class__(key=key, **_values(target))
+            # indicator_list is not a list property, it's encoded when it's set
+            for name, _ in merged._attempt_lists:
+                setattr(merged, name, [attempt[name] for attempt in attempts])
+            merged.spilled_count = 0
+            merged.best_completeness = None
+            spilled = merged.compact_history()
+            new_keys = set(attempt.key for attempt in spilled)
+            to_delete = [attempt.key for attempt in old] + [
+                attempt_key for attempt_key in models.ParticipationAttempt.query(ancestor=key).fetch(keys_only=True)
+                if attempt_key not in new_keys]
+        ndb.put_multi([merged] + spilled)
+        ndb.delete_multi(to_delete + [entity.key])
+        return merged
+
+    return txn()
+
+
+def sync_course_relations(course_key):
+    """
+    Copies the fields of the course to its relations (see ``APIDB.sync_course_relations``), queued by
+    ``models.Course.extend_window`` when the course time grows and by ``APIDB`` when a large course is updated or
+    deleted.
+
+    :param course_key: the key of the course
+    """
+    APIDB.sync_course_relations(course_key.get())
+
+
+def fan_out_sessions(session_keys):
+    """
+    Writes the sessions in the timelines of the subscribers of their courses (see
+    ``APIDB.fan_out_to_timelines``), queued when the sessions are created and when they change.
+
+    :param session_keys: the keys of the sessions
+    """
+    APIDB.fan_out_to_timelines([session for session in ndb.get_multi(session_keys) if session])
+
+
+def index_sessions(session_keys):
+    """
+    Writes the ``SessionMember`` of the sessions (see ``APIDB.put_session_indexes``), queued by
+    ``APIDB.index_sessions`` for the sessions of the large courses. The sessions are read when the task runs, so the
+    members get their last values.
+
+    :param session_keys: the keys of the sessions
+    """
+    APIDB.put_session_indexes([session for session in ndb.get_multi(session_keys) if session])
+
+
+def add_to_session_indexes(user_key, course_key, field):
+    """
+    Adds the user to the ``SessionMember`` of the sessions of the course (see ``APIDB.add_to_session_indexes``),
+    queued when the user subscribes to the course or becomes a trainer of it.
+
+    :param user_key: the key of the user
+    :param course_key: the key of the course
+    :param field: ``subscribers`` or ``trainers``
+    """
+    APIDB.add_to_session_indexes(course_key.get(), user_key.get(), field)
+
+
+def detach_course_sessions(course_key):
+    """
+    Removes the sessions of the deleted course from the lists of the club (see ``APIDB.detach_course_sessions``),
+    queued when the course is deleted.
+
+    :param course_key: the key of the course
+    """
+    APIDB.detach_course_sessions(course_key.get())
+
+
+def add_course_to_timeline(user_key, course_key):
+    """
+    Adds the sessions of the course to the timeline of the user (see ``APIDB.add_course_to_timeline``), queued
+    when the user subscribes to the course.
+
+    :param user_key: the key of the user
+    :param course_key: the key of the course
+    """
+    APIDB.add_course_to_timeline(user_key.get(), course_key.get())
+
+
+def migrate_participation_keys(cursor=None, batch_size=50):
+    """
+    Moves the participations and the performances to the deterministic keys (see ``Participation.build_key`` and
+    ``Performance.build_key``). It runs as a chain of deferred tasks, started by ``/api/admin/migrate-participations``.
+
+    :param cursor: where to start
+    :param batch_size: the number of participations for each task
+    """
+    participations, cursor, more = models.Participation.query().fetch_page(batch_size, start_cursor=cursor)
+    for participation in participations:
+        key = models.Participation.build_key(participation.user, participation.session, participation.level)
+        performances = models.Performance.query(models.Performance.participation == participation.key).fetch()
+        for performance in performances:
+            performance.participation = key
+            performance_key = models.Performance.build_key(key, performance.activity, performance.level)
+            if performance.key != performance_key:
+                _rekey(performance, performance_key, lambda attempt: attempt['record_date'])
+            else:
+                performance.put()
+        if participation.key != key:
+            _rekey(participation, key, lambda attempt: attempt['time'] and attempt['time'].join)
+    logging.info("participations migrated: %s", len(participations))
+    if more:
+        defer(migrate_participation_keys, cursor, batch_size)
+
+
+def migrate_indicators(kind="Participation", cursor=None, batch_size=100):
+    """
+    Encodes the pickled ``indicator_list`` of the participations and the performances in the columns of
+    ``models.IndicatorColumns``. It runs as a chain of deferred tasks, first on the participations then on the
+    performances, started by ``/api/admin/migrate-indicators``.
+
+    :param kind: ``Participation`` or ``Performance``
+    :param cursor: where to start
+    :param batch_size: the number of entities for each task
+    """
+    model = getattr(models, kind)
+    entities, cursor, more = model.query().fetch_page(batch_size, start_cursor=cursor)
+    to_put = []
+    for entity in entities:
+        if entity.legacy_indicator_list is None:
+            continue
+        try:
+            entity.indicator_list = entity.legacy_indicator_list
+        except BadParameters:
+            # it's left pickled, it's still readable
+            logging.warning("%s %s: indicators not valid", kind, entity.key)
+            continue
+        to_put.append(entity)
+    ndb.put_multi(to_put)
+    logging.info("%s indicators migrated: %s", kind, len(to_put))
+    if more:
+        defer(migrate_indicators, kind, cursor, batch_size)
+    elif kind == "Participation":
+        defer(migrate_indicators, "Performance", None, batch_size)
+
+
+def migrate_course_relations(kind="CourseSubscription", cursor=None, batch_size=100):
+    """
+    Copies the fields of the courses in the subscriptions and in the trainers (see ``models.CourseRelation``).
+    It runs as a chain of deferred tasks, first on the subscriptions then on the trainers, started by
+    ``/api/admin/migrate-course-relations``.
+
+    :param kind: ``CourseSubscription`` or ``CourseTrainers``
+    :param cursor: where to start
+    :param batch_size: the number of relations for each task
+    """
+    model = getattr(models, kind)
+    relations, cursor, more = model.query().fetch_page(batch_size, start_cursor=cursor)
+    courses = ndb.get_multi([relation.course for relation in relations])
+    changed = [relation for relation, course in zip(relations, courses) if course and relation.copy_course(course)]
+    ndb.put_multi(changed)
+    logging.info("%s relations migrated: %s", kind, len(changed))
+    if more:
+        defer(migrate_course_relations, kind, cursor, batch_size)
+    elif kind == "CourseSubscription":
+        defer(migrate_course_relations, "CourseTrainers", None, batch_size)
+
+
+def migrate_session_indexes(cursor=None, batch_size=100):
+    """
+    Stores the club of the sessions and writes their ``SessionMember`` (see ``APIDB.put_session_indexes``). It runs
+    as a chain of deferred tasks, started by ``/api/admin/migrate-session-indexes``.
+
+    :param cursor: where to start
+    :param batch_size: the number of sessions for each task
+    """
+    sessions, cursor, more = models.Session.query().fetch_page(batch_size, start_cursor=cursor)
+    # the put sets the club and the status
+    APIDB.put_sessions(sessions)
+    APIDB.put_session_indexes(sessions)
+    logging.info("session indexes migrated: %s", len(sessions))
+    if more:
+        defer(migrate_session_indexes, cursor, batch_size)
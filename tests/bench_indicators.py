@@ -0,0 +1,57 @@
+"""
+Compares the pickled ``indicator_list`` with the columns of ``models.IndicatorColumns``: size of the stored
+entity and time to decode it and read its indicators.
+
+Run it from the root of the project, with the SDK in the path::
+
+    python tests/bench_indicators.py [attempts] [indicators per attempt]
+"""
+import sys
+import timeit
+
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+import models
+
+__author__ = 'stefano tranquillini'
+
+
+def _attempts(ids, n_attempts, n_indicators):
+    return [[dict(id=ids[i % len(ids)], value=attempt * i) for i in range(n_indicators)]
+            for attempt in range(n_attempts)]
+
+
+def main(n_attempts=10, n_indicators=8, number=2000):
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    ndb.get_context().set_cache_policy(False)
+    try:
+        club = ndb.Key(models.Club, "bench")
+        indicators = [models.Indicator(name="indicator %s" % i, description="indicator %s" % i, created_for=club)
+                      for i in range(n_indicators)]
+        ids = [key.urlsafe() for key in ndb.put_multi(indicators)]
+        attempts = _attempts(ids, n_attempts, n_indicators)
+        key = ndb.Key(models.Participation, "bench")
+        legacy = models.Participation(key=key, session=ndb.Key('Session', 1), user=ndb.Key('User', 1),
+                                      legacy_indicator_list=attempts)
+        encoded = models.Participation(key=key, session=ndb.Key('Session', 1), user=ndb.Key('User', 1))
+        encoded.indicator_list = attempts
+        print "%s attempts, %s indicators each" % (n_attempts, n_indicators)
+        for name, entity in (("pickle", legacy), ("columns", encoded)):
+            data = entity._to_pb().Encode()
+
+            def decode():
+                models.Participation._from_pb(entity_pb.EntityProto(data)).indicator_rows()
+
+            seconds = timeit.timeit(decode, number=number)
+            print "%-8s %6d bytes %8.1f us/decode" % (name, len(data), seconds / number * 1e6)
+    finally:
+        bed.deactivate()
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
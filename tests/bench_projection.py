@@ -0,0 +1,83 @@
+"""
+Compares the listings of the members of a club and of the subscribers of a course with the full relations and with
+the projection on ``member`` used by ``APIDB.__get`` (see ``APIDB._APIDB__projected``): bytes of the relations
+returned by the query and time of the listing.
+
+Run it from the root of the project, with the SDK in the path::
+
+    python tests/bench_projection.py [members] [observations per subscription]
+"""
+import sys
+import timeit
+
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from api_db_utils import APIDB
+import models
+
+__author__ = 'stefano tranquillini'
+
+
+def _populate(n_members, n_observations):
+    club = models.Club(name="bench club", url="http://bench.gymcentral.net", is_open=True)
+    club.put()
+    course = models.Course(name="bench course", description="bench course", club=club.key, course_type="FREE")
+    course.put()
+    exercises = ndb.put_multi([models.Exercise(name="exercise %s" % i, created_for=club.key) for i in range(5)])
+    users = ndb.put_multi([models.User(name="user %s" % i) for i in range(n_members)])
+    relations = []
+    for user in users:
+        relations.append(models.ClubMembership(id=models.ClubMembership.build_id(user, club.key), member=user,
+                                               club=club.key, membership_type="MEMBER", status="ACCEPTED"))
+        observations = [models.Observation(created_by=users[0], text="observation %s of the coach" % i)
+                        for i in range(n_observations)]
+        relations.append(models.CourseSubscription(id=models.CourseSubscription.build_id(user, course.key),
+                                                   member=user, course=course.key, status="ACCEPTED",
+                                                   disabled_exercises=exercises, observations=observations))
+    for i in range(0, len(relations), 500):
+        ndb.put_multi(relations[i:i + 500])
+    return club, course
+
+
+def _bytes(entities):
+    return sum(len(entity._to_pb(allow_partial=True).Encode()) for entity in entities)
+
+
+def _report(name, query, prop, listing, number):
+    full = query.fetch()
+    projected = query.fetch(projection=[prop])
+    print name
+    print "  %-10s %10d bytes %8.1f ms/query" % ("full", _bytes(full),
+                                                 timeit.timeit(query.fetch, number=number) / number * 1000)
+    print "  %-10s %10d bytes %8.1f ms/query" % ("projection", _bytes(projected),
+                                                 timeit.timeit(lambda: query.fetch(projection=[prop]),
+                                                               number=number) / number * 1000)
+    # the listing with the users, merge loads the full relations
+    print "  %-10s %10s       %8.1f ms/listing" % ("full", "", timeit.timeit(lambda: listing(merge='relation'),
+                                                                           number=number) / number * 1000)
+    print "  %-10s %10s       %8.1f ms/listing" % ("projection", "", timeit.timeit(listing, number=number) /
+                                                   number * 1000)
+
+
+def main(n_members=5000, n_observations=5, number=5):
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub(consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1))
+    bed.init_memcache_stub()
+    bed.init_search_stub()
+    ndb.get_context().set_cache_policy(False)
+    try:
+        club, course = _populate(n_members, n_observations)
+        print "%s members, %s observations for each subscription" % (n_members, n_observations)
+        _report("club members", club.members.filter(models.ClubMembership.status == "ACCEPTED"), 'member',
+                lambda **kwargs: APIDB.get_club_members(club, **kwargs), number)
+        _report("course subscribers", course.subscribers, 'member',
+                lambda **kwargs: APIDB.get_course_subscribers(course, **kwargs), number)
+    finally:
+        bed.deactivate()
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,87 @@
+"""
+Reports the import cost of the scripts of ``app.yaml``, as a new instance pays it. Each script is imported in a
+new process, the time of every module is measured with a hook on ``__import__``.
+
+Run it from the root of the project, with the SDK in the path::
+
+    python tests/profile_imports.py [script ...] [--top N]
+
+``total`` is the time of the module with the modules it imports, ``self`` without them.
+"""
+import __builtin__
+import os
+import subprocess
+import sys
+import time
+
+__author__ = 'stefano tranquillini'
+
+SCRIPTS = ['api_coach', 'api_trainee', 'api_admin', 'api_testing']
+
+
+def _fix_sys_path():
+    try:
+        import dev_appserver
+        dev_appserver.fix_sys_path()
+    except ImportError:
+        pass
+    sys.path.insert(0, os.getcwd())
+
+
+def _profile(script):
+    # name -> [total, self]
+    times = {}
+    stack = []
+    original_import = __builtin__.__import__
+
+    def timed_import(name, globals=None, locals=None, fromlist=None, level=-1):
+        loaded = len(sys.modules)
+        stack.append(0.0)
+        start = time.time()
+        try:
+            return original_import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.time() - start
+            children = stack.pop()
+            # only the imports that loaded something, e.g. "from google.appengine.api import search"
+            if len(sys.modules) > loaded:
+                if stack:
+                    stack[-1] += elapsed
+                if fromlist:
+                    name = "%s (%s)" % (name, ", ".join(fromlist))
+                times.setdefault(name, [elapsed, elapsed - children])
+
+    __builtin__.__import__ = timed_import
+    start = time.time()
+    try:
+        __import__(script)
+    finally:
+        __builtin__.__import__ = original_import
+    return time.time() - start, times
+
+
+def child(script, top):
+    _fix_sys_path()
+    total, times = _profile(script)
+    print "%s: %.1f ms, %s modules" % (script, total * 1000, len(times))
+    print "%10s %10s  module" % ("total ms", "self ms")
+    for name, (inclusive, own) in sorted(times.iteritems(), key=lambda item: -item[1][1])[:top]:
+        print "%10.1f %10.1f  %s" % (inclusive * 1000, own * 1000, name)
+    print
+
+
+def main(argv):
+    top = 20
+    if '--top' in argv:
+        i = argv.index('--top')
+        top = int(argv[i + 1])
+        argv = argv[:i] + argv[i + 2:]
+    if argv and argv[0] == '--child':
+        return child(argv[1], top)
+    for script in argv or SCRIPTS:
+        # a new process, as a new instance
+        subprocess.call([sys.executable, __file__, '--child', script, '--top', str(top)])
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
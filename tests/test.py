@@ -1,8 +1,13 @@
 from datetime import datetime, timedelta
+import json
 import logging
+import pickle
 import unittest
 import logging.config
 
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
 from google.appengine.ext import testbed
 from google.appengine.ext.ndb.key import Key
 import webtest
@@ -25,8 +30,14 @@ from api_admin import app as app_admin
 from api_trainee import app as app_trainee
 from api_coach import app
 from gaebasepy.auth import GCAuth
-from gaebasepy.gc_utils import date_to_js_timestamp, date_from_js_timestamp
+from gaebasepy.gc_utils import date_to_js_timestamp, date_from_js_timestamp, camel_case, json_serializer, \
+    sanitize_json
+import counters
+import identity_map
 import models
+import role_cache
+import serializer
+from tasks import sync_user, fan_out_sessions, migrate_participation_keys
 
 __author__ = 'Stefano Tranquillini <stefano.tranquillini@gmail.com>'
 
@@ -84,6 +95,8 @@ class APITestCases(unittest.TestCase):
         self.auth_headers_trainee_dummy = {'Authorization': str('Token %s' % GCAuth.auth_user_token(self.dummy)),
                                            'X-App-Id': 'trainee'}
         self.app = webtest.TestApp(app)
+        # the ids are the same in every test
+        role_cache.clear()
 
     def tearDown(self):
         self.testbed.deactivate()
@@ -168,7 +181,19 @@ class APITestCases(unittest.TestCase):
         d_input = dict(userId=self.user.id, role="MEMBER", profileLevel=10)
         self.app.post_json('/api/coach/courses/%s/subscriptions' % id_course, d_input,
                            headers=self.auth_headers_coach)
-
+        # the user is added to the sessions in a task
+        self._run_tasks()
+
+    def _run_tasks(self):
+        # runs the deferred tasks, also the ones queued by them. sync_user is skipped, it calls the external server
+        taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        tasks = taskqueue.get_filtered_tasks()
+        while tasks:
+            taskqueue.FlushQueue("default")
+            for task in tasks:
+                if pickle.loads(task.payload)[0] is not sync_user:
+                    deferred.run(task.payload)
+            tasks = taskqueue.get_filtered_tasks()
 
     def test_app_key(self):
         # check that app_id works correctly
@@ -367,6 +392,224 @@ class APITestCases(unittest.TestCase):
         # check that list is empty
         assert d_output['total'] == 0
 
+    def test_subscribed_courses(self):
+        id_club = self._create_club()
+        id_course = self._create_course(id_club=id_club)
+        self._create_course("PROGRAM", id_club=id_club)
+        self._trainee_club(id_club)
+        self._trainee_course(id_course)
+        url = '/api/trainee/clubs/%s/courses?subscribed=True' % id_club
+        d_output = self.app.get(url, headers=self.auth_headers_trainee).json
+        assert d_output['total'] == 1, d_output
+        assert d_output['results'][0]['id'] == id_course, d_output
+        d_output = self.app.get(url + '&course_type=PROGRAM', headers=self.auth_headers_trainee).json
+        assert d_output['total'] == 0, d_output
+        # the subscription follows the course
+        self.app.delete('/api/coach/courses/%s' % id_course, headers=self.auth_headers_coach)
+        d_output = self.app.get(url, headers=self.auth_headers_trainee).json
+        assert d_output['total'] == 0, d_output
+
+    def test_course_window(self):
+        id_club = self._create_club()
+        id_course = self._create_course(id_club=id_club)
+        self._trainee_club(id_club)
+        self._trainee_course(id_course)
+        end_date = datetime.now() + timedelta(days=10)
+        d_input = dict(name="after the course", sessionType='JOINT',
+                       startDate=date_to_js_timestamp(end_date - timedelta(hours=1)),
+                       endDate=date_to_js_timestamp(end_date))
+        self.app.post_json('/api/coach/courses/%s/sessions' % id_course, d_input, headers=self.auth_headers_coach)
+        course = Key(urlsafe=id_course).get()
+        assert course.end_date >= end_date - timedelta(seconds=1), course.end_date
+        # the subscription follows the course time
+        self._run_tasks()
+        subscription = models.CourseSubscription.query(models.CourseSubscription.course == course.key).get()
+        assert subscription.course_end_date == course.end_date, subscription
+        # an edit of the other fields doesn't write the relations
+        puts = self._count_puts()
+        self.app.put_json('/api/coach/courses/%s' % id_course, dict(name="renamed course"),
+                          headers=self.auth_headers_coach)
+        self._run_tasks()
+        assert not [kinds for kinds in puts if 'CourseSubscription' in kinds], puts
+
+    def test_session_lists_output(self):
+        # the lists render the same items the old to_dict + sanitize_json + camel_case did
+        id_club = self._create_club()
+        id_course = self._create_course(id_club=id_club)
+        self._trainee_club(id_club)
+        self._trainee_course(id_course)
+        for d_input in [dict(name="single", url="test url", sessionType='SINGLE'),
+                        dict(name="joint", sessionType='JOINT')]:
+            d_input.update(startDate=date_to_js_timestamp(datetime.now() - timedelta(minutes=30)),
+                           endDate=date_to_js_timestamp(datetime.now() + timedelta(minutes=30)))
+            self.app.post_json('/api/coach/courses/%s/sessions' % id_course, d_input, headers=self.auth_headers_coach)
+        course = Key(urlsafe=id_course).get()
+        sessions = models.Session.query(models.Session.course == course.key).fetch()
+        assert len(sessions) == 2, sessions
+
+        def check(url, headers, allowed, with_url=True, **values):
+            d_output = self.app.get(url, headers=headers).json
+            assert d_output['total'] == 2, d_output
+            results = dict((item['id'], item) for item in d_output['results'])
+            for session in sessions:
+                res_obj = session.to_dict()
+                res_obj.update(status=session.status, participation_count=0, **values)
+                keys = allowed + ['start_date', 'end_date']
+                if with_url and session.session_type == "SINGLE":
+                    keys += ['url']
+                res_obj = json.loads(json.dumps(camel_case(sanitize_json(res_obj, allowed=keys)),
+                                                default=json_serializer))
+                assert results[session.id] == res_obj, (results[session.id], res_obj)
+
+        base = ['id', 'name', 'status', 'participation_count', 'session_type']
+        check('/api/trainee/courses/%s/sessions' % id_course, self.auth_headers_trainee, base)
+        check('/api/coach/clubs/%s/sessions' % id_club, self.auth_headers_coach, base + ['course', 'created'],
+              course=sanitize_json(course, allowed=['id', 'name']))
+        # the coach course list never had the url
+        check('/api/coach/courses/%s/sessions' % id_course, self.auth_headers_coach,
+              base + ['participation_percent', 'max_level', 'profile'], with_url=False, participation_percent=0)
+        # the timeline of the trainee, as the old TimelineStub.to_dict
+        d_output = self.app.get('/api/trainee/clubs/%s/sessions' % id_club, headers=self.auth_headers_trainee).json
+        assert d_output['total'] == 2, d_output
+        results = dict((item['id'], item) for item in d_output['results'])
+        for stub in APIDB.get_timeline(self.user, Key(urlsafe=id_club).get()).stubs:
+            res_obj = ndb.Model.to_dict(stub, exclude=['session', 'course'])
+            res_obj.update(id=stub.session.urlsafe(), course_id=id_course, course_name=course.name,
+                           status=stub.status(course.course_type), max_level=course.max_level)
+            if stub.session_type != "SINGLE":
+                del res_obj['url']
+            del res_obj['week_no']
+            del res_obj['day_no']
+            res_obj = json.loads(json.dumps(camel_case(sanitize_json(res_obj)), default=json_serializer))
+            assert results[res_obj['id']] == res_obj, (results[res_obj['id']], res_obj)
+
+    def test_serializer(self):
+        id_course = self._create_course()
+        course = Key(urlsafe=id_course).get()
+        fields = ['id', 'name', 'course_type', 'start_date', 'max_level']
+        item = serializer.serialize(course, fields, session_count=1, profile=dict(profile_name="a"))
+        expected = camel_case(sanitize_json(dict(course.to_dict(), session_count=1, profile=dict(profile_name="a")),
+                                            allowed=fields + ['session_count', 'profile']))
+        assert item == expected, (item, expected)
+        # edit_response doesn't walk the serialized responses again
+        rv = serializer.response(results=[item], total=1, next=None, prev=None)
+        assert app.edit_response(rv) is rv
+        assert app.edit_response(dict(results=[dict(course_type="FREE")]))['results'][0] == dict(courseType="FREE")
+
+    def test_page_number_prev(self):
+        id_course = self._create_course('FREE')
+        for i in range(3):
+            self.app.post_json('/api/coach/courses/%s/sessions' % id_course, dict(name="session %s" % i,
+                                                                                 sessionType='JOINT'),
+                               headers=self.auth_headers_coach)
+        url = '/api/coach/courses/%s/sessions' % id_course
+        pages = [self.app.get(url, dict(page=page, size=1), headers=self.auth_headers_coach).json
+                 for page in range(3)]
+        assert pages[0]['prev'] is None, pages[0]
+        # the prev of a page by number is the previous page, and so on back to the first one
+        d_output = pages[2]
+        for page in (1, 0):
+            d_output = self.app.get(url, dict(cursor=d_output['prev'], size=1), headers=self.auth_headers_coach).json
+            assert d_output['results'] == pages[page]['results'], (d_output, pages[page])
+        assert d_output['prev'] is None, d_output
+
+    def test_finished_counter(self):
+        id_club = self._create_club()
+        id_course = self._create_course(id_club=id_club)
+        d_input = dict(name="expiring", sessionType='JOINT',
+                       startDate=date_to_js_timestamp(datetime.now() - timedelta(hours=1)),
+                       endDate=date_to_js_timestamp(datetime.now() + timedelta(minutes=30)))
+        id_session = self.app.post_json('/api/coach/courses/%s/sessions' % id_course, d_input,
+                                        headers=self.auth_headers_coach).json['id']
+        course = Key(urlsafe=id_course).get()
+        name = "sessions|%s|FINISHED" % course.key.id()
+        counters.initialize(name, 0)
+        # the session ended but the cron didn't run yet, it's stored as ONGOING
+        session = Key(urlsafe=id_session).get()
+        session.end_date = datetime.now() - timedelta(minutes=1)
+        session._pre_put_hook = lambda: None
+        session.put()
+        session = Key(urlsafe=id_session).get()
+        assert session.status == "ONGOING", session.status
+        exercise = models.Exercise(name="activity", created_for=course.club)
+        exercise.put()
+        # the put of the activities computes the new status, the counter follows it
+        assert APIDB.add_activity_to_session(session, exercise)
+        assert Key(urlsafe=id_session).get().status == "FINISHED"
+        assert counters.get_count(name) == 1, counters.get_count(name)
+        assert APIDB.rm_activity_from_session(session, exercise)
+        assert counters.get_count(name) == 1, counters.get_count(name)
+        # the cron finds nothing to fix
+        APIDB.update_sessions_status()
+        assert counters.get_count(name) == 1, counters.get_count(name)
+
+    def test_club_sessions_index(self):
+        id_club = self._create_club()
+        id_course = self._create_course('FREE', id_club=id_club)
+        self._trainee_club(id_club)
+        d_input = dict(name="before the subscription", sessionType='JOINT')
+        self.app.post_json('/api/coach/courses/%s/sessions' % id_course, d_input, headers=self.auth_headers_coach)
+        self._trainee_course(id_course)
+        d_input = dict(name="after the subscription", sessionType='JOINT')
+        id_session = self.app.post_json('/api/coach/courses/%s/sessions' % id_course, d_input,
+                                        headers=self.auth_headers_coach).json['id']
+        # a save that doesn't change the fields of the members doesn't write them
+        puts = self._count_puts()
+        self.app.put_json('/api/coach/sessions/%s' % id_session, dict(name="renamed"),
+                          headers=self.auth_headers_coach)
+        assert not [kinds for kinds in puts if 'SessionMember' in kinds], puts
+        url = '/api/trainee/clubs/%s/sessions' % id_club
+        d_output = self.app.get(url, headers=self.auth_headers_trainee).json
+        assert d_output['total'] == 2, d_output
+        d_output = self.app.get('/api/coach/clubs/%s/sessions' % id_club, headers=self.auth_headers_coach).json
+        assert d_output['total'] == 2, d_output
+        # the sessions of a deleted course leave the club
+        self.app.delete('/api/coach/courses/%s' % id_course, headers=self.auth_headers_coach)
+        self._run_tasks()
+        d_output = self.app.get(url, headers=self.auth_headers_trainee).json
+        assert d_output['total'] == 0, d_output
+        d_output = self.app.get('/api/coach/clubs/%s/sessions' % id_club, headers=self.auth_headers_coach).json
+        assert d_output['total'] == 0, d_output
+
+    def test_timeline(self):
+        id_club = self._create_club()
+        id_course = self._create_course('FREE', id_club=id_club)
+        self._trainee_club(id_club)
+        self._trainee_course(id_course)
+        url = '/api/trainee/clubs/%s/sessions' % id_club
+        # builds the timeline
+        d_output = self.app.get(url, headers=self.auth_headers_trainee).json
+        assert d_output['total'] == 0, d_output
+        # the new session is written in the timeline
+        d_input = dict(name="session timeline", sessionType='JOINT')
+        id_session = self.app.post_json('/api/coach/courses/%s/sessions' % id_course, d_input,
+                                        headers=self.auth_headers_coach).json['id']
+        self._run_tasks()
+        d_output = self.app.get(url, headers=self.auth_headers_trainee).json
+        assert d_output['total'] == 1, d_output
+        assert d_output['results'][0]['id'] == id_session, d_output
+        assert d_output['results'][0]['courseId'] == id_course, d_output
+        assert d_output['results'][0]['courseName'] == "name course", d_output
+        assert not d_output['results'][0]['participated'], d_output
+        d_output = self.app.get(url + '/ongoing', headers=self.auth_headers_trainee).json
+        assert d_output['id'] == id_session, d_output
+        # the course is not copied in the timeline
+        self.app.put_json('/api/coach/courses/%s' % id_course, dict(name="renamed course"),
+                          headers=self.auth_headers_coach)
+        d_output = self.app.get(url, headers=self.auth_headers_trainee).json
+        assert d_output['results'][0]['courseName'] == "renamed course", d_output
+        # a save that doesn't change the fields of the timeline doesn't queue the fan-out
+        self.app.put_json('/api/coach/sessions/%s' % id_session, dict(name="session timeline"),
+                          headers=self.auth_headers_coach)
+        taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        queued = [pickle.loads(task.payload)[0] for task in taskqueue.get_filtered_tasks()]
+        assert fan_out_sessions not in queued, queued
+        # and removed when it's canceled
+        self.app.delete('/api/coach/sessions/%s' % id_session, headers=self.auth_headers_coach)
+        self._run_tasks()
+        d_output = self.app.get(url, headers=self.auth_headers_trainee).json
+        assert d_output['total'] == 0, d_output
+
     def test_sessions(self):
         id_club = self._create_club()
         profile = dict(name="profile test")
@@ -407,6 +650,8 @@ class APITestCases(unittest.TestCase):
         assert d_output['total'] == 0
 
         self.app.get('/api/coach/sessions/%s' % id_session, status=404, headers=self.auth_headers_coach)
+        # the canceled session was loaded, the map of the failed request is removed anyway
+        assert identity_map.stats()['size'] == 0, identity_map.stats()
 
         id_course = self._create_course('SCHEDULED', id_club=id_club)
         # session_response_base = ['id', 'name', 'sessionType', 'profile', 'status', 'metaData', 'activities', 'onBefore',
@@ -489,6 +734,136 @@ class APITestCases(unittest.TestCase):
         assert d_output['score'] == 40, d_output
 
 
+    def _count_puts(self):
+        """
+        Records the kinds of the entities of each datastore ``Put`` RPC
+        """
+        puts = []
+
+        def hook(service, call, request, response):
+            if call == 'Put':
+                puts.append([entity.key().path().element_list()[-1].type() for entity in request.entity_list()])
+
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('count_puts', hook, 'datastore_v3')
+        return puts
+
+    def _count_gets(self):
+        """
+        Records the kinds of the keys of each datastore ``Get`` RPC
+        """
+        gets = []
+
+        def hook(service, call, request, response):
+            if call == 'Get':
+                gets.append([key.path().element_list()[-1].type() for key in request.key_list()])
+
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('count_gets', hook, 'datastore_v3')
+        return gets
+
+    def test_role_cache(self):
+        id_club = self._create_club()
+        self.app.get('/api/coach/clubs/%s' % id_club, headers=self.auth_headers_coach)
+        gets = self._count_gets()
+        self.app.get('/api/coach/clubs/%s' % id_club, headers=self.auth_headers_coach)
+        assert not [kinds for kinds in gets if 'ClubMembership' in kinds], gets
+        # the mutators invalidate the cache
+        APIDB.rm_member_from_club(self.coach, Key(urlsafe=id_club).get())
+        self.app.get('/api/coach/clubs/%s' % id_club, headers=self.auth_headers_coach, status=401)
+
+    def test_performance_puts(self):
+        id_club = self._create_club()
+        id_course = self._create_course('PROGRAM', id_club=id_club)
+        d_input = dict(name="session puts", sessionType='JOINT', weekNo=1, dayNo=2)
+        id_session = self.app.post_json('/api/coach/courses/%s/sessions' % id_course, d_input,
+                                        headers=self.auth_headers_coach).json['id']
+        self.app.post_json('/api/coach/clubs/%s/activities' % id_club, dict(name="activity", indicators=[]),
+                           headers=self.auth_headers_coach)
+        id_activity = self.app.get('/api/coach/clubs/%s/activities' % id_club,
+                                   headers=self.auth_headers_coach).json['results'][0]['id']
+        # the trainee has level 10
+        self.app.post_json('/api/coach/activities/%s/levels' % id_activity,
+                           dict(name="level", description="level 10", levelNumber=10, details=[]),
+                           headers=self.auth_headers_coach)
+        self.app.put_json('/api/coach/sessions/%s' % id_session, dict(activities=[dict(id=id_activity)]),
+                          headers=self.auth_headers_coach)
+        self._trainee_club(id_club)
+        self._trainee_course(id_course)
+
+        puts = self._count_puts()
+        for completeness in (10, 40):
+            del puts[:]
+            d_input = dict(joinTime=date_to_js_timestamp(datetime.now()),
+                           leaveTime=date_to_js_timestamp(datetime.now()), completeness=completeness,
+                           indicators=[], activityPerformances=[
+                    dict(activityId=id_activity, completeness=completeness, indicators=[],
+                         recordDate=date_to_js_timestamp(datetime.now()))])
+            self.app.post_json('/api/trainee/sessions/%s/performances' % id_session, d_input,
+                               headers=self.auth_headers_trainee)
+            # participation and performance are written once, with the same rpc
+            writes = [kinds for kinds in puts if 'Participation' in kinds or 'Performance' in kinds]
+            assert len(writes) == 1, puts
+            assert sorted(writes[0]) == ['Participation', 'Performance'], puts
+
+        # the single calls write each entity once too
+        session = Key(urlsafe=id_session).get()
+        del puts[:]
+        participation = APIDB.create_participation(self.user, session, 50, date_to_js_timestamp(datetime.now()),
+                                                   date_to_js_timestamp(datetime.now()), [])
+        APIDB.create_performance(participation, id_activity, 50, date_to_js_timestamp(datetime.now()), [])
+        writes = [kinds for kinds in puts if 'Participation' in kinds or 'Performance' in kinds]
+        assert writes == [['Participation'], ['Performance']], puts
+        assert participation.completeness == [10, 40, 50], participation.completeness
+
+    def test_migrate_participation_keys(self):
+        session_key = Key(urlsafe=self.app.post_json(
+            '/api/coach/courses/%s/sessions' % self._create_course('FREE'), dict(name="session", sessionType='JOINT'),
+            headers=self.auth_headers_coach).json['id'])
+        start = datetime.now() - timedelta(days=30)
+
+        def participation(key, days):
+            entity = models.Participation(key=key, session=session_key, user=self.user.key, level=1,
+                                          time=[models.TimeData(join=start + timedelta(days=day),
+                                                                leave=start + timedelta(days=day)) for day in days],
+                                          completeness=days)
+            ndb.put_multi([entity] + entity.compact_history())
+            return entity
+
+        # the legacy one has some attempts in ParticipationAttempt, the one with the new key only the inline ones
+        legacy = participation(Key(models.Participation, 'legacy'), range(1, 24, 2))
+        key = models.Participation.build_key(self.user.key, session_key, 1)
+        participation(key, [2, 4, 6])
+        assert legacy.spilled_count == 2, legacy.spilled_count
+        migrate_participation_keys()
+        assert legacy.key.get() is None
+        assert not models.ParticipationAttempt.query(ancestor=legacy.key).fetch(keys_only=True)
+        merged = key.get()
+        assert merged.participation_count == 15, merged.participation_count
+        full = APIDB.get_attempts_history([merged])[0]
+        days = [2, 4, 6] + range(1, 24, 2)
+        assert full.completeness == sorted(days), full.completeness
+        assert [time.join for time in full.time] == [start + timedelta(days=day) for day in sorted(days)]
+
+    def test_indicator_columns(self):
+        club_key = Key(urlsafe=self._create_club())
+        heart_rate = models.Indicator(name="heart rate", description="heart rate", created_for=club_key).put()
+        steps = models.Indicator(name="steps", description="steps", created_for=club_key).put()
+        heart_rate, steps = heart_rate.urlsafe(), steps.urlsafe()
+        attempts = [[dict(id=heart_rate, value=120), dict(id=steps, value=10)], [], [dict(id=steps, value=30)]]
+        participation = models.Participation(session=Key('Session', 1), user=self.user.key)
+        participation.indicator_list = attempts
+        assert participation.indicator_offsets == [0, 2, 2], participation.indicator_offsets
+        participation.put()
+        participation = participation.key.get()
+        assert participation.indicator_list == attempts, participation.indicator_list
+        assert participation.indicators[2][0]['value'] == 30, participation.indicators
+        assert participation.indicators[0][0]['name'] == "heart rate", participation.indicators
+        # the pickled list is encoded on the next write
+        legacy = models.Participation(session=Key('Session', 1), user=self.user.key, legacy_indicator_list=attempts)
+        assert legacy.indicators == participation.indicators
+        legacy.add_indicators([dict(id=heart_rate, value=90)])
+        assert legacy.legacy_indicator_list is None
+        assert legacy.indicator_list == attempts + [[dict(id=heart_rate, value=90)]], legacy.indicator_list
+
     def test_subscribers(self):
         id_course = self._create_course('FREE')
         d_input = dict(userId=self.user.id, role="MEMBER", profileLevel=10)
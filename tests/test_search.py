@@ -14,6 +14,7 @@ from google.appengine.api import search
 # don't delete these
 from google.appengine.ext.ndb.key import Key
 from api_db_utils import APIDB
+import search_index
 
 __author__ = 'Stefano Tranquillini <stefano.tranquillini@gmail.com>'
 
@@ -30,7 +31,8 @@ class APITestCases(unittest.TestCase):
         self.testbed.init_datastore_v3_stub()
         self.testbed.init_memcache_stub()
         self.testbed.init_urlfetch_stub()
-        self.testbed.init_taskqueue_stub()
+        # the queue.yaml has the pull queue of the search index
+        self.testbed.init_taskqueue_stub(root_path='..')
         self.testbed.init_search_stub()
 
 
@@ -58,6 +60,11 @@ class APITestCases(unittest.TestCase):
                           picture='..', email='elstefano@test.it', phone='2313213', active_club=None,
                           unique_properties=['email'])
 
+        # the documents are written by the cron job, then the hash of the fields is stored
+        assert to_change.key.get().search_hash is None
+        search_index.drain("users")
+        stored = to_change.key.get()
+        assert stored.search_hash == search_index.fields_hash(stored.search_fields()), stored.search_hash
         index = search.Index(name="users")
         query_string = "stefano"
         query_options = search.QueryOptions(ids_only=True)
@@ -66,6 +73,7 @@ class APITestCases(unittest.TestCase):
         print len(ndb.get_multi(results))
         to_change.email = "stefano@test.it"
         to_change.put()
+        search_index.drain("users")
         query = search.Query(query_string=query_string, options=query_options)
         results = [Key(urlsafe=r.doc_id) for r in index.search(query)]
         print len(ndb.get_multi(results))